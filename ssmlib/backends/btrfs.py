@@ -17,7 +17,10 @@
 
 import re
 import os
+import fcntl
+import struct
 import datetime
+import threading
 from ssmlib import misc
 from ssmlib.backends import template
 
@@ -38,40 +41,234 @@ def get_btrfs_version():
         version = "0.0"
     return float(version)
 
-BTRFS_VERSION = get_btrfs_version()
-
-
-class Btrfs(template.Backend):
-
-    def __init__(self, *args, **kwargs):
-        super(Btrfs, self).__init__(*args, **kwargs)
-        self.type = 'btrfs'
-        self.default_pool_name = SSM_BTRFS_DEFAULT_POOL
-        self._vol = {}
-        self._pool = {}
-        self._dev = {}
-        self._snap = {}
-        self._subvolumes = {}
-        self._binary = misc.check_binary('btrfs')
+# Detected on the first use by btrfs_version()
+BTRFS_VERSION = None
+
+
+def btrfs_version():
+    global BTRFS_VERSION
+    with misc.TOOL_VERSION_LOCK:
+        if BTRFS_VERSION is None:
+            BTRFS_VERSION = misc.get_tool_version('btrfs', get_btrfs_version,
+                                                  0.0)
+    return BTRFS_VERSION
+
+
+# Mounted btrfs file systems described by the kernel
+BTRFS_SYSFS = "/sys/fs/btrfs"
+
+# A line of 'btrfs subvolume list'. Some versions prefix the path with
+# <FS_TREE>, which is not interesting for us.
+SUBVOLUME_LINE_RE = re.compile(
+    r'ID (\d+) .*?top level (\d+) .*?path (?:<FS_TREE>/*)?(.*)$')
+
+# Name of the snapshots created by 'ssm snapshot' without a name
+SNAP_NAME_RE = re.compile(r"snap-\d{4}-\d{2}-\d{2}-T\d{6}")
+
+
+# Walking the tree of tree roots with ioctls, see linux/btrfs.h and
+# linux/btrfs_tree.h
+BTRFS_IOC_TREE_SEARCH_V2 = 0xC0709411
+BTRFS_IOC_INO_LOOKUP = 0xD0009412
+BTRFS_ROOT_TREE_OBJECTID = 1
+BTRFS_FS_TREE_OBJECTID = 5
+BTRFS_FIRST_FREE_OBJECTID = 256
+BTRFS_LAST_FREE_OBJECTID = 0xFFFFFFFFFFFFFF00
+BTRFS_ROOT_ITEM_KEY = 132
+BTRFS_ROOT_BACKREF_KEY = 144
+U64_MAX = 0xFFFFFFFFFFFFFFFF
+
+# struct btrfs_ioctl_search_args_v2 without the buffer: the search key
+# followed by the size of the buffer
+SEARCH_ARGS = struct.Struct("=7Q4L4QQ")
+# struct btrfs_ioctl_search_header
+SEARCH_HEADER = struct.Struct("=3Q2L")
+SEARCH_BUF_SIZE = 65536
+# struct btrfs_ioctl_ino_lookup_args
+INO_LOOKUP_ARGS = struct.Struct("=2Q4080s")
+# Generation of the root in struct btrfs_root_item
+ROOT_ITEM_GENERATION = struct.Struct("<Q")
+ROOT_ITEM_GENERATION_OFFSET = 160
+# struct btrfs_root_ref, followed by the name of the subvolume
+ROOT_REF = struct.Struct("<QQH")
+
+
+def _tree_search(fd, tree_id, min_objectid, max_objectid, min_type,
+                 max_type):
+    """
+    Yield (objectid, type, offset, data) of all the items in the given
+    range of keys of a btrfs tree. Keys are compared as a whole, so items
+    of other types might be returned as well.
+    """
+    args = bytearray(SEARCH_ARGS.size + SEARCH_BUF_SIZE)
+    min_offset = 0
+    while min_objectid <= max_objectid:
+        SEARCH_ARGS.pack_into(args, 0, tree_id, min_objectid, max_objectid,
+                              min_offset, U64_MAX, 0, U64_MAX, min_type,
+                              max_type, 4096, 0, 0, 0, 0, 0, SEARCH_BUF_SIZE)
+        fcntl.ioctl(fd, BTRFS_IOC_TREE_SEARCH_V2, args, True)
+        nr_items = SEARCH_ARGS.unpack_from(args)[9]
+        if nr_items == 0:
+            return
+        pos = SEARCH_ARGS.size
+        for _ in range(nr_items):
+            objectid, offset, item_type, length = \
+                SEARCH_HEADER.unpack_from(args, pos)[1:]
+            pos += SEARCH_HEADER.size
+            yield objectid, item_type, offset, bytes(args[pos:pos + length])
+            pos += length
+        # Continue right after the last key found
+        min_objectid, min_type = objectid, item_type
+        if offset < U64_MAX:
+            min_offset = offset + 1
+        elif item_type < 255:
+            min_offset = 0
+            min_type = item_type + 1
+        else:
+            min_offset = min_type = 0
+            min_objectid = objectid + 1
+
+
+def _ino_lookup(fd, tree_id, objectid):
+    """
+    Return path of the directory objectid inside of the subvolume tree_id,
+    relative to the subvolume and ending with '/', or an empty string for
+    the top directory of the subvolume.
+    """
+    args = bytearray(INO_LOOKUP_ARGS.pack(tree_id, objectid, b""))
+    fcntl.ioctl(fd, BTRFS_IOC_INO_LOOKUP, args, True)
+    name = INO_LOOKUP_ARGS.unpack_from(args)[2]
+    return misc.__str__(name.split(b"\0", 1)[0])
+
+
+def _read_subvolumes(items, ino_lookup):
+    """
+    Make a list of subvolumes out of the ROOT_ITEM and ROOT_BACKREF items
+    of the tree of tree roots. Each of them is a dictionary with ID, ID of
+    the parent subvolume, generation, path from the top of the file system
+    and whether it is a snapshot, sorted by ID.
+
+    Parameters
+    ----------
+    items : iterable
+        (objectid, type, offset, data) of the items
+    ino_lookup : callable
+        Function (tree_id, objectid) returning path of a directory, as
+        _ino_lookup() does
+    """
+    roots = {}
+    refs = {}
+    for objectid, item_type, offset, data in items:
+        if item_type == BTRFS_ROOT_ITEM_KEY:
+            generation = ROOT_ITEM_GENERATION.unpack_from(
+                data, ROOT_ITEM_GENERATION_OFFSET)[0]
+            # Offset of the root item is the generation the snapshot was
+            # taken in, zero for subvolumes created from scratch
+            roots[objectid] = (generation, offset != 0)
+        elif item_type == BTRFS_ROOT_BACKREF_KEY:
+            dirid, sequence, name_len = ROOT_REF.unpack_from(data)
+            name = data[ROOT_REF.size:ROOT_REF.size + name_len]
+            refs[objectid] = (offset, dirid, misc.__str__(name))
+
+    paths = {BTRFS_FS_TREE_OBJECTID: ""}
+
+    def get_path(objectid):
+        if objectid not in paths:
+            parent, dirid, name = refs[objectid]
+            path = get_path(parent)
+            if path:
+                path += "/"
+            paths[objectid] = path + ino_lookup(parent, dirid) + name
+        return paths[objectid]
+
+    subvolumes = []
+    for objectid in sorted(refs):
+        # Subvolumes being deleted still have their back reference
+        if objectid not in roots:
+            continue
+        generation, snapshot = roots[objectid]
+        subvolumes.append({'ID': objectid,
+                           'parent_ID': refs[objectid][0],
+                           'generation': generation,
+                           'path': get_path(objectid),
+                           'snapshot': snapshot})
+    return subvolumes
+
+
+def get_subvolumes(mount):
+    """
+    List all subvolumes of the btrfs file system mounted at mount without
+    running 'btrfs subvolume list', see _read_subvolumes(). Raises OSError
+    when the ioctls are not available.
+    """
+    fd = os.open(mount, os.O_RDONLY)
+    try:
+        items = _tree_search(fd, BTRFS_ROOT_TREE_OBJECTID,
+                             BTRFS_FIRST_FREE_OBJECTID,
+                             BTRFS_LAST_FREE_OBJECTID,
+                             BTRFS_ROOT_ITEM_KEY, BTRFS_ROOT_BACKREF_KEY)
+        return _read_subvolumes(
+            items, lambda tree_id, objectid: _ino_lookup(fd, tree_id,
+                                                         objectid))
+    finally:
+        os.close(fd)
+
+
+class BtrfsModel(object):
+    """
+    Information about all btrfs file systems in the system. It is parsed
+    from a single 'btrfs filesystem show' call and the subvolume lists of
+    the mounted file systems, and shared by all the btrfs backends until
+    the storage configuration changes. Backends get their own copies of
+    the rows so they are free to modify them.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
         self.modified_list_version = True
+        self.invalidate()
+
+    def invalidate(self):
+        with self.lock:
+            self.output = None
+            self.mounts = {}
+            self.pool = {}
+            self.vol = {}
+            self.dev = {}
+            # Subvolume lists by (mount, list_snapshots)
+            self._lists = {}
+            # Subvolumes found by get_subvolumes() by mount, or None
+            self._trees = {}
+            # Subvolumes by list_snapshots
+            self._subvolumes = {}
+
+    def load(self):
+        """ Parse 'btrfs filesystem show' unless it was done already. """
+        with self.lock:
+            if self.output is None:
+                self._parse()
+
+    def _parse(self):
+        mounts = misc.get_mounts('btrfs')
+        partitions = {}
+        for line in misc.get_partitions():
+            partitions[line[3]] = line
 
-        if not self._binary:
+        if misc.SSM_SYSFS and self._parse_sysfs(mounts, partitions):
+            self.mounts = mounts
+            self.output = ""
             return
 
-        self.mounts = misc.get_mounts('btrfs')
         command = ['btrfs', 'filesystem', 'show']
-        self.output = misc.run(command, stderr=False)[1]
+        output = misc.run(command, stderr=False)[1]
 
         vol = {}
         pool = {}
         dev = {}
-        partitions = {}
         fs_size = pool_size = fs_used = 0
         pool_name = ''
-        for line in misc.get_partitions():
-            partitions[line[3]] = line
 
-        for line in self.output.strip().split("\n"):
+        for line in output.strip().split("\n"):
             if not line:
                 continue
             array = line.split()
@@ -91,17 +288,7 @@ class Btrfs(template.Backend):
 
                 try:
                     vol['real_dev'] = misc.get_device_by_uuid(uuid)
-
-                    if vol['real_dev'] in self.mounts:
-                        pool['mount'] = self.mounts[vol['real_dev']]['mp']
-                        vol['mount'] = self.mounts[vol['real_dev']]['mp']
-
-                    else:
-                        for dev_i in self.mounts:
-                            found = re.findall(r'{0}:/.*'.format(vol['real_dev']), dev_i)
-                            if found:
-                                pool['mount'] = self.mounts[found[0]]['mp']
-                                break
+                    self._fill_mounts(vol, pool, mounts)
                 except OSError:
                     # udev is "hard-to-work-with" sometimes so this is fallback
                     vol['real_dev'] = ""
@@ -130,18 +317,18 @@ class Btrfs(template.Backend):
 
                 # Fallback in case we could not find real_dev by uuid
                 if 'mount' not in pool:
-                    if dev['dev_name'] in self.mounts:
-                        pool['mount'] = self.mounts[dev['dev_name']]['mp']
+                    if dev['dev_name'] in mounts:
+                        pool['mount'] = mounts[dev['dev_name']]['mp']
                         vol['real_dev'] = dev['dev_name']
 
-                        if 'root' in self.mounts[dev['dev_name']]:
-                            if self.mounts[dev['dev_name']]['root'] == '/':
-                                vol['mount'] = self.mounts[dev['dev_name']]['mp']
+                        if 'root' in mounts[dev['dev_name']]:
+                            if mounts[dev['dev_name']]['root'] == '/':
+                                vol['mount'] = mounts[dev['dev_name']]['mp']
                     else:
-                        for dev_i in self.mounts:
+                        for dev_i in mounts:
                             found = re.findall(r'{0}:/.*'.format(dev['dev_name']), dev_i)
                             if found:
-                                pool['mount'] = self.mounts[found[0]]['mp']
+                                pool['mount'] = mounts[found[0]]['mp']
                                 vol['real_dev'] = found[0].split(':')[0]
                                 break
 
@@ -154,19 +341,130 @@ class Btrfs(template.Backend):
                 pool_size += dev_size
                 dev['dev_free'] = dev_size - dev_used
                 dev['hide'] = False
-                self._dev[dev['dev_name']] = dev
+                self.dev[dev['dev_name']] = dev
                 dev = {}
 
         if len(vol) > 0:
             self._store_data(vol, pool, fs_used, fs_size, pool_size, pool_name)
+        self.mounts = mounts
+        self.output = output
 
-    def run_btrfs(self, command):
-        if not self._binary:
-            self.problem.check(self.problem.TOOL_MISSING, 'btrfs')
-        command.insert(0, "btrfs")
-        return misc.run(command, stdout=True)
+    def _parse_sysfs(self, mounts, partitions):
+        """
+        Fill the model from BTRFS_SYSFS without running any command. The
+        kernel only describes mounted file systems there and it does not
+        say how much of each device is used, so this is possible only when
+        every btrfs file system is mounted and lives on a single device.
+        The size of the file system is taken from statvfs() of its mount
+        point. Otherwise return False and leave the model untouched.
+        """
+        if not partitions or not os.path.isdir(BTRFS_SYSFS):
+            return False
+        signatures = misc.SNAPSHOT.signatures()
+        # We can not be sure to know about all the btrfs file systems
+        # unless we know the signatures of all the devices
+        for name in partitions:
+            if name not in signatures:
+                return False
+        uuids = set([signature['UUID'] for signature in signatures.values()
+                     if signature['TYPE'] == 'btrfs'])
+        by_devno = {}
+        for row in partitions.values():
+            by_devno["{0}:{1}".format(row[0], row[1])] = row
+
+        filesystems = []
+        try:
+            for uuid in sorted(uuids):
+                path = os.path.join(BTRFS_SYSFS, uuid)
+                if not os.path.isdir(path):
+                    # Not mounted
+                    return False
+                devices = os.listdir(os.path.join(path, 'devices'))
+                if len(devices) != 1:
+                    return False
+                with open(os.path.join(path, 'label'), 'r') as f:
+                    label = f.read().strip() or 'none'
+                with open(os.path.join(path, 'devices', devices[0],
+                                       'dev'), 'r') as f:
+                    row = by_devno[f.read().strip()]
+                fs_used = dev_used = 0
+                for chunk in ['data', 'metadata', 'system']:
+                    chunk = os.path.join(path, 'allocation', chunk)
+                    if not os.path.isdir(chunk):
+                        continue
+                    with open(os.path.join(chunk, 'bytes_used'), 'r') as f:
+                        fs_used += int(f.read())
+                    with open(os.path.join(chunk, 'disk_total'), 'r') as f:
+                        dev_used += int(f.read())
+                vol = {'uuid': uuid, 'ID': 0}
+                pool = {'uuid': uuid, 'dev_count': '1'}
+                if label != 'none':
+                    vol['label'] = label
+                vol['real_dev'] = misc.get_real_device(row[3])
+                self._fill_mounts(vol, pool, mounts)
+                if 'mount' not in pool:
+                    return False
+                # Size of the file system, which may be smaller than the
+                # device it lives on
+                stat = os.statvfs(pool['mount'])
+                fs_size = stat.f_blocks * stat.f_frsize / 1024.0
+                filesystems.append((vol, pool, label, row, fs_used / 1024.0,
+                                    fs_size, dev_used / 1024.0))
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+
+        for vol, pool, label, row, fs_used, fs_size, dev_used in filesystems:
+            dev_name = vol['real_dev']
+            pool_name = self._find_uniq_pool_name(label, row[3])
+            # Like 'btrfs filesystem show', the pool counts whole devices
+            dev_size = int(row[2])
+            self.dev[dev_name] = {'dev_name': dev_name,
+                                  'pool_name': pool_name,
+                                  'dev_used': str(dev_used),
+                                  'dev_free': dev_size - dev_used,
+                                  'hide': False}
+            self._store_data(vol, pool, fs_used, fs_size, dev_size,
+                             pool_name)
+        return True
+
+    def _fill_mounts(self, vol, pool, mounts):
+        """ Find where the file system with vol['real_dev'] is mounted. """
+        if vol['real_dev'] in mounts:
+            pool['mount'] = mounts[vol['real_dev']]['mp']
+            vol['mount'] = mounts[vol['real_dev']]['mp']
+
+        else:
+            for dev_i in mounts:
+                found = re.findall(r'{0}:/.*'.format(vol['real_dev']), dev_i)
+                if found:
+                    pool['mount'] = mounts[found[0]]['mp']
+                    break
+
+    def _find_uniq_pool_name(self, label, dev):
+        if len(label) < 3 or label == "none":
+            label = "btrfs_{0}".format(os.path.basename(dev))
+        if label not in self.pool:
+            return label
+        return os.path.basename(dev)
+
+    def _store_data(self, vol, pool, fs_used, fs_size, pool_size, pool_name):
+        vol['fs_type'] = 'btrfs'
+        vol['fs_used'] = pool['pool_used'] = str(fs_used)
+        vol['fs_free'] = str(fs_size - fs_used)
+        vol['fs_size'] = vol['vol_size'] = str(fs_size)
+        pool['pool_free'] = str(pool_size - fs_used)
+        pool['pool_size'] = pool_size
+        pool['pool_name'] = vol['pool_name'] = vol['dev_name'] = pool_name
+        pool['type'] = 'btrfs'
+        vol['type'] = 'btrfs'
+
+        self.pool[pool['pool_name']] = pool
+        self.vol[vol['dev_name']] = vol
 
     def _list_subvolumes(self, mount, list_snapshots=False):
+        key = (mount, list_snapshots)
+        if key in self._lists:
+            return self._lists[key]
         command = ['btrfs', 'subvolume', 'list']
         if self.modified_list_version:
             command.append('-a')
@@ -180,48 +478,78 @@ class Btrfs(template.Backend):
                 command.append('-s')
             output = misc.run(command + [mount], stdout=False)[1]
             self.modified_list_version = False
+        self._lists[key] = output
         return output
 
+    def _get_subvolumes(self, mount, list_snapshots=False):
+        """
+        Return list of subvolumes, or only snapshots, of the file system
+        mounted at mount. All of them are found by a single walk of the
+        tree of tree roots, when that is not possible we fall back to
+        'btrfs subvolume list'.
+        """
+        if mount not in self._trees:
+            try:
+                self._trees[mount] = get_subvolumes(mount)
+            except (IOError, OSError, KeyError, ValueError, struct.error):
+                self._trees[mount] = None
+        if self._trees[mount] is None:
+            output = self._list_subvolumes(mount, list_snapshots)
+            return list(self._parse_subvolumes(output))
+        return [{'ID': str(subvolume['ID']),
+                 'top_level': str(subvolume['parent_ID']),
+                 'path': subvolume['path'],
+                 'subvolume': True}
+                for subvolume in self._trees[mount]
+                if subvolume['snapshot'] or not list_snapshots]
+
     # There is no way in btrfs to list subvolumes which are not snapshots
     # so we have to get the list of snapshots to filter it out from
     # regular subvolume list so we do not have it in the output twice.
     # Once in volume list and once in snapshot list.
     def _get_snap_name_list(self, mount):
-        snap = []
-        if BTRFS_VERSION < 0.20:
+        snap = set()
+        if btrfs_version() < 0.20:
             return snap
-        command = ['btrfs', 'subvolume', 'list', '-s', mount]
-        output = misc.run(command, stdout=False)[1]
-
-        for line in output.strip().split("\n"):
-            if not line:
-                continue
-            path = re.search('(?<=path ).*$', line).group(0)
-            snap.append(path)
+        # The very same list is used for the snapshot view
+        for volume in self._get_subvolumes(mount, list_snapshots=True):
+            snap.add(volume['path'])
         return snap
 
+    def subvolumes(self, list_snapshots=False):
+        """
+        Return subvolumes of all the mounted btrfs file systems, or only
+        the snapshots if list_snapshots is True. The rows are shared, do
+        not modify them.
+        """
+        with self.lock:
+            self.load()
+            if list_snapshots not in self._subvolumes:
+                self._subvolumes[list_snapshots] = \
+                    self._fill_subvolumes(list_snapshots)
+            return self._subvolumes[list_snapshots]
+
     def _fill_subvolumes(self, list_snapshots=False):
-        if not self._binary:
-            return
-        if self._subvolumes:
-            return
-        for (name, vol) in self._vol.items():
+        subvolumes = {}
+        for (name, vol) in self.vol.items():
             pool_name = vol['pool_name']
             real_dev = vol['real_dev']
-            pool = self._pool[pool_name]
+            pool = self.pool[pool_name]
 
-            if 'mount' in self._pool[pool_name]:
+            if 'mount' in self.pool[pool_name]:
                 mount = pool['mount']
             else:
                 # If btrfs is not mounted we will not process subvolumes
                 continue
 
-            snapshots = []
+            snapshots = set()
             if not list_snapshots:
                 snapshots = self._get_snap_name_list(mount)
 
-            output = self._list_subvolumes(mount, list_snapshots)
-            for volume in self._parse_subvolumes(output):
+            # Subvolumes of this file system by their path, so we can find
+            # the parent of a subvolume without scanning all of them
+            by_path = {}
+            for volume in self._get_subvolumes(mount, list_snapshots):
                 new = vol.copy()
                 new.update(volume)
                 new['dev_name'] = "{0}:{1}".format(name, new['path'])
@@ -231,78 +559,89 @@ class Btrfs(template.Backend):
                     new['mount'] = self.mounts[item]['mp']
                     # Subvolume is mounted directly
                     new['direct_mount'] = True
-                else:
+                elif '/' in new['path']:
                     # If subvolume is not mounted try to find whether parent
                     # subvolume is mounted
-                    found = re.findall(r'^(.*)/([^/]*)$', new['path'])
-                    if found:
-                        parent_path, path = found[0]
-                        # try previously loaded subvolumes
-                        for prev_sv in self._subvolumes:
-                            # if subvolumes are mounted, use that mp
-                            if self._subvolumes[prev_sv]['path'] == parent_path:
-                                # if parent subvolume is not mounted this
-                                # subvolume is not mounted as well
-                                if self._subvolumes[prev_sv]['mount'] == '':
-                                    new['mount'] = ''
-                                else:
-                                    new['mount'] = "{0}/{1}".format(
-                                        self._subvolumes[prev_sv]['mount'],
-                                        path)
-                                break
-                    # if parent volume is not mounted, use root subvolume
-                    # if mounted
-                    else:
-                        if 'mount' in vol:
-                            new['mount'] = "{0}/{1}".format(vol['mount'],
-                                                            new['path'])
+                    parent_path, path = new['path'].rsplit('/', 1)
+                    # try previously loaded subvolumes
+                    parent = by_path.get(parent_path)
+                    if parent is not None:
+                        # if parent subvolume is not mounted this
+                        # subvolume is not mounted as well
+                        if not parent.get('mount'):
+                            new['mount'] = ''
+                        else:
+                            new['mount'] = "{0}/{1}".format(parent['mount'],
+                                                            path)
+                # if parent volume is not mounted, use root subvolume
+                # if mounted
+                elif 'mount' in vol:
+                    new['mount'] = "{0}/{1}".format(vol['mount'], new['path'])
 
                 new['hide'] = False
                 # Store snapshot info
                 if 'mount' in new and \
-                    re.match(r"snap-\d{4}-\d{2}-\d{2}-T\d{6}",
-                             os.path.basename(new['mount'])):
+                   SNAP_NAME_RE.match(os.path.basename(new['mount'])):
                     new['snap_name'] = "{0}:{1}".format(name,
                             os.path.basename(new['path']))
                     new['snap_path'] = new['mount']
                 if volume['path'] in snapshots:
                     new['hide'] = True
 
-                self._subvolumes[new['dev_name']] = new
+                by_path.setdefault(new['path'], new)
+                subvolumes[new['dev_name']] = new
+        return subvolumes
 
     def _parse_subvolumes(self, output):
-        volume = {}
         for line in output.strip().split("\n"):
-            if not line:
+            found = SUBVOLUME_LINE_RE.search(line)
+            if not found:
                 continue
-            # For the version with screwed 'subvolume list' command
-            line = re.sub("<FS_TREE>/*", "", line)
-            volume['ID'] = re.search(r'(?<=ID )\d+', line).group(0)
-            volume['top_level'] = re.search(r'(?<=top level )\d+', line).group(0)
-            volume['path'] = re.search('(?<=path ).*$', line).group(0)
-            volume['subvolume'] = True
-            yield volume
+            yield {'ID': found.group(1), 'top_level': found.group(2),
+                   'path': found.group(3), 'subvolume': True}
 
-    def _find_uniq_pool_name(self, label, dev):
-        if len(label) < 3 or label == "none":
-            label = "btrfs_{0}".format(os.path.basename(dev))
-        if label not in self._pool:
-            return label
-        return os.path.basename(dev)
+BTRFS_MODEL = BtrfsModel()
+misc.register_cache(BTRFS_MODEL.invalidate)
 
-    def _store_data(self, vol, pool, fs_used, fs_size, pool_size, pool_name):
-        vol['fs_type'] = 'btrfs'
-        vol['fs_used'] = pool['pool_used'] = str(fs_used)
-        vol['fs_free'] = str(fs_size - fs_used)
-        vol['fs_size'] = vol['vol_size'] = str(fs_size)
-        pool['pool_free'] = str(pool_size - fs_used)
-        pool['pool_size'] = pool_size
-        pool['pool_name'] = vol['pool_name'] = vol['dev_name'] = pool_name
-        pool['type'] = 'btrfs'
-        vol['type'] = 'btrfs'
 
-        self._pool[pool['pool_name']] = pool
-        self._vol[vol['dev_name']] = vol
+class Btrfs(template.Backend):
+
+    def __init__(self, *args, **kwargs):
+        super(Btrfs, self).__init__(*args, **kwargs)
+        self.type = 'btrfs'
+        self.default_pool_name = SSM_BTRFS_DEFAULT_POOL
+        self._vol = {}
+        self._pool = {}
+        self._dev = {}
+        self._snap = {}
+        self._subvolumes = {}
+        self._binary = misc.check_binary('btrfs')
+
+        if not self._binary:
+            return
+
+        BTRFS_MODEL.load()
+        self.mounts = BTRFS_MODEL.mounts
+        self.output = BTRFS_MODEL.output
+        self._vol = template.copy_rows(BTRFS_MODEL.vol)
+        self._pool = template.copy_rows(BTRFS_MODEL.pool)
+        self._dev = template.copy_rows(BTRFS_MODEL.dev)
+
+    def run_btrfs(self, command):
+        if not self._binary:
+            self.problem.check(self.problem.TOOL_MISSING, 'btrfs')
+        command.insert(0, "btrfs")
+        try:
+            return misc.run(command, stdout=True)
+        finally:
+            misc.invalidate_caches()
+
+    def _fill_subvolumes(self, list_snapshots=False):
+        if not self._binary:
+            return
+        if self._subvolumes:
+            return
+        self._subvolumes = template.copy_rows(BTRFS_MODEL.subvolumes(list_snapshots))
 
     def _remove_filesystem(self, name):
         if 'mount' in self._vol[name]:
@@ -489,6 +828,7 @@ class BtrfsPool(Btrfs, template.BackendPool):
             command.extend(['--force'])
         command.extend(devs)
         misc.run(command, stdout=True)
+        misc.invalidate_caches()
         misc.udev_checkpoint(devs)
         return name
 
@@ -599,7 +939,6 @@ class BtrfsPool(Btrfs, template.BackendPool):
             tmp = misc.temp_mount("UUID={0}".format(pool['uuid']))
             pool['mount'] = tmp
 
-        dev = BtrfsDev(options=self.options).data
         command = ['replace', 'start']
         if self.options.force:
             command.extend(['-f'])
@@ -617,7 +956,7 @@ class BtrfsSnap(Btrfs):
 
         self._fill_subvolumes(list_snapshots=True)
         for (name, vol) in self._subvolumes.items():
-            if BTRFS_VERSION < 0.20:
+            if btrfs_version() < 0.20:
                 if 'snap_name' in vol:
                     self._snap[vol['snap_name']] = vol.copy()
                     self._snap[vol['snap_name']]['hide'] = False
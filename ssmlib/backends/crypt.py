@@ -15,12 +15,12 @@
 
 # crypt module for System Storage Manager
 
-import re
 import os
 import stat
 import tempfile
 from ssmlib import misc
 from ssmlib import problem
+from ssmlib.backends import dm
 from ssmlib.backends import template
 
 __all__ = ["DmCryptVolume"]
@@ -53,11 +53,22 @@ def get_cryptsetup_version():
     try:
         output = misc.run(['cryptsetup', '--version'], can_fail=True)[1]
         version = list(map(int, output.strip().split()[-1].split('.', 3)))
-    except (OSError, AttributeError):
+    except (OSError, AttributeError, IndexError, ValueError):
         version = [0, 0, 0]
     return version
 
-CRYPTSETUP_VERSION = get_cryptsetup_version()
+# Detected on the first use by cryptsetup_version()
+CRYPTSETUP_VERSION = None
+
+
+def cryptsetup_version():
+    global CRYPTSETUP_VERSION
+    with misc.TOOL_VERSION_LOCK:
+        if CRYPTSETUP_VERSION is None:
+            CRYPTSETUP_VERSION = misc.get_tool_version('cryptsetup',
+                                                       get_cryptsetup_version,
+                                                       [0, 0, 0])
+    return CRYPTSETUP_VERSION
 
 
 class DmObject(template.Backend):
@@ -75,10 +86,13 @@ class DmObject(template.Backend):
         if not misc.check_binary('cryptsetup'):
             self.problem.check(self.problem.TOOL_MISSING, 'cryptsetup')
         command.insert(0, "cryptsetup")
-        if password != None:
-            return misc.run(command, stdout=stdout, stdin_data=password)
-        else:
-            return misc.run(command, stdout=stdout)
+        try:
+            if password != None:
+                return misc.run(command, stdout=stdout, stdin_data=password)
+            else:
+                return misc.run(command, stdout=stdout)
+        finally:
+            misc.invalidate_caches()
 
 
 class DmCryptPool(DmObject, template.BackendPool):
@@ -111,7 +125,7 @@ class DmCryptPool(DmObject, template.BackendPool):
 
     def create(self, pool, size=None, name=None, devs=None,
                options=None):
-        if CRYPTSETUP_VERSION < [1, 6, 0]:
+        if cryptsetup_version() < [1, 6, 0]:
             msg = "You need at least cryptsetup version " + \
                   "{0}. Creating encrypted volumes".format('1.6.0')
             self.problem.check(self.problem.NOT_SUPPORTED, msg)
@@ -176,36 +190,48 @@ class DmCryptVolume(DmObject, template.BackendVolume):
     def __init__(self, *args, **kwargs):
         super(DmCryptVolume, self).__init__(*args, **kwargs)
 
-        command = ['dmsetup', 'table']
-        self.output = misc.run(command, stderr=False)[1]
-        for line in self.output.split("\n"):
-            if not line or line == "No devices found":
-                break
-            dm = {}
-            array = line.split()
-            if len(array) == 1:
+        for device in sorted(dm.get_devices().values(),
+                             key=lambda device: device['name']):
+            # Volumes of other subsystems are not interesting
+            if device['subsystem'] not in [None, '', 'CRYPT']:
                 continue
-            dm['type'] = array[3]
-            if dm['type'] != 'crypt':
+            table = dm.get_table(device['name'])
+            if table is None:
+                # The table is not known, but cryptsetup can still tell
+                if device['subsystem'] != 'CRYPT':
+                    continue
+                table = [{'type': 'crypt', 'params': '',
+                          'length': device['size'] * 2}]
+            targets = [target for target in table
+                       if target['type'] == 'crypt']
+            if not targets:
                 continue
-            dm['vol_size'] = str(int(array[2]) / 2.0)
-            devname = re.sub(":$", "",
-                             "{0}/mapper/{1}".format(DM_DEV_DIR, array[0]))
-            dm['dm_name'] = devname
-            dm['pool_name'] = self.default_pool_name
-            dm['dev_name'] = devname
-            dm['real_dev'] = misc.get_real_device(devname)
-            if dm['real_dev'] in self.mounts:
-                dm['mount'] = self.mounts[dm['real_dev']]['mp']
+            vol = {}
+            vol['type'] = 'crypt'
+            vol['vol_size'] = str(targets[-1]['length'] / 2.0)
+            devname = "{0}/mapper/{1}".format(DM_DEV_DIR, device['name'])
+            vol['dm_name'] = devname
+            vol['pool_name'] = self.default_pool_name
+            vol['dev_name'] = devname
+            vol['real_dev'] = misc.get_real_device(devname)
+            if vol['real_dev'] in self.mounts:
+                vol['mount'] = self.mounts[vol['real_dev']]['mp']
 
             # Check if the device really exists in the system. In some cases
             # (tests) DM_DEV_DIR can lie to us, if that is the case, simple
             # ignore the device.
             if not os.path.exists(devname):
                 continue
-            command = ['cryptsetup', 'status', devname]
-            self._parse_cryptsetup(command, dm)
-            self.data[dm['dev_name']] = dm
+            params = dm.crypt_params(targets[-1]['params'])
+            if params:
+                vol['cipher'] = params['cipher']
+                vol['keysize'] = params['keysize']
+                vol['crypt_device'] = dm.find_device_name(params['device']) \
+                    or params['device']
+            else:
+                command = ['cryptsetup', 'status', devname]
+                self._parse_cryptsetup(command, vol)
+            self.data[vol['dev_name']] = vol
 
     def _parse_cryptsetup(self, cmd, dm):
         self.output = misc.run(cmd, stderr=False)[1]
@@ -233,6 +259,11 @@ class DmCryptVolume(DmObject, template.BackendVolume):
             return self.data[device]
         return None
 
+    def aliases(self, key):
+        dm = self.data[key]
+        return template.device_aliases([key, dm['dm_name'], dm['real_dev']],
+                                       DM_DEV_DIR)
+
     def remove(self, dm):
         vol = self[dm]
         if 'mount' in vol:
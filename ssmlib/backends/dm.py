@@ -0,0 +1,350 @@
+# (C)2012 Red Hat, Inc., Lukas Czerner <lczerner@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# device-mapper queries shared by the System Storage Manager backends
+
+import os
+import fcntl
+import struct
+import threading
+from ssmlib import misc
+from ssmlib import problem
+
+# Device mapper devices are described by the kernel in <DM_SYSFS>/dm-X/dm
+DM_SYSFS = "/sys/block"
+DM_CONTROL = "/dev/mapper/control"
+
+# Prefixes of the device uuid which tell what subsystem created the device
+DM_SUBSYSTEMS = ['CRYPT', 'LVM', 'mpath']
+
+# struct dm_ioctl and struct dm_target_spec from <linux/dm-ioctl.h>
+DM_IOCTL = struct.Struct("=3L3Li3LQ128s129s7s")
+DM_TARGET_SPEC = struct.Struct("=QQiL16s")
+DM_NAME_LIST = struct.Struct("=QL")
+DM_VERSION = (4, 0, 0)
+DM_LIST_DEVICES = 0xC138FD02
+DM_TABLE_STATUS = 0xC138FD0C
+DM_STATUS_TABLE_FLAG = 1 << 4
+DM_BUFFER_FULL_FLAG = 1 << 8
+
+
+def _cstring(data):
+    return misc.__str__(bytes(data).split(b"\0", 1)[0])
+
+
+def _dm_ioctl(fd, request, name="", flags=0):
+    """
+    Issue the device mapper ioctl and return its header fields together
+    with the whole buffer. The buffer grows until the result fits.
+    """
+    size = 16384
+    while True:
+        buf = bytearray(size)
+        DM_IOCTL.pack_into(buf, 0, DM_VERSION[0], DM_VERSION[1],
+                           DM_VERSION[2], size, DM_IOCTL.size, 0, 0, flags,
+                           0, 0, 0, name.encode(), b"", b"")
+        fcntl.ioctl(fd, request, buf, True)
+        header = DM_IOCTL.unpack_from(buf)
+        if not header[7] & DM_BUFFER_FULL_FLAG:
+            return header, buf
+        size *= 4
+
+
+def list_devices(fd):
+    """
+    Return names of all device mapper devices the kernel knows about
+    with their "major:minor" numbers using the DM_LIST_DEVICES ioctl.
+    """
+    header, buf = _dm_ioctl(fd, DM_LIST_DEVICES)
+    devices = {}
+    pos = header[4]
+    while pos < header[3]:
+        dev, offset = DM_NAME_LIST.unpack_from(buf, pos)
+        name = _cstring(buf[pos + DM_NAME_LIST.size:])
+        # Empty list is reported as a single entry without a device
+        if not dev and not name:
+            break
+        devices[name] = "{0}:{1}".format(os.major(dev), os.minor(dev))
+        if not offset:
+            break
+        pos += offset
+    return devices
+
+
+def table_status(fd, name):
+    """
+    Return the table of the device mapper device name using the
+    DM_TABLE_STATUS ioctl, see parse_table_line().
+    """
+    header, buf = _dm_ioctl(fd, DM_TABLE_STATUS, name, DM_STATUS_TABLE_FLAG)
+    targets = []
+    start = pos = header[4]
+    for i in range(header[5]):
+        sector, length, status, offset, target = \
+            DM_TARGET_SPEC.unpack_from(buf, pos)
+        params = _cstring(buf[pos + DM_TARGET_SPEC.size:])
+        targets.append(_target(sector, length, _cstring(target), params))
+        pos = start + offset
+    return targets
+
+
+def _target(start, length, target, params):
+    # Never keep the encryption key around, only its size is interesting
+    if target == 'crypt':
+        array = params.split()
+        if len(array) > 1 and not array[1].startswith(":"):
+            array[1] = "0" * len(array[1])
+            params = " ".join(array)
+    return {'start': int(start),
+            'length': int(length),
+            'type': target,
+            'params': params}
+
+
+def parse_table_line(line):
+    """
+    Parse a line of 'dmsetup table' output into the name of the device and
+    the target which is a dictionary with 'start', 'length' of the target in
+    512 byte sectors, the target 'type' and its 'params'.
+    Return None if it does not describe a target.
+    """
+    array = line.split(None, 4)
+    if len(array) < 4 or not array[0].endswith(":"):
+        return None
+    try:
+        return array[0][:-1], _target(array[1], array[2], array[3],
+                                      array[4] if len(array) > 4 else "")
+    except ValueError:
+        return None
+
+
+def crypt_params(params):
+    """
+    Return the 'cipher', the 'keysize' in bits and the underlying 'device'
+    of the crypt target parameters. The device is either the path, or the
+    "major:minor" number of the device.
+    """
+    array = params.split()
+    if len(array) < 4:
+        return {}
+    key = array[1]
+    if key.startswith(":"):
+        # Key in the kernel keyring as :<size in bytes>:<type>:<description>
+        try:
+            keysize = int(key.split(":")[1]) * 8
+        except ValueError:
+            return {}
+    else:
+        keysize = len(key) * 4
+    return {'cipher': array[0],
+            'keysize': str(keysize),
+            'device': array[3]}
+
+
+class DmModel(object):
+    """
+    Information about all device mapper devices in the system. The devices
+    are known from the shared snapshot of the block devices and described
+    by sysfs, their tables are read all at once on the first use. The data
+    are shared by the backends until the storage configuration changes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        with self.lock:
+            self._devices = None
+            self._index = None
+            self._names = None
+            self._tables = None
+
+    def devices(self):
+        """
+        Return a dictionary of device mapper devices keyed by the device
+        name. Each device has its 'name', the 'dm_name' in /dev/mapper (or
+        the real device when the name is not known), the
+        'real_dev', 'devnum', 'size' in KiB, the 'uuid' and the 'subsystem'
+        which created it, and the list of its 'slaves'. The uuid and the
+        subsystem is None when it is not known.
+        """
+        with self.lock:
+            self._load_devices()
+            return self._devices
+
+    def _load_devices(self):
+        if self._devices is not None:
+            return
+        self._devices = self._read_devices()
+        # Devices can be looked for by any of their names
+        self._index = {}
+        for device in self._devices.values():
+            for key in ['real_dev', 'dm_name', 'devnum', 'name']:
+                self._index[device[key]] = device
+
+    def complete(self):
+        """
+        Return True if the device mapper driver is loaded and every device
+        is described, so that the devices do not need to be looked for by
+        other means.
+        """
+        if misc.get_dmnumber('device-mapper') is None:
+            return False
+        for device in self.devices().values():
+            if device['uuid'] is None:
+                return False
+        return True
+
+    def tables(self):
+        """
+        Return a dictionary of tables of all device mapper devices keyed by
+        the device name, see parse_table_line().
+        """
+        with self.lock:
+            if self._tables is None:
+                self._tables = self._read_tables()
+            return self._tables
+
+    def get_device(self, devname):
+        """
+        Find the device mapper device by its name, by the /dev/mapper path,
+        by the real device or by its "major:minor" number.
+        """
+        with self.lock:
+            self._load_devices()
+            return self._index.get(devname)
+
+    def find_device_name(self, devnum):
+        """
+        Return the name of any block device with the "major:minor" number.
+        """
+        with self.lock:
+            if self._names is None:
+                self._names = {}
+                for line in misc.get_partitions():
+                    key = "{0}:{1}".format(line[0], line[1])
+                    self._names.setdefault(key, line[4])
+            return self._names.get(devnum)
+
+    def _read_devices(self):
+        devices = {}
+        dmnumber = misc.get_dmnumber('device-mapper')
+        if dmnumber is None:
+            return devices
+        real_devs = {}
+        for line in misc.get_partitions():
+            if str(line[0]) != str(dmnumber):
+                continue
+            if line[3] in real_devs:
+                device = real_devs[line[3]]
+            else:
+                device = self._read_device(line)
+                real_devs[line[3]] = device
+                devices[device['name']] = device
+            # There is a row for each parent of the device
+            if len(line) > 5 and line[5] not in device['slaves']:
+                device['slaves'].append(line[5])
+        return devices
+
+    def _read_device(self, line):
+        sysfs = os.path.join(DM_SYSFS, os.path.basename(line[3]), "dm")
+        name = None
+        if line[4].startswith("/dev/mapper/"):
+            name = line[4][len("/dev/mapper/"):]
+        try:
+            if name is None:
+                name = self._read_sysfs_value(sysfs, "name")
+            uuid = self._read_sysfs_value(sysfs, "uuid")
+        except (IOError, OSError):
+            uuid = None
+        dm_name = line[3]
+        if name is None:
+            name = os.path.basename(line[3])
+        else:
+            dm_name = "/dev/mapper/{0}".format(name)
+
+        subsystem = None
+        if uuid is not None:
+            subsystem = uuid.split("-", 1)[0]
+            if subsystem not in DM_SUBSYSTEMS:
+                subsystem = ""
+        return {'name': name,
+                'dm_name': dm_name,
+                'real_dev': line[3],
+                'devnum': "{0}:{1}".format(line[0], line[1]),
+                'size': int(line[2]),
+                'uuid': uuid,
+                'subsystem': subsystem,
+                'slaves': []}
+
+    @staticmethod
+    def _read_sysfs_value(*path):
+        with open(os.path.join(*path), 'r') as f:
+            return f.read().strip()
+
+    def _read_tables(self):
+        try:
+            fd = os.open(DM_CONTROL, os.O_RDWR)
+        except OSError:
+            return self._read_dmsetup_tables()
+        try:
+            return dict((name, table_status(fd, name))
+                        for name in list_devices(fd))
+        except (IOError, OSError, struct.error):
+            return self._read_dmsetup_tables()
+        finally:
+            os.close(fd)
+
+    def _read_dmsetup_tables(self):
+        tables = {}
+        if not misc.check_binary('dmsetup'):
+            return tables
+        try:
+            output = misc.run(['dmsetup', 'table'], stderr=False,
+                              can_fail=True)[1]
+        except (problem.CommandFailed, OSError):
+            return tables
+        for line in (output or "").split("\n"):
+            target = parse_table_line(line)
+            if target:
+                tables.setdefault(target[0], []).append(target[1])
+        return tables
+
+
+DM_MODEL = DmModel()
+misc.register_cache(DM_MODEL.invalidate)
+
+
+def get_devices():
+    return DM_MODEL.devices()
+
+
+def get_device(devname):
+    return DM_MODEL.get_device(devname)
+
+
+def get_table(name):
+    """ Return the table of the device, or None if it is not known. """
+    return DM_MODEL.tables().get(name)
+
+
+def devices_complete():
+    return DM_MODEL.complete()
+
+
+def find_device_name(devnum):
+    """ Return the name of the block device with the "major:minor" number. """
+    return DM_MODEL.find_device_name(devnum)
@@ -17,10 +17,18 @@
 
 import re
 import os
+import sys
+import json
 import stat
+import atexit
+import select
 import datetime
+import threading
+import subprocess
+from collections import OrderedDict
 from ssmlib import misc
 from ssmlib import problem
+from ssmlib.backends import dm
 from ssmlib.backends import template
 
 __all__ = ["PvsInfo", "VgsInfo", "LvsInfo", "ThinPool"]
@@ -36,6 +44,27 @@ except KeyError:
     DM_DEV_DIR = "/dev"
 MAX_LVS = 999
 
+# Run lvm commands through a single persistent lvm shell instead of
+# spawning a new lvm process for every command.
+try:
+    SSM_LVM_SHELL = os.environ['SSM_LVM_SHELL']
+    if SSM_LVM_SHELL.upper() in ['NO', 'FALSE', '0']:
+        SSM_LVM_SHELL = False
+    else:
+        SSM_LVM_SHELL = True
+except KeyError:
+    SSM_LVM_SHELL = True
+
+LVM_SHELL_PROMPT = b"lvm> "
+# How long to wait for the lvm shell to come up before giving up on it
+LVM_SHELL_TIMEOUT = 10
+# How long to wait for a command in the lvm shell to finish
+LVM_SHELL_COMMAND_TIMEOUT = 300
+# Only the read-only reporting commands are run in the lvm shell. Commands
+# changing the storage may ask the user for confirmation, or run other
+# tools such as fsadm, which needs the terminal rather than the pipe.
+LVM_SHELL_COMMANDS = ['lvs', 'vgs', 'pvs', 'fullreport']
+
 # TODO: This is ugly and needs to be removed and done properly
 THIN_POOL_DATA = {}
 
@@ -55,7 +84,423 @@ def get_lvm_version():
         version = [0, 0, 0]
     return version
 
-LVM_VERSION = get_lvm_version()
+# Detected on the first use by lvm_version()
+LVM_VERSION = None
+
+
+def lvm_version():
+    global LVM_VERSION
+    with misc.TOOL_VERSION_LOCK:
+        if LVM_VERSION is None:
+            LVM_VERSION = misc.get_tool_version('lvm', get_lvm_version,
+                                                [0, 0, 0])
+    return LVM_VERSION
+
+
+class LvmShell(object):
+    """
+    Persistent lvm shell co-process.
+
+    lvm is started only once per ssm invocation and the reporting commands
+    (see LVM_SHELL_COMMANDS) are fed to it through its standard input.
+    Reports and the command status are written by lvm in json format into
+    the pipe given by LVM_REPORT_FD. Whenever the shell can not be used,
+    run() returns None and the caller is expected to spawn the command the
+    usual way.
+    """
+
+    def __init__(self):
+        self.proc = None
+        self.report_fd = None
+        self.usable = True
+        self.lock = threading.Lock()
+
+    def _start(self):
+        report_r, report_w = os.pipe()
+        env = dict(os.environ)
+        env['LVM_REPORT_FD'] = str(report_w)
+        env['LC_ALL'] = "C"
+        if sys.version < '3':
+            fds = {'close_fds': False}
+        else:
+            fds = {'close_fds': True, 'pass_fds': (report_w,)}
+        start = misc.profile_start()
+        try:
+            self.proc = subprocess.Popen(['lvm'], stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         env=env, **fds)
+        except OSError:
+            os.close(report_r)
+            os.close(report_w)
+            return False
+        os.close(report_w)
+        self.report_fd = report_r
+        try:
+            self._read_until_prompt(LVM_SHELL_TIMEOUT)
+        except (IOError, OSError):
+            self.close()
+            return False
+        if start is not None:
+            # The shell did not consume any cpu time before it was started
+            misc.profile_command(['lvm'], (start[0], 0.0), 0, 0,
+                                 self.proc.pid)
+        atexit.register(self.close)
+        return True
+
+    def close(self, kill=False):
+        if self.proc is None:
+            return
+        try:
+            if kill:
+                self.proc.kill()
+            self.proc.stdin.close()
+            self.proc.wait()
+        except (IOError, OSError):
+            pass
+        for stream in [self.proc.stdout, self.proc.stderr]:
+            stream.close()
+        os.close(self.report_fd)
+        self.proc = None
+        self.report_fd = None
+
+    def _read_until_prompt(self, timeout=None):
+        if timeout is None:
+            timeout = LVM_SHELL_COMMAND_TIMEOUT
+        out = err = report = b""
+        fds = [self.proc.stdout.fileno(), self.proc.stderr.fileno(),
+               self.report_fd]
+        while not out.endswith(LVM_SHELL_PROMPT):
+            ready = select.select(fds, [], [], timeout)[0]
+            if not ready:
+                raise IOError("lvm shell is not responding")
+            for fd in ready:
+                data = os.read(fd, 65536)
+                if not data:
+                    raise IOError("lvm shell exited unexpectedly")
+                if fd == fds[0]:
+                    out += data
+                elif fd == fds[1]:
+                    err += data
+                else:
+                    report += data
+        # The prompt is printed after the command finished, so whatever
+        # is left in the other pipes is already there.
+        fds = fds[1:]
+        while fds:
+            ready = select.select(fds, [], [], 0)[0]
+            if not ready:
+                break
+            for fd in ready:
+                data = os.read(fd, 65536)
+                if not data:
+                    fds.remove(fd)
+                elif fd == self.report_fd:
+                    report += data
+                else:
+                    err += data
+        out = out[:-len(LVM_SHELL_PROMPT)]
+        return (misc.__str__(out), misc.__str__(err), misc.__str__(report))
+
+    @staticmethod
+    def _parse_json(text):
+        decoder = json.JSONDecoder(object_pairs_hook=OrderedDict)
+        docs = []
+        index = text.find("{")
+        while index >= 0:
+            try:
+                doc, index = decoder.raw_decode(text, index)
+                docs.append(doc)
+            except ValueError:
+                index += 1
+            index = text.find("{", index)
+        return docs
+
+    def _quote(self, arg):
+        if not arg or len(arg.split()) > 1:
+            return '"{0}"'.format(arg)
+        return arg
+
+    def run(self, cmd, stdout=False, can_fail=False, **kwargs):
+        """
+        Run lvm command (including the leading 'lvm') in the lvm shell and
+        return the same (returncode, output, error) triple as misc.run()
+        does. Reports are returned in the '|' separated form reporting
+        commands produce with '--separator |'.
+        """
+        if len(cmd) < 2 or cmd[1] not in LVM_SHELL_COMMANDS:
+            return None
+        with self.lock:
+            if not self.usable:
+                return None
+            if self.proc is None and not self._start():
+                self.usable = False
+                return None
+
+            for i, item in enumerate(cmd):
+                if not isinstance(item, str):
+                    cmd[i] = str(item)
+            if misc.VERBOSE_VV_FLAG:
+                print('executing command: {}'.format(' '.join(cmd)))
+
+            args = cmd[1:2] + ['--config',
+                               'report/output_format=json ' +
+                               'log/report_command_log=1'] + cmd[2:]
+            line = " ".join([self._quote(arg) for arg in args]) + "\n"
+            pid = self.proc.pid
+            start = misc.profile_start(pid)
+            try:
+                self.proc.stdin.write(line.encode())
+                self.proc.stdin.flush()
+                output, error, report = self._read_until_prompt()
+            except (IOError, OSError):
+                # The shell died or got stuck. The command does not change
+                # anything, so it is safe to run it again the usual way.
+                self.usable = False
+                self.close(kill=True)
+                return None
+
+        # Strip the command line if the shell echoes it back
+        if output.startswith(line):
+            output = output[len(line):]
+
+        # Caller asked for json report, give it as it is
+        if '--reportformat' in cmd and report:
+            output = report
+
+        ret = 0
+        rows = None
+        for doc in self._parse_json(report) + self._parse_json(output):
+            for item in doc.get('log', []):
+                if item.get('log_type') == 'status' and \
+                   item.get('log_ret_code') not in ['1', 1]:
+                    ret = int(item['log_ret_code'])
+                # Error messages are logged into the report as well
+                elif item.get('log_type') == 'error' and \
+                        item.get('log_message'):
+                    error += "  " + item['log_message'] + "\n"
+            for section in doc.get('report', []):
+                rows = rows or []
+                for objects in section.values():
+                    rows.extend(["|".join(map(str, obj.values()))
+                                 for obj in objects])
+        if rows is not None and '--reportformat' not in cmd:
+            output = "".join([row + "\n" for row in rows])
+
+        misc.profile_command(cmd, start, ret,
+                             len(output) + len(error) + len(report), pid)
+
+        if stdout:
+            if output:
+                sys.stdout.write(output)
+            if error:
+                sys.stderr.write(error)
+
+        if ret != 0 and not can_fail:
+            err_msg = "ERROR exit code {0} for running command: \"{1}\"".format(
+                      ret, " ".join(cmd))
+            if not stdout:
+                print(output)
+                print(error)
+            raise problem.CommandFailed(err_msg, exitcode=ret)
+
+        if misc.VERBOSE_VVV_FLAG:
+            msg = "Exit: {}".format(ret)
+            if error:
+                msg += ", Error: {}".format(error)
+            if output:
+                msg += "\nOutput: {}".format(output)
+            print(msg)
+
+        return (ret, output, error)
+
+LVM_SHELL = LvmShell()
+
+
+def run_lvm_command(command, **kwargs):
+    """
+    Run lvm reporting command through the persistent lvm shell if possible
+    and fall back to running it as a separate process. Any other command is
+    always run as a separate process. Arguments are the same as for
+    misc.run().
+    """
+    if SSM_LVM_SHELL:
+        result = LVM_SHELL.run(command, **kwargs)
+        if result is not None:
+            return result
+    return misc.run(command, **kwargs)
+
+
+# Columns gathered for volume groups, physical volumes and logical volumes.
+# Backends map their attributes onto these, so the order matters.
+LVM_COLUMNS = {
+    'vg': ['vg_name', 'pv_count', 'vg_size', 'vg_free', 'lv_count'],
+    'pv': ['pv_name', 'vg_name', 'pv_free', 'pv_used', 'pv_size'],
+    'lv': ['vg_name', 'lv_size', 'stripes', 'stripesize', 'segtype',
+           'lv_name', 'origin', 'lv_attr', 'pool_lv', 'snap_percent',
+           'pv_count', 'thin_count', 'data_percent', 'metadata_percent']}
+LVM_REPORT_COMMANDS = {'vg': 'vgs', 'pv': 'pvs', 'lv': 'lvs'}
+# Logical volume columns which describe its segments
+LVM_SEG_COLUMNS = ['stripes', 'stripesize', 'segtype']
+# Keys of the columns in the json report which differ from the column name
+LVM_JSON_KEYS = {'stripesize': 'stripe_size'}
+
+# Columns which are expensive for lvm to gather, as it has to ask the
+# device mapper about every volume, and the information they provide,
+# see Options.needs()
+LVM_EXPENSIVE_COLUMNS = {
+    'snap_percent': 'snap_usage',
+    'data_percent': 'thin_usage',
+    'metadata_percent': 'thin_usage'}
+
+
+def skipped_columns(options):
+    """ Return set of the expensive columns nobody is going to print """
+    needs = getattr(options, 'needs', None)
+    if needs is None:
+        return frozenset()
+    return frozenset([column for (column, probe)
+                      in LVM_EXPENSIVE_COLUMNS.items() if not needs(probe)])
+
+
+class LvmReport(object):
+    """
+    Information about all volume groups, physical and logical volumes in
+    the system. It is gathered only once, preferably by a single 'lvm
+    fullreport' call, and shared by all the lvm backends until the
+    storage configuration changes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reports = None
+        self.skipped = frozenset()
+
+    def invalidate(self):
+        with self.lock:
+            self.reports = None
+
+    def get(self, name, skipped=frozenset()):
+        """
+        Return list of rows for the given report ('vg', 'pv' or 'lv'). Each
+        row is a list of values in order given by LVM_COLUMNS. The columns
+        in skipped do not need to be gathered and their value is empty.
+        """
+        with self.lock:
+            # Some of the columns left out before are needed now
+            if self.reports is not None and not self.skipped <= skipped:
+                self.reports = None
+            if self.reports is None:
+                self.skipped = frozenset(skipped)
+                self.reports = self._full_report() or {}
+            if name not in self.reports:
+                self.reports[name] = self._report(name)
+            return self.reports[name]
+
+    def _columns(self, name):
+        return [column for column in LVM_COLUMNS[name]
+                if column not in self.skipped]
+
+    def _fill_skipped(self, name, values):
+        """ Put empty values of the skipped columns into the row """
+        row = []
+        values = iter(values)
+        for column in LVM_COLUMNS[name]:
+            if column in self.skipped:
+                row.append("")
+                continue
+            try:
+                row.append(next(values))
+            except StopIteration:
+                break
+        return row
+
+    def _check_result(self, command, ret, err):
+        # A workaround for LVM behaviour:
+        # lvm lvs' exit code is 5 on exported volumes, even if everything
+        # is ok. So, if the code is 5, command was 'lvm lvs ...'
+        # and error message says that a volume was exported, ignore the
+        # error
+        if ret == 0:
+            return True
+        if ret == 5 and command[1] in ['lvs', 'fullreport'] and \
+           str(err).endswith('is exported\n'):
+            return True
+        return False
+
+    def _report(self, name):
+        command = ["lvm", LVM_REPORT_COMMANDS[name], "--separator", "|",
+                   "--noheadings", "--nosuffix", "--units", "k", "-o",
+                   ",".join(self._columns(name))]
+        ret, output, err = run_lvm_command(command, stderr=False,
+                                           can_fail=True)
+        if not self._check_result(command, ret, err):
+            if err is not None:
+                print(err)
+            err_msg = "ERROR exit code {0} for running command: \"{1}\"".format(
+                      ret, " ".join(command))
+            raise problem.CommandFailed(err_msg, exitcode=ret)
+
+        rows = []
+        for line in output.split("\n"):
+            if not line:
+                break
+            rows.append(self._fill_skipped(
+                name, [value.lstrip() for value in line.split("|")]))
+        return rows
+
+    def _full_report(self):
+        # Both 'fullreport' and json output are available since 2.02.158
+        if lvm_version() < [2, 2, 158]:
+            return None
+        lv_columns = [column for column in self._columns('lv')
+                      if column not in LVM_SEG_COLUMNS]
+        seg_columns = [column for column in self._columns('lv')
+                       if column in LVM_SEG_COLUMNS]
+        command = ["lvm", "fullreport", "--reportformat", "json",
+                   "--nosuffix", "--units", "k"]
+        for name in ['vg', 'pv']:
+            command.extend(["--configreport", name, "-o",
+                            ",".join(self._columns(name))])
+        # Segment columns are only available in the segment report, it is
+        # joined with the logical volumes by their uuid
+        command.extend(["--configreport", "lv", "-o",
+                        ",".join(lv_columns + ['lv_uuid']),
+                        "--configreport", "seg", "-o",
+                        ",".join(['lv_uuid'] + seg_columns),
+                        "--configreport", "pvseg", "-o", "pvseg_start"])
+        ret, output, err = run_lvm_command(command, stderr=False,
+                                           can_fail=True)
+        if not self._check_result(command, ret, err):
+            return None
+
+        objects = {'vg': [], 'pv': [], 'lv': []}
+        segments = {}
+        for doc in LvmShell._parse_json(output):
+            for section in doc.get('report', []):
+                for name, items in objects.items():
+                    items.extend(section.get(name, []))
+                for seg in section.get('seg', []):
+                    # The volume is described by its first segment
+                    segments.setdefault(seg.get('lv_uuid'), seg)
+
+        reports = {}
+        for name, items in objects.items():
+            rows = reports[name] = []
+            for obj in items:
+                if name == 'lv':
+                    obj = dict(segments.get(obj.get('lv_uuid'), {}), **obj)
+                rows.append(self._fill_skipped(
+                    name, [str(obj.get(LVM_JSON_KEYS.get(column, column), ""))
+                           for column in self._columns(name)]))
+        # Do not show hidden volumes, the same way 'lvs' does not
+        name_index = LVM_COLUMNS['lv'].index('lv_name')
+        reports['lv'] = [row for row in reports['lv']
+                         if not row[name_index].startswith("[")]
+        return reports
+
+LVM_REPORT = LvmReport()
+misc.register_cache(LVM_REPORT.invalidate)
 
 def create_thin_volume(parent_pool, thin_pool, virtsize, lvname):
     pool_volume = parent_pool + '/' + thin_pool
@@ -65,6 +510,7 @@ def create_thin_volume(parent_pool, thin_pool, virtsize, lvname):
                '-V', str(virtsize) + 'K']
     command.insert(0, "lvm")
     misc.run(command, stdout=True)
+    misc.invalidate_caches()
     return "{0}/{1}/{2}".format(DM_DEV_DIR, parent_pool, lvname)
 
 
@@ -99,7 +545,10 @@ class LvmInfo(template.Backend):
         if self.options.verbose:
             command.insert(1, "-v")
         command.insert(0, "lvm")
-        misc.run(command, stdout=True)
+        try:
+            misc.run(command, stdout=True)
+        finally:
+            misc.invalidate_caches()
 
     def _data_index(self, row):
         return row.values()[len(row.values()) - 1]
@@ -107,30 +556,13 @@ class LvmInfo(template.Backend):
     def _skip_data(self, row):
         return False
 
-    def _parse_data(self, command):
+    def _parse_data(self, report):
         if not self.binary:
             return
-        ret, self.output, err = misc.run(command, stderr=False, can_fail=True)
-        # A workaround for LVM behaviour:
-        # lvm lvs' exit code is 5 on exported volumes, even if everything
-        # is ok. So, if the code is 5, command was 'lvm lvs ...'
-        # and error message says that a volume was exported, ignore the
-        # error
-        if ret != 0:
-            err_msg = "ERROR exit code {0} for running command: \"{1}\"".format(
-                      ret, " ".join(command))
-            if ret != 5 or command[0:2] != ['lvm', 'lvs'] or \
-               not str(err).endswith('is exported\n'):
-                if err is not None:
-                    print(err)
-                raise problem.CommandFailed(err_msg, exitcode=ret)
-
-        for line in self.output.split("\n"):
-            if not line:
-                break
-            array = line.split("|")
-            row = dict([(self.attrs[index], array[index].lstrip())
-                       for index in range(len(array))])
+        for array in LVM_REPORT.get(report, skipped_columns(self.options)):
+            # Attributes set to None are not interesting for the backend
+            row = dict([(attr, value) for attr, value in zip(self.attrs, array)
+                        if attr is not None])
             if self._skip_data(row):
                 continue
             self._fill_aditional_info(row)
@@ -140,7 +572,7 @@ class LvmInfo(template.Backend):
         pass
 
     def supported_since(self, version, string):
-        if version > LVM_VERSION:
+        if version > lvm_version():
             msg = "ERROR: You need at least lvm version " + \
                   "{0}. Feature \"{1}\"".format(".".join(map(str, version)),
                                                 string)
@@ -160,14 +592,7 @@ class LvmInfo(template.Backend):
         # have it only as an optional dependency for lvm2 and if it is not installed,
         # lvm behaves strangely and can fail without any useful information
         # in middle of a sequence of commands SSM does.
-        found = False
-        for path in os.environ["PATH"].split(os.pathsep):
-            path = path.strip('"')
-            if os.path.isfile(os.path.join(path, 'thin_check')):
-                    found = True
-                    break
-
-        if not found:
+        if not misc.find_binary('thin_check')[0]:
             msg = "ERROR: lvm does not have installed thin provisioning tools. " +\
                   "Some distributions mark it as an optional dependency for lvm2, " +\
                   "in which case, you need to install it manually"
@@ -180,13 +605,10 @@ class VgsInfo(LvmInfo, template.BackendPool):
 
     def __init__(self, *args, **kwargs):
         super(VgsInfo, self).__init__(*args, **kwargs)
-        command = ["lvm", "vgs", "--separator", "|", "--noheadings",
-                   "--nosuffix", "--units", "k", "-o",
-                   "vg_name,pv_count,vg_size,vg_free,lv_count"]
         self.attrs = ['pool_name', 'dev_count', 'pool_size', 'pool_free',
                       'vol_count']
 
-        self._parse_data(command)
+        self._parse_data('vg')
 
     def _fill_aditional_info(self, vg):
         vg['type'] = 'lvm'
@@ -371,13 +793,10 @@ class PvsInfo(LvmInfo, template.BackendDevice):
 
     def __init__(self, *args, **kwargs):
         super(PvsInfo, self).__init__(*args, **kwargs)
-        command = ["lvm", "pvs", "--separator", "|", "--noheadings",
-                   "--nosuffix", "--units", "k", "-o",
-                   "pv_name,vg_name,pv_free,pv_used,pv_size"]
         self.attrs = ['dev_name', 'pool_name', 'dev_free',
                       'dev_used', 'dev_size']
 
-        self._parse_data(command)
+        self._parse_data('pv')
 
     def _data_index(self, row):
         return misc.get_real_device(row['dev_name'])
@@ -403,14 +822,11 @@ class LvsInfo(LvmInfo, template.BackendVolume):
 
     def __init__(self, *args, **kwargs):
         super(LvsInfo, self).__init__(*args, **kwargs)
-        command = ["lvm", "lvs", "--separator", "|", "--noheadings",
-                   "--nosuffix", "--units", "k", "-o",
-                   "vg_name,lv_size,stripes,stripesize,segtype,lv_name,origin,lv_attr,pool_lv"]
         self.attrs = ['pool_name', 'vol_size', 'stripes',
                       'stripesize', 'type', 'lv_name', 'origin', 'attr', 'pool_lv']
         self.handle_fs = True
         self.mounts = misc.get_mounts('{0}/mapper'.format(DM_DEV_DIR))
-        self._parse_data(command)
+        self._parse_data('lv')
 
     def _fill_aditional_info(self, lv):
         lv['dev_name'] = "{0}/{1}/{2}".format(DM_DEV_DIR, lv['pool_name'],
@@ -426,17 +842,14 @@ class LvsInfo(LvmInfo, template.BackendVolume):
 
         lv['real_dev'] = misc.get_real_device(lv['dev_name'])
 
-        sysfile = "/sys/block/{0}/dm/name".format(
-                  os.path.basename(lv['real_dev']))
-
         # In some weird cases the "real" device might not be in /dev/dm-*
-        # form (see tests). In this case constructed sysfile will not exist
-        # so we just use real device name to search mounts.
-        try:
-            with open(sysfile, 'r') as f:
-                lvname = f.readline()[:-1]
-            lv['dm_name'] = "{0}/mapper/{1}".format(DM_DEV_DIR, lvname)
-        except IOError:
+        # form (see tests). In this case it is not a known device mapper
+        # device so we just use real device name to search mounts.
+        device = dm.get_device(lv['real_dev'])
+        if device and device['dm_name'] != device['real_dev']:
+            lv['dm_name'] = "{0}/mapper/{1}".format(DM_DEV_DIR,
+                                                    device['name'])
+        else:
             lv['dm_name'] = lv['real_dev']
 
         if lv['real_dev'] in self.mounts:
@@ -458,6 +871,11 @@ class LvsInfo(LvmInfo, template.BackendVolume):
             return self.data[device]
         return None
 
+    def aliases(self, key):
+        lv = self.data[key]
+        return template.device_aliases([key, lv['dev_name'], lv['dm_name'],
+                                        lv['real_dev']], DM_DEV_DIR)
+
     def _data_index(self, row):
         return row['real_dev']
 
@@ -520,16 +938,12 @@ class SnapInfo(LvmInfo):
 
     def __init__(self, *args, **kwargs):
         super(SnapInfo, self).__init__(*args, **kwargs)
-        command = ["lvm", "lvs", "--separator", "|", "--noheadings",
-                   "--nosuffix", "--units", "k", "-o",
-                   "vg_name,lv_size,stripes,stripesize,segtype," +
-                   "lv_name,origin,snap_percent,lv_attr,pool_lv"]
         self.attrs = ['pool_name', 'vol_size', 'stripes',
                       'stripesize', 'type', 'lv_name', 'origin',
-                      'snap_size', 'attr', 'pool_lv']
+                      'attr', 'pool_lv', 'snap_size']
         self.handle_fs = True
         self.mounts = misc.get_mounts('{0}/mapper'.format(DM_DEV_DIR))
-        self._parse_data(command)
+        self._parse_data('lv')
 
     def _skip_data(self, row):
         if not row['origin']:
@@ -549,11 +963,11 @@ class SnapInfo(LvmInfo):
         if snap['type'] != "thin":
             # It's possible that snap_percent in lvm output is not defined.
             # For example on inactive volume, so just remove it.
-            if snap['snap_size']:
+            if snap.get('snap_size'):
                 size = float(snap['vol_size']) * float(snap['snap_size'])
                 snap['snap_size'] = str(size / 100.00)
             else:
-                del snap['snap_size']
+                snap.pop('snap_size', None)
         else:
             # Show thin-pool as a pool name in case of thin volumes
             snap['parent_pool'] = snap['pool_name']
@@ -561,17 +975,14 @@ class SnapInfo(LvmInfo):
 
         snap['real_dev'] = misc.get_real_device(snap['dev_name'])
 
-        sysfile = "/sys/block/{0}/dm/name".format(
-                  os.path.basename(snap['real_dev']))
-
         # In some weird cases the "real" device might not be in /dev/dm-*
-        # form (see tests). In this case constructed sysfile will not exist
-        # so we just use real device name to search mounts.
-        try:
-            with open(sysfile, 'r') as f:
-                lvname = f.readline()[:-1]
-            snap['dm_name'] = "{0}/mapper/{1}".format(DM_DEV_DIR, lvname)
-        except IOError:
+        # form (see tests). In this case it is not a known device mapper
+        # device so we just use real device name to search mounts.
+        device = dm.get_device(snap['real_dev'])
+        if device and device['dm_name'] != device['real_dev']:
+            snap['dm_name'] = "{0}/mapper/{1}".format(DM_DEV_DIR,
+                                                    device['name'])
+        else:
             snap['dm_name'] = snap['real_dev']
 
         if snap['real_dev'] in self.mounts:
@@ -585,16 +996,11 @@ class ThinPool(LvmInfo, template.BackendPool):
     def __init__(self, *args, **kwargs):
         super(ThinPool, self).__init__(*args, **kwargs)
         self.type = 'thin'
-        command = ["lvm", "lvs", "--separator", "|", "--noheadings",
-                   "--nosuffix", "--units", "k", "-o",
-                   "vg_name,lv_size,stripes,stripesize,segtype,lv_name," +
-                   "origin,lv_attr,pv_count,thin_count,data_percent," +
-                   "metadata_percent,snap_percent"]
         self.attrs = ['parent_pool', 'vol_size', 'stripes',
                       'stripesize', 'type', 'lv_name', 'origin', 'attr',
-                      'dev_count', 'vol_count', 'data_percent',
-                      'metadata_percent', 'snap_percent']
-        self._parse_data(command)
+                      None, 'snap_percent', 'dev_count', 'vol_count',
+                      'data_percent', 'metadata_percent']
+        self._parse_data('lv')
         # Uff, so ugly...needs to be changed
         global THIN_POOL_DATA
         THIN_POOL_DATA = self.data
@@ -604,8 +1010,11 @@ class ThinPool(LvmInfo, template.BackendPool):
         vg['pool_name'] = os.path.basename(vg['lv_name'])
         vg['index_name'] = "{}/{}".format(vg['parent_pool'], vg['pool_name'])
         vg['pool_size'] = vg['vol_size']
-        vg['pool_used'] = float(vg['vol_size']) * (float(vg['data_percent'])/100)
-        vg['pool_free'] = float(vg['vol_size']) - vg['pool_used']
+        # Usage of the thin pool is not known unless somebody needs it
+        if vg.get('data_percent'):
+            vg['pool_used'] = float(vg['vol_size']) * \
+                (float(vg['data_percent'])/100)
+            vg['pool_free'] = float(vg['vol_size']) - vg['pool_used']
         if vg['attr'][4] == 'a':
             vg['active'] = True
         else:
@@ -627,6 +1036,10 @@ class ThinPool(LvmInfo, template.BackendPool):
                     raise Exception("Multiple items with name {} found".format(key))
         return found
 
+    def aliases(self, key):
+        # Thin pools can also be referred to without the parent pool
+        return [key, key.split('/', 1)[1]]
+
     def _data_index(self, row):
         return row['index_name']
 
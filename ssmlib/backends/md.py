@@ -17,6 +17,7 @@
 
 import os
 import socket
+import threading
 from ssmlib import misc
 from ssmlib.backends import template
 
@@ -27,35 +28,124 @@ except KeyError:
 
 MDADM = "mdadm"
 
-
-class MdRaid(template.Backend):
-
-    def __init__(self, *args, **kwargs):
-        super(MdRaid, self).__init__(*args, **kwargs)
-        self.type = 'dm'
-        self._vol = {}
-        self._pool = {}
-        self._dev = {}
-        self.hostname = socket.gethostname()
-        self._binary = misc.check_binary(MDADM)
-        self.default_pool_name = SSM_DM_DEFAULT_POOL
-        self.attrs = ['dev_name', 'pool_name', 'dev_free',
-                      'dev_used', 'dev_size']
-
-        if not self._binary:
-            return
-
-        self.mounts = misc.get_mounts('/dev/md')
-
+# MD arrays are described by the kernel in <MD_SYSFS>/mdX/md
+MD_SYSFS = "/sys/block"
+
+
+def _read_sysfs_value(path, default=None):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        if default is None:
+            raise
+        return default
+
+
+class MdModel(object):
+    """
+    Information about all MD RAID arrays in the system and their member
+    devices. It is read from sysfs once and shared by the md backends until
+    the storage configuration changes. mdadm is only used for arrays the
+    kernel does not describe in sysfs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        with self.lock:
+            self.vol = None
+            self.dev = None
+
+    def get(self):
+        """ Return dictionaries of md volumes and their member devices. """
+        with self.lock:
+            if self.vol is None:
+                self._parse()
+            return self.vol, self.dev
+
+    def _parse(self):
+        vol = {}
+        dev = {}
+        mounts = misc.get_mounts('/dev/md')
         mdnumber = misc.get_dmnumber("md")
+        partitions = misc.get_partitions()
+        sizes = dict([(line[3], int(line[2])) for line in partitions])
+
+        # Without the md driver there can not be any md arrays
+        if mdnumber is not None:
+            for line in partitions:
+                devname = line[3]
+                # There is a row for each parent of the device
+                if line[0] != mdnumber or devname in vol:
+                    continue
+                devsize = int(line[2])
+                data = None
+                if misc.SSM_SYSFS:
+                    data = self.get_sysfs_data(devname, devsize, sizes, dev)
+                if data is None:
+                    data = self.get_volume_data(devname)
+                    for slave in misc.get_slaves(os.path.basename(devname)):
+                        dev[slave] = self.get_device_data(
+                            slave, sizes.get(slave, devsize))
+                if data['dev_name'] in mounts:
+                    data['mount'] = mounts[data['dev_name']]['mp']
+                vol[devname] = data
+        self.vol = vol
+        self.dev = dev
+
+    def get_sysfs_data(self, devname, devsize, sizes, devices):
+        """
+        Fill the volume data of the array devname and the data of its
+        member devices into devices from sysfs. Return None if the array
+        is not described there.
+        """
+        md = os.path.join(MD_SYSFS, os.path.basename(devname), "md")
+        try:
+            level = _read_sysfs_value(os.path.join(md, "level"))
+            metadata = _read_sysfs_value(os.path.join(md, "metadata_version"))
+            members = sorted([name[4:] for name in os.listdir(md)
+                              if name.startswith("dev-")])
+            # Not every raid level can be synchronized
+            sync_action = _read_sysfs_value(os.path.join(md, "sync_action"),
+                                            "idle")
+            sync_completed = _read_sysfs_value(
+                os.path.join(md, "sync_completed"), "none")
+        except (IOError, OSError):
+            return None
 
-        for line in misc.get_partitions():
-            devname = line[3]
-            devsize = int(line[2])
-            if line[0] == mdnumber:
-                self._vol[devname] = self.get_volume_data(devname)
-                for dev in misc.get_slaves(os.path.basename(devname)):
-                    self._dev[dev] = self.get_device_data(dev, devsize)
+        data = {}
+        data['dev_name'] = devname
+        data['real_dev'] = devname
+        data['pool_name'] = SSM_DM_DEFAULT_POOL
+        data['type'] = level
+        data['vol_size'] = str(devsize)
+        data['total_devices'] = str(len(members))
+        if sync_action not in ['idle', 'frozen']:
+            data['sync_action'] = sync_action
+            try:
+                done, total = [int(value) for value in
+                               sync_completed.split("/")]
+                data['sync_progress'] = "{0:.2f}".format(
+                    100.0 * done / total)
+            except (ValueError, ZeroDivisionError):
+                pass
+
+        for member in members:
+            dev_name = "/dev/{0}".format(member.replace("!", "/"))
+            dev = {}
+            dev['dev_name'] = dev_name
+            dev['hide'] = False
+            # mdadm reports the name of the array only with version 1
+            # superblocks
+            if metadata.startswith("1."):
+                dev['pool_name'] = SSM_DM_DEFAULT_POOL
+            dev['dev_used'] = dev['dev_size'] = sizes.get(dev_name, devsize)
+            dev['dev_free'] = 0
+            devices[dev_name] = dev
+        return data
 
     def get_device_data(self, devname, devsize):
         data = {}
@@ -79,8 +169,6 @@ class MdRaid(template.Backend):
         data['dev_name'] = devname
         data['real_dev'] = devname
         data['pool_name'] = SSM_DM_DEFAULT_POOL
-        if data['dev_name'] in self.mounts:
-            data['mount'] = self.mounts[data['dev_name']]['mp']
         command = [MDADM, '--detail', devname]
         for line in misc.run(command, stderr=False)[1].split("\n"):
             array = line.split(":")
@@ -97,11 +185,39 @@ class MdRaid(template.Backend):
 
         return data
 
+MD_MODEL = MdModel()
+misc.register_cache(MD_MODEL.invalidate)
+
+
+class MdRaid(template.Backend):
+
+    def __init__(self, *args, **kwargs):
+        super(MdRaid, self).__init__(*args, **kwargs)
+        self.type = 'dm'
+        self._vol = {}
+        self._pool = {}
+        self._dev = {}
+        self.hostname = socket.gethostname()
+        self._binary = misc.check_binary(MDADM)
+        self.default_pool_name = SSM_DM_DEFAULT_POOL
+        self.attrs = ['dev_name', 'pool_name', 'dev_free',
+                      'dev_used', 'dev_size']
+
+        if not self._binary:
+            return
+
+        vol, dev = MD_MODEL.get()
+        self._vol = template.copy_rows(vol)
+        self._dev = template.copy_rows(dev)
+
     def run_mdadm(self, command):
         if not self._binary:
             self.problem.check(self.problem.TOOL_MISSING, MDADM)
         command.insert(0, MDADM)
-        return misc.run(command, stdout=True)
+        try:
+            return misc.run(command, stdout=True)
+        finally:
+            misc.invalidate_caches()
 
 
 class MdRaidVolume(MdRaid, template.BackendVolume):
@@ -21,12 +21,119 @@ import re
 from ssmlib import misc
 from ssmlib import problem
 
+from ssmlib.backends import dm
 from ssmlib.backends import template
 
 __all__ = ["MultipathDevice"]
 
 MP="multipath"
 
+# Lines of 'multipath -ll' output. A map is described by a header, the
+# size line and then the tree of path groups and their paths.
+MAP_HEADER_RE = re.compile(r"^(\S+)(?: \(([^)]+)\))? (dm-\d+) (.*)$")
+PATH_GROUP_RE = re.compile(r"[|`]-\+- (.*)$")
+PATH_RE = re.compile(r"[|`]- (\S+)\s+(\S+)\s+(\d+:\d+)\s*(.*)$")
+
+
+def parse_topology(output):
+    """ Parse the output of 'multipath -ll' into a list of maps.
+
+    Each map is a dictionary with the 'name' of the map, its 'wwid', the
+    'dm' device and the list of path 'groups'. Each group is a dictionary
+    with the group 'attrs' and the list of its 'paths', each of them being
+    a dictionary with 'hctl', 'dev', 'devnum' and 'state'.
+
+    Parameters
+    ----------
+    output : str
+        Output of 'multipath -ll', possibly limited to some maps
+
+    Returns
+    -------
+    list
+        Maps in the order multipath listed them
+    """
+    maps = []
+    mp_map = group = None
+    for line in output.split("\n"):
+        if not line.strip():
+            continue
+        if line[0] not in " |`" and not line.startswith("size="):
+            match = MAP_HEADER_RE.match(line)
+            if not match:
+                mp_map = group = None
+                continue
+            # Without user friendly names the wwid is the name
+            mp_map = {'name': match.group(1),
+                      'wwid': match.group(2) or match.group(1),
+                      'dm': match.group(3),
+                      'groups': []}
+            group = None
+            maps.append(mp_map)
+            continue
+        if mp_map is None:
+            continue
+        match = PATH_GROUP_RE.search(line)
+        if match:
+            group = {'attrs': match.group(1), 'paths': []}
+            mp_map['groups'].append(group)
+            continue
+        match = PATH_RE.search(line)
+        if match and group is not None:
+            group['paths'].append({'hctl': match.group(1),
+                                   'dev': match.group(2),
+                                   'devnum': match.group(3),
+                                   'state': match.group(4)})
+    return maps
+
+
+def parse_table(params):
+    """ Parse parameters of the multipath device mapper target into the list
+    of path groups as described in parse_topology(). Paths are only known by
+    their device, so the 'hctl' and the 'state' of the paths are empty.
+
+    Parameters
+    ----------
+    params : str
+        Parameters of the multipath target in the device mapper table
+
+    Returns
+    -------
+    list
+        Path groups, or None if the parameters could not be parsed
+    """
+    array = params.split()
+    try:
+        # Skip the features and the hardware handler
+        pos = 1 + int(array[0])
+        pos += 1 + int(array[pos])
+        count = int(array[pos])
+        pos += 2
+        groups = []
+        for i in range(count):
+            selector = array[pos:pos + 2 + int(array[pos + 1])]
+            pos += len(selector)
+            paths = int(array[pos])
+            path_args = int(array[pos + 1])
+            pos += 2
+            group = {'attrs': "policy='{0}'".format(" ".join([selector[0]] +
+                                                             selector[2:])),
+                     'paths': []}
+            for j in range(paths):
+                devname = dm.find_device_name(array[pos])
+                if devname is None:
+                    return None
+                group['paths'].append({'hctl': '',
+                                       'dev': devname.replace("/dev/", "", 1),
+                                       'devnum': array[pos],
+                                       'state': ''})
+                pos += 1 + path_args
+            groups.append(group)
+    except (IndexError, ValueError):
+        return None
+    return groups
+
+
 class Multipath(template.Backend):
     def __init__(self, options, data=None):
         self.type = 'multipath'
@@ -36,9 +143,11 @@ class Multipath(template.Backend):
         self.output = None
         self.problem = problem.ProblemSet(options)
 
-        for mp_dev in self.get_mp_devices():
-            mpname = self.get_real_device(mp_dev)
-            self._dev[mp_dev] = self.get_volume_data(mp_dev)
+        # All the maps are described by a single 'multipath -ll'
+        for mp_map in self.get_topology():
+            mp_dev = mp_map['name']
+            self._dev[mp_dev] = self._map_data(mp_map)
+            mpname = self._dev[mp_dev]['dev_name']
             for devname in self._dev[mp_dev]['nodes']:
                 self._dev[devname] = self.get_device_data(devname, mpname, 0)
 
@@ -67,50 +176,77 @@ class Multipath(template.Backend):
             data['mount'] = 'MULTIPATH'
         return data
 
-    def get_mp_devices(self):
-        """ Find all multipath devices (but not their nodes). """
-        devices = []
+    def get_topology(self, volname=None):
+        """ Find the multipath maps, see parse_topology(). The maps are read
+            from the shared device mapper information, or by running
+            'multipath -ll' once if it is not complete.
+        """
+        maps = self.get_dm_topology(volname)
+        if maps is not None:
+            return maps
         command = [MP, '-ll']
+        if volname:
+            command.append(volname)
         try:
-            output = misc.run(command, stderr=False, can_fail=True)[1].split("\n")
-            pattern = re.compile(r"^([a-z0-9]+) \([^)]+\)")
+            output = misc.run(command, stderr=False, can_fail=True)[1]
         except (problem.CommandFailed, OSError):
             # probably multipath not installed
-            output = []
+            return []
+        return parse_topology(output or "")
 
-        for line in output:
-            match = pattern.match(line)
-            if match:
-                devices.append(match.group(1))
-        return devices
+    def get_dm_topology(self, volname=None):
+        """ Describe the multipath maps from the device mapper tables, or
+            return None if that is not possible.
+        """
+        if not dm.devices_complete():
+            return None
+        maps = []
+        for device in sorted(dm.get_devices().values(),
+                             key=lambda device: device['name']):
+            if device['subsystem'] != 'mpath':
+                continue
+            if volname and volname not in [device['name'], device['dm_name'],
+                                           device['real_dev']]:
+                continue
+            table = dm.get_table(device['name'])
+            if not table or table[0]['type'] != 'multipath':
+                return None
+            groups = parse_table(table[0]['params'])
+            if groups is None:
+                return None
+            maps.append({'name': device['name'],
+                         'wwid': device['uuid'][len('mpath-'):],
+                         'dm': os.path.basename(device['real_dev']),
+                         'groups': groups})
+        return maps
 
+    def get_mp_devices(self):
+        """ Find all multipath devices (but not their nodes). """
+        return [mp_map['name'] for mp_map in self.get_topology()]
+
+    def _map_data(self, mp_map):
+        data = {}
+        # Maps are named by their wwid without user friendly names, so
+        # the name can not tell the device
+        data['dev_name'] = misc.get_real_device("/dev/" + mp_map['dm'])
+        data['hide'] = False
+        data['wwid'] = mp_map['wwid']
+        data['dev_size'] = misc.get_device_size(data['dev_name'])
+        data['nodes'] = []
+        for group in mp_map['groups']:
+            for path in group['paths']:
+                data['nodes'].append("/dev/" +
+                                     self.get_real_device(path['dev']))
+        data['total_nodes'] = len(data['nodes'])
+        data['path_groups'] = len(mp_map['groups'])
+        return data
 
     def get_volume_data(self, volname):
         data = {}
         data['dev_name'] = self.get_real_device(volname)
         data['hide'] = False
-        command = [MP, '-ll', volname]
-        try:
-            output = misc.run(command, stderr=False)[1].split("\n")
-        except OSError:
-            # probably multipath not installed
-            output = []
-
-        if len(output) > 0:
-            match = re.search(r"\(([^)]+)\)",output[0])
-            data['wwid'] = match.group(1)
-            data['dev_size'] = misc.get_device_size(data['dev_name'])
-            data['nodes'] = []
-            data['total_nodes'] = 0
-            for entry in zip(output[2::2],output[3::2]):
-                """ Some string operations to remove the tree path symbols
-                    from the output. """
-                dev = list(filter(None,
-                            entry[1][re.search(r"[a-zA-Z0-9]", entry[1])
-                                     .start():].split(" ")
-                        ))
-                data['nodes'].append("/dev/"+self.get_real_device(dev[1]))
-                data['total_nodes'] += 1
+        for mp_map in self.get_topology(volname):
+            data = self._map_data(mp_map)
         return data
 
 
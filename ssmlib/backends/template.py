@@ -48,6 +48,35 @@ class Backend(object):
         if key in self.data:
             return self.data[key]
 
+    def aliases(self, key):
+        """
+        Return all the names the item stored in self.data under the key can
+        be referred to by. Backends which accept other names than the keys
+        in __getitem__() should extend this, see Storage.__getitem__().
+        """
+        return [key]
+
+
+def device_aliases(devices, dev_dir):
+    """
+    Return the device paths along with the same paths relative to dev_dir,
+    such as vg/lv for /dev/vg/lv.
+    """
+    aliases = []
+    for device in devices:
+        aliases.append(device)
+        if device.startswith(dev_dir + "/"):
+            aliases.append(device[len(dev_dir) + 1:])
+    return aliases
+
+
+def copy_rows(rows):
+    """
+    Return a copy of the rows of data shared by the backends, which the
+    backend can modify freely.
+    """
+    return dict((name, row.copy()) for (name, row) in rows.items())
+
 
 class BackendPool(Backend):
     def __init__(self, *args, **kwargs):
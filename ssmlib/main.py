@@ -42,6 +42,14 @@ SUPPORTED_BACKENDS = ['lvm', 'btrfs', 'crypt']
 SUPPORTED_RAID = ['0', '1', '10']
 os.environ['LC_ALL'] = "C"
 
+# State of the file system probe of an item
+FS_PROBE_UNKNOWN = 0
+FS_PROBE_NONE = 1
+FS_PROBE_FS = 2
+
+# Number of file system probes done so far
+FS_PROBE_COUNT = 0
+
 # If you change this please change doc/conf.py as well
 VERSION = '1.4'
 
@@ -63,6 +71,32 @@ else:
         return next(iter)
 
 
+class ListPlan(object):
+    """
+    Plan of the discovery for the tables 'ssm list' is going to print. It is
+    worked out from the attributes of the tables and tells the backends
+    which of the expensive information is actually going to be printed, see
+    Options.needs().
+    """
+
+    # Expensive information and the table attributes which need it
+    PROBES = {
+        # File system type and sizes found by probing the device
+        'fs_info': frozenset(['fs_type', 'fs_size', 'fs_free', 'fs_used',
+                              'fs_uuid', 'fs_label']),
+        # How much of the snapshot space is used
+        'snap_usage': frozenset(['snap_size']),
+        # How much of the thin pool data space is used
+        'thin_usage': frozenset(['pool_free', 'pool_used']),
+    }
+
+    def __init__(self, attrs):
+        self.attrs = frozenset(attrs)
+
+    def needs(self, probe):
+        return not self.attrs.isdisjoint(self.PROBES[probe])
+
+
 class Options(object):
     """
     Structure that contains option setting allowing it to be
@@ -78,6 +112,15 @@ class Options(object):
         self.force = False
         self.yes = False
         self.config = None
+        # Discovery plan of the current 'ssm list', see ListPlan
+        self.plan = None
+
+    def needs(self, probe):
+        """
+        Return True if the expensive information, one of ListPlan.PROBES,
+        is needed. Everything is needed unless there is a discovery plan.
+        """
+        return self.plan is None or self.plan.needs(probe)
 
     @property
     def vv(self):
@@ -126,6 +169,17 @@ try:
 except KeyError:
     SSM_PREFIX_FILTER = None
 
+# Reuse the tables printed by 'ssm list' until the storage changes. The
+# tables are kept in misc.SSM_CACHE_DIR, see StorageHandle.list().
+try:
+    SSM_LIST_CACHE = os.environ['SSM_LIST_CACHE']
+    if SSM_LIST_CACHE.upper() in ['YES', 'TRUE', '1']:
+        SSM_LIST_CACHE = True
+    else:
+        SSM_LIST_CACHE = False
+except KeyError:
+    SSM_LIST_CACHE = False
+
 
 class Struct(object):
     def __init__(self):
@@ -238,6 +292,18 @@ class SetBackend(argparse._StoreAction):
         setattr(namespace, self.dest, values)
 
 
+class SetProfile(argparse.Action):
+    """
+    Action for the profile parameters. Profiling has to be enabled right
+    away so that it covers the information gathered while parsing the rest
+    of the command line.
+    """
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        misc.SSM_PROFILE = True
+        setattr(namespace, self.dest, values if values else True)
+
+
 class FsInfo(object):
     """
     Parse and store information about the file system. Methods specific for
@@ -286,24 +352,73 @@ class FsInfo(object):
     def get_info(self, *args, **kwargs):
         return self._get_fs_func("get_info", *args, **kwargs)
 
+    def _statvfs_get_info(self, mount_point, size=None):
+        stat = os.statvfs(mount_point)
+        # The kernel leaves the metadata out of the file system size, so
+        # the size from the superblock is preferred when it is known
+        if size is None:
+            size = stat.f_blocks * stat.f_frsize // 1024
+        self.data['fs_size'] = size
+        self.data['fs_free'] = stat.f_bavail * stat.f_frsize // 1024
+        self.data['fs_used'] = size - stat.f_bfree * stat.f_frsize // 1024
+
+    def _store_fs_ids(self):
+        """ Store the UUID and the label found in the superblock. """
+        if not self.fs_info:
+            return
+        if self.fs_info['uuid']:
+            self.data['fs_uuid'] = self.fs_info['uuid']
+        if self.fs_info['label']:
+            self.data['fs_label'] = self.fs_info['label']
+
     def extN_get_info(self, dev):
+        # The superblock is read directly, tune2fs is just a fallback
+        self.fs_info = misc.read_ext_superblock(dev)
+        self._store_fs_ids()
+        # Free blocks in the superblock are not kept up to date while the
+        # file system is mounted, so only its size is taken from there
+        # and the kernel describes the rest.
+        mount_point = misc.get_mount_point(dev)
+        if mount_point:
+            size = None
+            if self.fs_info:
+                size = self.fs_info['block_count'] * \
+                    self.fs_info['block_size'] // 1024
+            self._statvfs_get_info(mount_point, size)
+            return
+        if not self.fs_info:
+            self.fs_info = self._tune2fs_superblock(dev)
+            self._store_fs_ids()
+        if not self.fs_info:
+            return
+
+        bsize = self.fs_info['block_size']
+        bcount = self.fs_info['block_count']
+        rbcount = self.fs_info['reserved_blocks']
+        fbcount = self.fs_info['free_blocks']
+        self.data['fs_size'] = bcount * bsize // 1024
+        self.data['fs_free'] = (fbcount - rbcount) * bsize // 1024
+        self.data['fs_used'] = (bcount - fbcount) * bsize // 1024
+
+    def _tune2fs_superblock(self, dev):
         command = ["tune2fs", "-l", dev]
         if not misc.check_binary(command[0]):
-            return
+            return None
         output = misc.run(command)[1]
 
+        fs_info = {}
         for line in output.split("\n")[1:]:
             array = line.split(":")
             if len(array) == 2:
-                self.fs_info[array[0]] = array[1].lstrip()
+                fs_info[array[0]] = array[1].lstrip()
 
-        bsize = int(self.fs_info['Block size'])
-        bcount = int(self.fs_info['Block count'])
-        rbcount = int(self.fs_info['Reserved block count'])
-        fbcount = int(self.fs_info['Free blocks'])
-        self.data['fs_size'] = bcount * bsize // 1024
-        self.data['fs_free'] = (fbcount - rbcount) * bsize // 1024
-        self.data['fs_used'] = (bcount - fbcount) * bsize // 1024
+        label = fs_info.get('Filesystem volume name', '')
+        return {'block_size': int(fs_info['Block size']),
+                'block_count': int(fs_info['Block count']),
+                'free_blocks': int(fs_info['Free blocks']),
+                'reserved_blocks': int(fs_info['Reserved block count']),
+                'uuid': fs_info.get('Filesystem UUID', ''),
+                'label': '' if label == '<none>' else label}
 
     def extN_fsck(self):
         command = ['fsck.{0}'.format(self.fstype), '-f', '-n']
@@ -344,43 +459,58 @@ class FsInfo(object):
             raise PR.error("File system on {0} is not ".format(self.device) +
                            "clean, I will not attempt to resize it. Please," +
                            "fix the problem first")
-        return misc.run(command, stdout=True)[0]
+        try:
+            return misc.run(command, stdout=True)[0]
+        finally:
+            misc.invalidate_caches()
 
     def xfs_get_info(self, dev):
         # Never use xfs_db for a mounted filesystem - such use is unsupported
         # by XFS and almost guaranteed to report stale data.
-        realdev = misc.get_real_device(dev)
-        mount_point = misc.get_mounts(dev).get(realdev, {}).get('mp', None)
+        mount_point = misc.get_mount_point(dev)
         if mount_point:
-            stat = os.statvfs(mount_point)
-            total = stat.f_blocks*stat.f_bsize/1024
-            free = stat.f_bfree*stat.f_bsize/1024
-            used = (stat.f_blocks-stat.f_bfree)*stat.f_bsize/1024
-            self.data['fs_size'] = total
-            self.data['fs_free'] = free
-            self.data['fs_used'] = used
-        else :
-            command = ["xfs_db", "-r", "-c", "sb", "-c", "print", dev]
-            if not misc.check_binary(command[0]):
+            self._statvfs_get_info(mount_point)
+        else:
+            # The superblock is read directly, xfs_db is just a fallback
+            self.fs_info = misc.read_xfs_superblock(dev) or \
+                self._xfs_db_superblock(dev)
+            if not self.fs_info:
                 return
-            output = misc.run(command)[1]
-
-            for line in output.split("\n")[1:]:
-                    array = line.split("=")
-                    if len(array) == 2:
-                        self.fs_info[array[0].rstrip()] = array[1].lstrip()
+            self._store_fs_ids()
 
-            bsize = int(self.fs_info['blocksize'])
-            bcount = int(self.fs_info['dblocks'])
-            lbcount = int(self.fs_info['logblocks'])
+            bsize = self.fs_info['block_size']
+            bcount = self.fs_info['block_count']
+            lbcount = self.fs_info['log_blocks']
             bcount -= lbcount
-            agcount = int(self.fs_info['agcount'])
-            fbcount = int(self.fs_info['fdblocks'])
+            agcount = self.fs_info['ag_count']
+            fbcount = self.fs_info['free_blocks']
             fbcount -= 4 + (4 + agcount)
             self.data['fs_size'] = bcount * bsize // 1024
             self.data['fs_free'] = fbcount * bsize // 1024
             self.data['fs_used'] = (bcount - fbcount) * bsize // 1024
 
+    def _xfs_db_superblock(self, dev):
+        command = ["xfs_db", "-r", "-c", "sb", "-c", "print", dev]
+        if not misc.check_binary(command[0]):
+            return None
+        output = misc.run(command)[1]
+
+        fs_info = {}
+        for line in output.split("\n")[1:]:
+            array = line.split("=")
+            if len(array) == 2:
+                fs_info[array[0].rstrip()] = array[1].lstrip()
+
+        return {'block_size': int(fs_info['blocksize']),
+                'block_count': int(fs_info['dblocks']),
+                'free_blocks': int(fs_info['fdblocks']),
+                'reserved_blocks': 0,
+                'log_blocks': int(fs_info['logblocks']),
+                'ag_count': int(fs_info['agcount']),
+                'uuid': fs_info.get('uuid', ''),
+                'label': fs_info.get('fname', '').strip('"').replace(
+                    "\\000", "")}
+
     def xfs_fsck(self):
         command = ['xfs_repair', '-n']
         if not misc.check_binary(command[0]):
@@ -409,6 +539,7 @@ class FsInfo(object):
         else:
             command.append(self.mounted)
             misc.run(command, stdout=True)
+            misc.invalidate_caches()
 
 
 class DeviceInfo(object):
@@ -458,20 +589,21 @@ class DeviceInfo(object):
             if item[0] in self.data:
                 self.data[item[0]]['mount'] = "SWAP"
 
-        for i, dev in enumerate(self.data.values()):
+        # Device is a partition of its parent device, as long as its name
+        # starts with the name of the parent.
+        partitions = {}
+        for dev in self.data.values():
+            parent = dev.get('parent_name')
+            if parent and dev.get('dev_name', "") != parent and \
+               dev.get('dev_name', "").startswith(parent):
+                partitions.setdefault(parent, []).append(dev)
+
+        for dev in self.data.values():
             part = 0
-            for a, d in enumerate(self.data.values()):
-                if a == i:
-                    continue
-                try:
-                    if d['parent_name'] != dev['dev_name'] and dev['major'] != d['major']:
-                        continue
-                except KeyError:
-                    continue
-                if re.search(dev['dev_name'], d['dev_name']):
-                    d['partition'] = True
-                    d['type'] = 'part'
-                    part += 1
+            for d in partitions.get(dev.get('dev_name'), []):
+                d['partition'] = True
+                d['type'] = 'part'
+                part += 1
             dev['partitioned'] = part
             if part > 0:
                 dev['mount'] = "PARTITIONED"
@@ -514,6 +646,7 @@ class DeviceInfo(object):
         command = ['dd', 'if={}'.format(source_dev), 'of={}'. \
                    format(target_dev), 'conv=fsync']
         misc.run(command)
+        misc.invalidate_caches()
         misc.send_udev_event(source_dev, "change")
         misc.send_udev_event(target_dev, "change")
 
@@ -541,6 +674,10 @@ class Item(misc.Node):
     need to call Dev, Pool or Vol methods directly.
     """
 
+    # There can be a lot of items on bigger systems, so keep them compact
+    __slots__ = ('obj', 'name', '_name_fields', 'aliases', 'key', 'type',
+                 'source', 'info_printed', '_names', '_proxies')
+
     def __init__(self, obj, name, source):
         """
         Parameters:
@@ -557,9 +694,14 @@ class Item(misc.Node):
         self.name = name
         self._name_fields = None
         self.aliases = set()
+        # Key of the item in the backend data
+        self.key = name
         self.type = obj.type
         self.source = source
         self.info_printed = False
+        self._names = None
+        # Backend method proxies created by __getattr__
+        self._proxies = None
 
     @property
     def name_fields(self):
@@ -569,22 +711,28 @@ class Item(misc.Node):
 
     @name_fields.setter
     def name_fields(self, vals):
-        self._name_fields = set(vals)
+        self._name_fields = frozenset(vals)
+        self._names = None
 
     @property
     def data(self):
-        return self.obj[self.name]
+        return self.obj[self.key]
 
     @property
     def names(self):
         """ Get a set of all names that can be used to reference this object.
             E.g /dev/dm-0 and /dev/mapper/some_name.
 
+        The set is computed once and reused until the data of the item
+        is changed through update_data().
+
         Returns
         -------
-        set
+        frozenset
             A set of names of this object.
         """
+        if self._names is not None:
+            return self._names
         names = set([self.name])
         for field in self.name_fields:
             name = self[field]
@@ -594,7 +742,19 @@ class Item(misc.Node):
             names.add(name)
         if 'pool_name' in self and 'lv_name' in self:
             names.add("{}/{}".format(self['pool_name'], self['lv_name']))
-        return names
+        self._names = frozenset(names)
+        return self._names
+
+    def update_data(self, values):
+        """ Update the backend data of the item with the given values.
+
+        Parameters
+        ----------
+        values : dict
+            Fields to set in the data of the item.
+        """
+        self.data.update(values)
+        self._names = None
 
     def matches_name(self, name):
         """ Return true if the object matches the name. That can be a path,
@@ -681,6 +841,10 @@ class Item(misc.Node):
         if 'fs_info' in node and node['fs_type']:
             out.append(('filesystem', ''))
             out.append(('  type', node['fs_type']))
+            if node['fs_uuid']:
+                out.append(('  uuid', node['fs_uuid']))
+            if node['fs_label']:
+                out.append(('  label', node['fs_label']))
             if node['fs_size']:
                 out.append(('  size', misc.humanize_size(node['fs_size'])))
             if node['fs_used']:
@@ -695,6 +859,31 @@ class Item(misc.Node):
             out.append(('  type', 'Swap'))
         return out
 
+    @classmethod
+    def sync_info(cls, node):
+        """
+        Get a list of pairs (description, value) about the synchronization
+        running on the given node, such as the resync of an md array. Both
+        values are user-visible strings.
+
+        Parameters:
+        ----------
+        node : {Item}
+            An item we want to learn about.
+        Returns
+        -------
+        {list}
+            List of (str, str) tuples, with (description, value) meaning.
+        """
+        out = []
+        if node['sync_action']:
+            out.append(('synchronization', ''))
+            out.append(('  action', node['sync_action']))
+            if node['sync_progress']:
+                out.append(('  progress',
+                            "{0} %".format(node['sync_progress'])))
+        return out
+
     @classmethod
     def get_pool_node(cls, node):
         """
@@ -830,6 +1019,19 @@ class Item(misc.Node):
         return False
 
     def __getattr__(self, func_name):
+        # Only called when the regular lookup fails, so do not recurse into
+        # ourselves when asked for an attribute which is not set up yet.
+        if func_name[0] == '_' and (func_name in _ITEM_SLOTS or
+                                    func_name.startswith('__')):
+            raise AttributeError(func_name)
+        proxies = self._proxies
+        if proxies is None:
+            proxies = self._proxies = {}
+        else:
+            try:
+                return proxies[func_name]
+            except KeyError:
+                pass
         func = getattr(self.obj, func_name)
 
         def _new_func(*args, **kwargs):
@@ -842,14 +1044,16 @@ class Item(misc.Node):
             else:
                 return func(self.name)
 
+        proxies[func_name] = _new_func
         return _new_func
 
     def __getitem__(self, key):
-        if key not in self.data and isinstance(key, str) and \
-           re.match(r"fs_.*", key):
+        data = self.data
+        if key not in data and isinstance(key, str) and \
+           key.startswith("fs_"):
             self._fill_fs_info()
         try:
-            ret = self.data[key]
+            ret = data[key]
         except KeyError:
             ret = ""
         return ret
@@ -864,7 +1068,32 @@ class Item(misc.Node):
         self._fill_fs_info()
         return repr((self.names, repr(self.data)))
 
+    @property
+    def fs_probe(self):
+        """ State of the file system probe for the current data of the item.
+            It is kept in the data, so all the items of the same device
+            share it, whatever name they were looked up by.
+
+        Returns
+        -------
+        int
+            FS_PROBE_UNKNOWN if the device was not probed yet, FS_PROBE_NONE
+            if there is no file system on it, FS_PROBE_FS otherwise.
+        """
+        return self.data.get('fs_probe', FS_PROBE_UNKNOWN)
+
     def _fill_fs_info(self):
+        """ Probe the device for a file system, at most once for the data
+            the backend provided for this item. Probes which fail are not
+            remembered.
+        """
+        global FS_PROBE_COUNT
+        if self.fs_probe != FS_PROBE_UNKNOWN:
+            return
+        # Nothing is going to print the file system information
+        if not self.obj.options.needs('fs_info'):
+            return
+        FS_PROBE_COUNT += 1
         if 'dm_name' in self.data:
             name = self.data['dm_name']
         elif 'real_dev' in self.data:
@@ -876,13 +1105,16 @@ class Item(misc.Node):
         fs = FsInfo(name, self.obj.options)
         if 'fs_type' not in fs.data:
             # Not a file system
+            self.data['fs_probe'] = FS_PROBE_NONE
             return
         try:
             fs.mounted = self.data['mount']
         except KeyError:
             fs.mounted = ""
-        self.data.update(fs.data)
-        self.data['fs_info'] = fs
+        fs_data = dict(fs.data)
+        fs_data['fs_info'] = fs
+        fs_data['fs_probe'] = FS_PROBE_FS
+        self.update_data(fs_data)
 
     def exists(self):
         if self.name in self.obj:
@@ -899,11 +1131,17 @@ class Item(misc.Node):
             return False
         return False
 
+_ITEM_SLOTS = frozenset(Item.__slots__)
+
+
 class PoolItem(Item):
 
+    __slots__ = ()
+    NAME_FIELDS = frozenset(['pool_name', 'dev_name'])
+
     def __init__(self, *args, **kwargs):
         super(PoolItem, self).__init__(*args, **kwargs)
-        self.name_fields = set(['pool_name', 'dev_name'])
+        self.name_fields = self.NAME_FIELDS
 
     def _get_printable_details(self):
         out = []
@@ -935,12 +1173,17 @@ class PoolItem(Item):
         return out
 
 class DeviceItem(Item):
+
+    __slots__ = ('__is_dm_dev',)
+    NAME_FIELDS = frozenset(['dev_name', 'mount', 'human_name'])
+
     def __init__(self, *args, **kwargs):
         super(DeviceItem, self).__init__(*args, **kwargs)
-        self.name_fields = set(['dev_name', 'mount', 'human_name'])
+        self.name_fields = self.NAME_FIELDS
         self.__is_dm_dev = None
         if self._is_lvm_snapshot():
-            self.data['snapshot_child_name'] = self._is_lvm_snapshot()
+            self.update_data(
+                {'snapshot_child_name': self._is_lvm_snapshot()})
 
     def _is_lvm_snapshot(self):
         """ Find out if this item is in fact a real/cow device for LVM snapshots
@@ -1048,15 +1291,20 @@ class DeviceItem(Item):
 
 
 class VolumeItem(Item):
+
+    __slots__ = ()
+    NAME_FIELDS = frozenset(['dev_name', 'dm_name', 'real_dev'])
+
     def __init__(self, *args, **kwargs):
         super(VolumeItem, self).__init__(*args, **kwargs)
-        self.name_fields = set(['dev_name', 'dm_name', 'real_dev'])
+        self.name_fields = self.NAME_FIELDS
 
     def _get_printable_details(self):
         out = []
         pool = self.get_pool_node(self)
         out.append(('type', self.volume_type_name(pool['type'])))
         out += self.volume_info(self)
+        out += self.sync_info(self)
         out += self.parent_pool_info(self, 'parent pool')
         out += self.fs_info(self)
         return out
@@ -1081,15 +1329,18 @@ class VolumeItem(Item):
 
 
 class SnapshotItem(Item):
+
+    __slots__ = ()
+    NAME_FIELDS = frozenset(['dev_name', 'mount', 'origin'])
+
     def __init__(self, *args, **kwargs):
         super(SnapshotItem, self).__init__(*args, **kwargs)
-        self.name_fields = set(['dev_name', 'mount', 'origin'])
+        self.name_fields = self.NAME_FIELDS
 
     def _get_printable_details(self):
         out = []
         out.append(('type', 'snapshot'))
-        names = self.names
-        names.discard(self['origin'])
+        names = self.names - set([self['origin']])
         for name in names:
             if name in self['mount']:
                 continue
@@ -1115,13 +1366,15 @@ class Storage(object):
     Template class to use for storing information about Pools, Volumes and
     Devices from different backends. This simplify things a lot since we do not
     have to manually walk through all the backends, but this class will do this
-    for us.
+    for us. Every storage has to define ATTRS, the attributes printed in its
+    table.
     """
 
     def __init__(self, options):
         super(Storage, self).__init__()
         self._data = {}
         self._cache = {}
+        self._index = None
         self.name_fields = set()
         self.detail_fields = []
         self.header = None
@@ -1130,7 +1383,7 @@ class Storage(object):
         self.item_cls = None
         self.set_globals(options)
 
-    def _cached_Item(self, backend, item):
+    def _cached_Item(self, backend, item, key=None):
         """ Read self._data to get an Item and use cache so subsequent
             request for the same Item do not create a new instance all the
             time.
@@ -1141,6 +1394,9 @@ class Storage(object):
                 The name of the backend to use.
             item : str
                 The name of the item from the backend.
+            key : str, optional
+                The key of the item in the backend data, if it is known and
+                differs from the name.
         """
         if backend not in self._cache:
             self._cache[backend] = {}
@@ -1150,6 +1406,8 @@ class Storage(object):
                 obj=self._data[backend],
                 name=item,
                 source=self)
+            if key is not None:
+                new_item.key = key
             self._cache[backend][item] = new_item
 
         return self._cache[backend][item]
@@ -1165,14 +1423,104 @@ class Storage(object):
         else:
             return False
 
-    def __getitem__(self, name):
+    def _build_index(self):
+        """
+        Map every name of every item to the backend and the key of the item
+        in the backend data. The first backend which knows the name wins,
+        names which refer to several items of the same backend are ambiguous
+        and stored as None.
+        """
+        index = {}
         for backend, source in self._data.items():
-            item = source[name]
-            if item:
-                return self._cached_Item(backend, name)
+            owners = {}
+            for key in source.data:
+                if hasattr(source, 'aliases'):
+                    aliases = source.aliases(key)
+                else:
+                    aliases = [key]
+                for alias in aliases:
+                    if alias in owners and owners[alias] != key:
+                        index[alias] = None
+                        continue
+                    owners[alias] = key
+                    index.setdefault(alias, (backend, key))
+        return index
+
+    @staticmethod
+    def _real_name(name):
+        """
+        Resolve the name the same way the backends always did, so that
+        names relative to DM_DEV_DIR and symlinks which are not known
+        aliases are still found.
+        """
+        device = name
+        if not os.path.isabs(name) and not os.path.exists(name):
+            device = lvm.DM_DEV_DIR + "/" + name
+            if not os.path.exists(device):
+                return None
+        return misc.get_real_device(device)
+
+    def __getitem__(self, name):
+        if self._index is None:
+            self._index = self._build_index()
+        try:
+            found = self._index.get(name)
+            if found is None and name not in self._index:
+                found = self._index.get(self._real_name(name))
+        except TypeError:
+            # Not a name at all
+            return None
+
+        if found is not None:
+            return self._cached_Item(found[0], name, found[1])
+        if name in self._index:
+            # Ambiguous name, let the backends decide
+            for backend, source in self._data.items():
+                item = source[name]
+                if item:
+                    return self._cached_Item(backend, name)
         return None
 
+    def _probe_backends(self, backends):
+        """
+        Gather information from all the backends in parallel, since most of
+        the time is spent waiting for the external tools anyway. Backends
+        which fail to gather the information are warned about, in the same
+        order as they were given. Backends may ask the user, or print what
+        they do, so they are probed one after another when ssm is run
+        interactively or verbosely.
+
+        Parameters
+        ----------
+        backends : list of (str, class, str) tuples
+            Name of the backend, backend class to instantiate and description
+            of the information it provides used in the warning message.
+
+        Returns
+        -------
+        list of (str, object) tuples
+            Name and instance of each backend, or None if the backend
+            failed, in the same order as given.
+        """
+        options = self.options
+        parallel = not (options.interactive or options.verbose or
+                        options.vv or options.vvv)
+        results = misc.run_parallel([
+            (lambda cls=cls: cls(options=options))
+            for (name, cls, desc) in backends], parallel)
+
+        probed = []
+        for (name, cls, desc), (backend, err) in zip(backends, results):
+            if err is not None and not isinstance(err, RuntimeError):
+                raise err
+            if err is not None:
+                PR.warn(err)
+                PR.warn("Can not get information about {0}".format(desc))
+            probed.append((name, backend))
+        return probed
+
     def reinitialize(self):
+        misc.invalidate_caches()
         self.__init__(self.options)
 
     def _apply_prefix_filter(self):
@@ -1247,6 +1595,16 @@ class Storage(object):
         self.attrs - list of attribute keys to print out
         self.types - types of the attributes to print out (str, or float/int)
         """
+        lines = self.summary(cond, more_data, cond_func)
+        if len(lines) == 0:
+            return
+
+        misc.ptable(lines, zip(self.header, self.types))
+
+    def summary(self, cond=None, more_data=None, cond_func=None):
+        """
+        Return lines of the information table psummary() prints.
+        """
         lines = []
 
         if cond == "fs_only":
@@ -1280,10 +1638,7 @@ class Storage(object):
             lines.append(line)
             index += 1
 
-        if len(lines) == 0:
-            return
-
-        misc.ptable(lines, zip(self.header, self.types))
+        return lines
 
 
 class Pool(Storage):
@@ -1292,29 +1647,20 @@ class Pool(Storage):
     it should be registered within this class with appropriate name.
     """
 
+    # Attributes printed in the table
+    ATTRS = ['pool_name', 'type', 'dev_count', 'pool_free',
+             'pool_used', 'pool_size', 'parent_pool']
+
     def __init__(self, *args, **kwargs):
         super(Pool, self).__init__(*args, **kwargs)
 
-        try:
-            self._data['lvm'] = lvm.VgsInfo(options=self.options)
-        except RuntimeError as err:
-            PR.warn(err)
-            PR.warn("Can not get information about LVM pools")
-        try:
-            self._data['thin'] = lvm.ThinPool(options=self.options)
-        except RuntimeError as err:
-            PR.warn(err)
-            PR.warn("Can not get information about thin pools")
-        try:
-            self._data['btrfs'] = btrfs.BtrfsPool(options=self.options)
-        except RuntimeError as err:
-            PR.warn(err)
-            PR.warn("Can not get information about btrfs pools")
-        try:
-            self._data['crypt'] = crypt.DmCryptPool(options=self.options)
-        except RuntimeError as err:
-            PR.warn(err)
-            PR.warn("Can not get information about crypt pools")
+        for name, backend in self._probe_backends([
+                ('lvm', lvm.VgsInfo, "LVM pools"),
+                ('thin', lvm.ThinPool, "thin pools"),
+                ('btrfs', btrfs.BtrfsPool, "btrfs pools"),
+                ('crypt', crypt.DmCryptPool, "crypt pools")]):
+            if backend is not None:
+                self._data[name] = backend
 
         self.item_cls = PoolItem
 
@@ -1325,8 +1671,7 @@ class Pool(Storage):
                 source=self)
         self.header = ['Pool', 'Type', 'Devices', 'Free', 'Used',
                        'Total', 'Parent']
-        self.attrs = ['pool_name', 'type', 'dev_count', 'pool_free',
-                      'pool_used', 'pool_size', 'parent_pool']
+        self.attrs = list(self.ATTRS)
         self.types = [str, str, str, float, float, float, str]
         self._apply_prefix_filter()
 
@@ -1342,54 +1687,29 @@ class Devices(Storage):
     backed discovers new devices, it should add them as a new entry.
     """
 
+    # Attributes printed in the table
+    ATTRS = ['dev_name', 'dev_free', 'dev_used', 'dev_size',
+             'pool_name', 'mount']
+
     def __init__(self, *args, **kwargs):
         super(Devices, self).__init__(*args, **kwargs)
 
-        try:
-            my_lvm = lvm.PvsInfo(options=self.options)
-        except RuntimeError as err:
-            PR.warn(err)
-            PR.warn("Can not get information about LVM physical volumes")
-        try:
-            my_btrfs = btrfs.BtrfsDev(options=self.options)
-        except RuntimeError as err:
-            PR.warn(err)
-            PR.warn("Can not get information about btrfs devices")
-            my_btrfs = Struct()
-            my_btrfs.data = {}
-        try:
-            my_md = md.MdRaidDevice(options=self.options)
-        except RuntimeError as err:
-            PR.warn(err)
-            PR.warn("Can not get information about MD devices")
-            my_md = Struct()
-            my_md.data = {}
-        try:
-            my_crypt = crypt.DmCryptDevice(options=self.options)
-        except RuntimeError as err:
-            PR.warn(err)
-            PR.warn("Can not get information about crypt devices")
-            my_crypt = Struct()
-            my_crypt.data = {}
-        try:
-            my_multipath = multipath.MultipathDevice(options=self.options)
-        except RuntimeError as err:
-            PR.warn(err)
-            PR.warn("Can not get information about multipath devices")
-            my_multipath = Struct()
-            my_multipath.data = {}
-
-        self._data['dev'] = DeviceInfo(data=dict(list(my_lvm.data.items()) +
-                                                 list(my_btrfs.data.items()) +
-                                                 list(my_md.data.items()) +
-                                                 list(my_crypt.data.items()) +
-                                                 list(my_multipath.data.items())),
-                                       options=self.options)
+        data = []
+        for name, backend in self._probe_backends([
+                ('lvm', lvm.PvsInfo, "LVM physical volumes"),
+                ('btrfs', btrfs.BtrfsDev, "btrfs devices"),
+                ('md', md.MdRaidDevice, "MD devices"),
+                ('crypt', crypt.DmCryptDevice, "crypt devices"),
+                ('multipath', multipath.MultipathDevice,
+                 "multipath devices")]):
+            if backend is not None:
+                data.extend(backend.data.items())
+
+        self._data['dev'] = DeviceInfo(data=dict(data), options=self.options)
         self.item_cls = DeviceItem
         self.header = ['Device', 'Free', 'Used',
                        'Total', 'Pool', 'Mount point']
-        self.attrs = ['dev_name', 'dev_free', 'dev_used', 'dev_size',
-                      'pool_name', 'mount']
+        self.attrs = list(self.ATTRS)
         self.types = [str, float, float, float, str, str]
         self._apply_prefix_filter()
 
@@ -1400,35 +1720,25 @@ class Volumes(Storage):
     it should be registered withing this class with appropriate name.
     """
 
+    # Attributes printed in the table
+    ATTRS = ['dev_name', 'pool_name', 'vol_size', 'fs_type',
+             'fs_size', 'fs_free', 'type', 'mount']
+
     def __init__(self, *args, **kwargs):
         super(Volumes, self).__init__(*args, **kwargs)
 
-        try:
-            self._data['lvm'] = lvm.LvsInfo(options=self.options)
-        except RuntimeError as err:
-            PR.warn(err)
-            PR.warn("Can not get information about LVM volumes")
-        try:
-            self._data['crypt'] = crypt.DmCryptVolume(options=self.options)
-        except RuntimeError as err:
-            PR.warn(err)
-            PR.warn("Can not get information about crypt volumes")
-        try:
-            self._data['btrfs'] = btrfs.BtrfsVolume(options=self.options)
-        except RuntimeError as err:
-            PR.warn(err)
-            PR.warn("Can not get information about btrfs volumes")
-        try:
-            self._data['md'] = md.MdRaidVolume(options=self.options)
-        except RuntimeError as err:
-            PR.warn(err)
-            PR.warn("Can not get information about md raid volumes")
+        for name, backend in self._probe_backends([
+                ('lvm', lvm.LvsInfo, "LVM volumes"),
+                ('crypt', crypt.DmCryptVolume, "crypt volumes"),
+                ('btrfs', btrfs.BtrfsVolume, "btrfs volumes"),
+                ('md', md.MdRaidVolume, "md raid volumes")]):
+            if backend is not None:
+                self._data[name] = backend
 
         self.item_cls = VolumeItem
         self.header = ['Volume', 'Pool', 'Volume size', 'FS', 'FS size',
                        'Free', 'Type', 'Mount point']
-        self.attrs = ['dev_name', 'pool_name', 'vol_size', 'fs_type',
-                      'fs_size', 'fs_free', 'type', 'mount']
+        self.attrs = list(self.ATTRS)
         self.types = [str, str, float, str, float, float, str, str]
         self._apply_prefix_filter()
 
@@ -1440,25 +1750,23 @@ class Snapshots(Storage):
     within this class with appropriate name.
     """
 
+    # Attributes printed in the table
+    ATTRS = ['dev_name', 'origin', 'pool_name', 'vol_size',
+             'snap_size', 'type', 'mount']
+
     def __init__(self, *args, **kwargs):
         super(Snapshots, self).__init__(*args, **kwargs)
 
-        try:
-            self._data['lvm'] = lvm.SnapInfo(options=self.options)
-        except RuntimeError as err:
-            PR.warn(err)
-            PR.warn("Can not get information about LVM snapshots")
-        try:
-            self._data['btrfs'] = btrfs.BtrfsSnap(options=self.options)
-        except RuntimeError as err:
-            PR.warn(err)
-            PR.warn("Can not get information about btrfs snapshots")
+        for name, backend in self._probe_backends([
+                ('lvm', lvm.SnapInfo, "LVM snapshots"),
+                ('btrfs', btrfs.BtrfsSnap, "btrfs snapshots")]):
+            if backend is not None:
+                self._data[name] = backend
 
         self.item_cls = SnapshotItem
         self.header = ['Snapshot', 'Origin', 'Pool', 'Volume size', 'Used',
                        'Type', 'Mount point']
-        self.attrs = ['dev_name', 'origin', 'pool_name', 'vol_size',
-                      'snap_size', 'type', 'mount']
+        self.attrs = list(self.ATTRS)
         self.types = [str, str, str, float, float, str, str]
         self._apply_prefix_filter()
 
@@ -1468,19 +1776,22 @@ def create_graph(pools, devices, volumes, snapshots):
         oriented graph. That allows us to get related Items and their info
         from every Item.
     """
-    def find_node(name, source):
-        """ Search items of class node_cls and try to find one
-            with specific name.
-        """
+    # Map every name of the items in each source to the first item of the
+    # source with such name, so that parents can be found without walking
+    # through all the items again.
+    indexes = []
+    for source in [pools, volumes, devices, snapshots]:
+        index = {}
         for item in source:
-            if item.matches_name(name):
-                return item
-        return None
+            for name in item.names:
+                index.setdefault(name, item)
+        indexes.append(index)
 
     def find_parents(item, parent_fields, child_fields):
         for field in parent_fields:
-            for source in [pools, volumes, devices, snapshots]:
-                parent = find_node(item[field], source)
+            name = item[field]
+            for index in indexes:
+                parent = index.get(name)
                 if not parent or item == parent:
                     continue
                 item.add_parent(parent)
@@ -1523,6 +1834,9 @@ class StorageHandle(object):
     """
 
     def __init__(self, options=Options()):
+        # Do not reuse anything we might have learned about the storage
+        # in the previous run
+        misc.invalidate_caches()
         self._mpoint = None
         self._dev = None
         self._pool = None
@@ -1606,7 +1920,10 @@ class StorageHandle(object):
         if self.options.verbose:
             if fstype in EXTN:
                 command.insert(1, '-v')
-        return misc.run(command, stdout=True)[0]
+        try:
+            return misc.run(command, stdout=True)[0]
+        finally:
+            misc.invalidate_caches()
 
     def _do_mount(self, volume, options=None, directory=None):
         if directory is None:
@@ -2015,22 +2332,91 @@ class StorageHandle(object):
     def list(self, args):
         """
         List devices, pools, volumes
+
+        With SSM_LIST_CACHE enabled, the printed tables are stored in the
+        on-disk cache along with misc.get_topology_stamp() and printed
+        again as long as the stamp does not change. Commands changing the
+        storage drop the cache, see main(). The stamp does not cover the
+        usage, so the free and used space of file systems, thin pools and
+        snapshots are printed as they were when the tables were stored.
         """
+        # Source of each table, its condition and whether to list file
+        # systems on devices as well
         if not args.type:
-            self.dev.psummary()
-            self.pool.psummary()
-            self.vol.psummary(more_data=self.dev.filesystems())
-            self.snap.psummary()
+            tables = [('dev', None, False), ('pool', None, False),
+                      ('vol', None, True), ('snap', None, False)]
         elif args.type in ['fs', 'filesystems']:
-            self.vol.psummary(more_data=self.dev.filesystems(), cond="fs_only")
+            tables = [('vol', "fs_only", True)]
         elif args.type in ['dev', 'devices']:
-            self.dev.psummary()
+            tables = [('dev', None, False)]
         elif args.type in ["volumes", "vol"]:
-            self.vol.psummary(more_data=self.dev.filesystems())
+            tables = [('vol', None, True)]
         elif args.type in ["pool", "pools"]:
-            self.pool.psummary()
+            tables = [('pool', None, False)]
         elif args.type in ['snap', 'snapshots']:
-            self.snap.psummary()
+            tables = [('snap', None, False)]
+        else:
+            return
+
+        list_type = args.type or ""
+        stamp = None
+        if SSM_LIST_CACHE:
+            stamp = misc.get_topology_stamp()
+        if stamp is not None:
+            stamp = "{0}:{1}:{2}:{3}".format(VERSION, SSM_DEFAULT_BACKEND,
+                                             SSM_PREFIX_FILTER, stamp)
+            cache = misc.load_cache("list")
+            if not cache or cache.get('stamp') != stamp:
+                cache = {'stamp': stamp, 'tables': {}}
+            if list_type in cache['tables']:
+                types = {'str': str, 'int': int, 'float': float}
+                for header, types_names, lines in cache['tables'][list_type]:
+                    misc.ptable([tuple(line) for line in lines],
+                                zip(header, [types[name]
+                                             for name in types_names]))
+                return
+
+        # Only gather what the tables are going to print
+        plan_orig = self.options.plan
+        self.options.plan = self._list_plan(tables)
+        printed = []
+        try:
+            for name, cond, with_fs in tables:
+                source = getattr(self, name)
+                more_data = None
+                if with_fs:
+                    more_data = self.dev.filesystems()
+                lines = source.summary(cond=cond, more_data=more_data)
+                if len(lines) > 0:
+                    misc.ptable(lines, zip(source.header, source.types))
+                printed.append((source.header,
+                                [t.__name__ for t in source.types], lines))
+        finally:
+            self.options.plan = plan_orig
+
+        if stamp is not None:
+            cache['tables'][list_type] = printed
+            misc.store_cache("list", cache)
+
+    def _list_plan(self, tables):
+        """
+        Return the ListPlan for the tables list() is going to print.
+
+        The plan only leaves out the expensive columns of the backends
+        (ListPlan.PROBES). Every backend of a printed table is still probed:
+        the md, crypt and multipath backends of Devices tell which pool
+        each device belongs to, so they feed the table whatever its
+        columns are.
+        """
+        classes = {'dev': Devices, 'pool': Pool, 'vol': Volumes,
+                   'snap': Snapshots}
+        attrs = []
+        for name, cond, with_fs in tables:
+            attrs.extend(classes[name].ATTRS)
+            # File systems on devices are listed in the same table
+            if with_fs or cond == "fs_only":
+                attrs.extend(ListPlan.PROBES['fs_info'])
+        return ListPlan(attrs)
 
     def info(self, args):
         """
@@ -2626,6 +3012,14 @@ class SsmParser(object):
                      "({0}).".format(",".join(SUPPORTED_BACKENDS)),
                 choices=SUPPORTED_BACKENDS,
                 action=SetBackend)
+        parser.add_argument('--profile', nargs=0, default=False,
+                help="Print time spent running each of the external " +
+                     "commands when ssm finishes.",
+                action=SetProfile)
+        parser.add_argument('--profile-json', metavar='FILE',
+                help="The same as --profile, but also write details " +
+                     "about every command into FILE in json format.",
+                action=SetProfile)
         parser.add_argument('-n', '--dry-run',
                 help='''Dry run. Do not do anything, just parse the command
                      line options and gather system information if necessary.
@@ -2923,15 +3317,27 @@ def main(args=None):
     #storage.set_globals(args.force, args.verbose, args.yes, args.config)
     storage.set_globals(options)
 
+    # Print the profile after everything else, including the clean-up
+    if misc.SSM_PROFILE:
+        atexit.register(misc.print_profile, args.profile_json)
+
     # Register clean-up function on exit
     atexit.register(misc.do_cleanup)
 
     if args.dry_run:
         return 0
 
+    # Anything but listing might change the storage
+    readonly = args.func in [storage.list, storage.info]
+    if not readonly:
+        misc.drop_cache("list")
+
     try:
         args.func(args)
     except argparse.ArgumentTypeError as ex:
         ssm_parser.parser.error(ex)
+    finally:
+        if not readonly:
+            misc.drop_cache("list")
 
     return 0
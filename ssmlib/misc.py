@@ -20,7 +20,15 @@ from __future__ import print_function
 import os
 import re
 import sys
+import atexit
+import errno
+import json
 import stat
+import time
+import uuid
+import struct
+import hashlib
+import resource
 import tempfile
 import threading
 import subprocess
@@ -42,6 +50,47 @@ TMP_MOUNTED = []
 VERBOSE_VV_FLAG = False
 VERBOSE_VVV_FLAG = False
 
+# Functions dropping information about the system storage which has been
+# cached for the current ssm invocation. See invalidate_caches().
+CACHE_INVALIDATORS = []
+
+# Directory where ssm can keep information across invocations. Setting it
+# to an empty string disables the on-disk caches.
+try:
+    SSM_CACHE_DIR = os.environ['SSM_CACHE_DIR']
+except KeyError:
+    SSM_CACHE_DIR = "/run/ssm"
+
+# Enumerate block devices by walking SYSFS_BLOCK instead of running lsblk
+try:
+    SSM_SYSFS = os.environ['SSM_SYSFS']
+    if SSM_SYSFS.upper() in ['NO', 'FALSE', '0']:
+        SSM_SYSFS = False
+    else:
+        SSM_SYSFS = True
+except KeyError:
+    SSM_SYSFS = True
+
+SYSFS_BLOCK = "/sys/class/block"
+
+# Record every external command ssm runs and print the summary on exit.
+# See profile_command() and print_profile().
+try:
+    SSM_PROFILE = os.environ['SSM_PROFILE']
+    SSM_PROFILE = SSM_PROFILE.upper() in ['YES', 'TRUE', '1']
+except KeyError:
+    SSM_PROFILE = False
+
+PROFILE_RECORDS = []
+PROFILE_LOCK = threading.Lock()
+
+# Results of find_binary() for the current ssm invocation
+BINARY_PATHS = {}
+# Whether BINARY_PATHS has new results to be stored in the on-disk cache
+BINARY_PATHS_CHANGED = False
+# Tools we have already warned about not being executable
+NOT_EXECUTABLE = set()
+
 if sys.version < '3':
     def __str__(x):
         if x is not None:
@@ -52,6 +101,23 @@ else:
             return str(x, encoding='utf-8', errors='strict')
 
 
+def register_cache(invalidate):
+    """
+    Register function which drops cached storage information. It is
+    going to be called from invalidate_caches().
+    """
+    CACHE_INVALIDATORS.append(invalidate)
+
+
+def invalidate_caches():
+    """
+    Drop all the cached information about the system storage. This needs to
+    be called whenever the storage configuration might have changed.
+    """
+    for invalidate in CACHE_INVALIDATORS:
+        invalidate()
+
+
 def get_unit_size(string):
     """
     Check the last character of the string for the unit and return the tuple
@@ -254,11 +320,185 @@ def get_file_size(path):
         return os.lseek(f.fileno(), os.SEEK_SET, os.SEEK_END) // 1024
 
 
+def load_cache(name):
+    """
+    Return data stored with store_cache() under the given name, or None if
+    there are none, or the on-disk cache is disabled. The cache directory
+    is only trusted if it is owned by us and nobody else can write to it.
+    """
+    if not SSM_CACHE_DIR:
+        return None
+    try:
+        st = os.stat(SSM_CACHE_DIR)
+        if st.st_uid != os.getuid() or \
+           st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            return None
+        with open(os.path.join(SSM_CACHE_DIR, name + ".json"), 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def store_cache(name, data):
+    """
+    Store json serializable data into the on-disk cache under the given
+    name. Failures are silently ignored, the cache is just an optimization.
+    """
+    if not SSM_CACHE_DIR:
+        return
+    try:
+        if not os.path.isdir(SSM_CACHE_DIR):
+            os.makedirs(SSM_CACHE_DIR, 0o700)
+        fd, tmp = tempfile.mkstemp(dir=SSM_CACHE_DIR)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, os.path.join(SSM_CACHE_DIR, name + ".json"))
+    except (IOError, OSError, TypeError, ValueError):
+        pass
+
+
+def drop_cache(name):
+    """ Remove data stored with store_cache() under the given name. """
+    if not SSM_CACHE_DIR:
+        return
+    try:
+        os.unlink(os.path.join(SSM_CACHE_DIR, name + ".json"))
+    except OSError:
+        pass
+
+
+def _path_dirs():
+    return [directory.strip('"') or '.' for directory in
+            os.environ.get('PATH', os.defpath).split(os.pathsep)]
+
+
+def _path_stamp():
+    stamp = {}
+    for directory in _path_dirs():
+        try:
+            stamp[directory] = os.stat(directory).st_mtime
+        except OSError:
+            stamp[directory] = None
+    return stamp
+
+
+def _load_binary_paths():
+    """
+    Fill BINARY_PATHS from the on-disk cache, unless any of the directories
+    in PATH has changed since the cache was written.
+    """
+    cache = load_cache("binaries")
+    if not cache or cache.get('path') != os.environ.get('PATH') or \
+       cache.get('stamp') != _path_stamp():
+        return
+    for name, (path, executable) in cache.get('binaries', {}).items():
+        # Permissions can change without the directory being modified
+        if path and executable != os.access(path, os.X_OK):
+            continue
+        BINARY_PATHS.setdefault(name, (path, executable))
+
+
+def find_binary(name):
+    """
+    Find the tool in PATH the same way the shell would do, without running
+    any external command.
+
+    Returns
+    -------
+    (str, bool)
+        Path to the tool and whether it is executable. Path is None if
+        there is no such file in PATH at all. If there are only files which
+        are not executable, path to the first one is returned.
+    """
+    if name in BINARY_PATHS:
+        return BINARY_PATHS[name]
+    if not BINARY_PATHS:
+        _load_binary_paths()
+        if name in BINARY_PATHS:
+            return BINARY_PATHS[name]
+
+    if os.sep in name:
+        candidates = [name]
+    else:
+        candidates = [os.path.join(directory, name)
+                      for directory in _path_dirs()]
+    found = (None, False)
+    for path in candidates:
+        if not os.path.isfile(path):
+            continue
+        if os.access(path, os.X_OK):
+            found = (path, True)
+            break
+        if found[0] is None:
+            found = (path, False)
+
+    global BINARY_PATHS_CHANGED
+    BINARY_PATHS[name] = found
+    # All the new results are stored at once when ssm finishes
+    if not BINARY_PATHS_CHANGED:
+        BINARY_PATHS_CHANGED = True
+        atexit.register(store_binary_paths)
+    return found
+
+
+def store_binary_paths():
+    """ Store the new results of find_binary() in the on-disk cache. """
+    global BINARY_PATHS_CHANGED
+    if not BINARY_PATHS_CHANGED:
+        return
+    BINARY_PATHS_CHANGED = False
+    store_cache("binaries", {'path': os.environ.get('PATH'),
+                             'stamp': _path_stamp(),
+                             'binaries': dict(BINARY_PATHS)})
+
+
+# Serializes detection of the tool versions, which backends probing in
+# parallel remember in their module globals
+TOOL_VERSION_LOCK = threading.RLock()
+
+
+def get_tool_version(name, probe, unknown):
+    """
+    Return version of the tool as detected by probe(). The result is
+    remembered in the on-disk cache keyed by path, inode and mtime of the
+    tool binary, so the tool is only run again once it has been replaced.
+
+    Parameters
+    ----------
+    name : str
+        Name of the tool binary to look up in PATH
+    probe : callable
+        Function running the tool and returning its parsed version
+    unknown
+        Value probe() returns when the version could not be determined,
+        such result is never cached
+    """
+    path = find_binary(name)[0]
+    key = None
+    if path:
+        try:
+            st = os.stat(path)
+            key = "{0}:{1}:{2}".format(path, st.st_ino, st.st_mtime)
+        except OSError:
+            pass
+    cache = load_cache("versions") or {}
+    if key and key in cache:
+        return cache[key]
+
+    version = probe()
+    if key and version != unknown:
+        cache[key] = version
+        store_cache("versions", cache)
+    return version
+
+
 def check_binary(name):
-    command = ['which', name]
-    if run(command, can_fail=True)[0]:
-        return False
-    return True
+    path, executable = find_binary(name)
+    if path and not executable and path not in NOT_EXECUTABLE:
+        NOT_EXECUTABLE.add(path)
+        sys.stderr.write("SSM Warning: '{0}' ".format(path) +
+                         "is not executable!\n")
+    return executable
 
 
 def do_mount(device, directory, options=None):
@@ -267,6 +507,8 @@ def do_mount(device, directory, options=None):
         command.extend(['-o', options])
     command.extend([device, directory])
     run(command)
+    # Only the mounts have changed
+    SNAPSHOT.invalidate()
 
 
 def do_umount(mpoint, all_targets=False):
@@ -278,6 +520,8 @@ def do_umount(mpoint, all_targets=False):
     except RuntimeError:
         command.append('-l')
         run(command + mpoint)
+    finally:
+        SNAPSHOT.invalidate()
 
 
 def temp_mount(device, options=None):
@@ -302,7 +546,31 @@ def do_cleanup():
             break
 
 
-def get_signature(device, types=None):
+# Usage of the signature types as blkid -u sees them, see _signature_usage()
+SIGNATURE_USAGE = {
+    'crypto': ['crypto_LUKS', 'BitLocker'],
+    'raid': ['LVM2_member'],
+    'other': ['swap', 'swsuspend', 'bcache'],
+    'filesystem': ['ext2', 'ext3', 'ext4', 'ext4dev', 'xfs', 'btrfs', 'vfat',
+                   'exfat', 'ntfs', 'iso9660', 'udf', 'f2fs', 'reiserfs',
+                   'jfs', 'squashfs', 'hfs', 'hfsplus', 'nilfs2', 'minix',
+                   'erofs', 'gfs2', 'ocfs2', 'cramfs']}
+
+
+def _signature_usage(fstype):
+    """
+    Return the blkid usage of the signature type as blkid -u sees it, or
+    None if the type is not known.
+    """
+    for usage, types in SIGNATURE_USAGE.items():
+        if fstype in types:
+            return usage
+    if fstype.endswith("_raid_member"):
+        return "raid"
+    return None
+
+
+def _probe_signature(device, types=None):
     command = ["blkid", "-o", "value", "-p", "-s", "TYPE"]
     if types is not None:
         command.extend(['-u', types])
@@ -316,10 +584,172 @@ def get_signature(device, types=None):
     return output
 
 
+def _unescape_lsblk(value):
+    # lsblk escapes each byte of unsafe characters as \xNN
+    data = re.sub(b"\\\\x([0-9a-fA-F]{2})",
+                  lambda match: bytes(bytearray([int(match.group(1), 16)])),
+                  value.encode('utf-8'))
+    return data.decode('utf-8', 'replace')
+
+
+def _probe_signatures(devices):
+    """
+    Probe the signatures on all the devices by a single 'blkid -p'. Return
+    dictionary of signatures as SystemSnapshot.signatures() does, indexed
+    by the device. Devices without any signature, or which could not be
+    read, are left out. Return None if blkid can not be used at all.
+    """
+    if not devices or not check_binary("blkid"):
+        return None
+    try:
+        ret, output, err = run(["blkid", "-p", "-o", "export"] + devices,
+                               can_fail=True, stderr=False)
+    except (OSError, problem.CommandFailed):
+        return None
+    # 2 means that nothing was found, 8 that some device is ambivalent
+    if ret not in [0, 2, 8]:
+        return None
+
+    signatures = {}
+    row = {}
+    for line in (output or "").splitlines() + [""]:
+        if "=" in line:
+            key, value = line.split("=", 1)
+            # Shell unsafe characters are escaped by backslash
+            row[key] = re.sub(r"\\(.)", r"\1", value)
+            continue
+        if row.get('DEVNAME') and row.get('TYPE'):
+            signatures[row['DEVNAME']] = {
+                'TYPE': row['TYPE'],
+                'USAGE': row.get('USAGE') or _signature_usage(row['TYPE']),
+                'UUID': row.get('UUID', ""),
+                'LABEL': row.get('LABEL', "")}
+        row = {}
+    return signatures
+
+
+def get_signature(device, types=None):
+    """
+    Return type of the signature found on the device, or None if there is
+    none. The signatures of all the block devices are gathered at once, see
+    SystemSnapshot.signatures(), only devices unknown to lsblk are probed
+    by blkid separately.
+
+    Parameters
+    ----------
+    device : str
+        Path to the device
+    types : str, optional
+        Comma separated list of signature usages to consider, such as
+        "filesystem", in the same format blkid -u accepts
+    """
+    signatures = SNAPSHOT.signatures()
+    signature = signatures.get(device) or \
+        signatures.get(os.path.realpath(device))
+    if signature is None:
+        return _probe_signature(device, types)
+
+    if not signature['TYPE']:
+        return None
+    if types is not None and signature['USAGE'] is None:
+        # Only blkid knows what the signature is used for
+        return _probe_signature(device, types)
+    if types is not None:
+        types = types.split(",")
+        if all([usage.startswith("no") for usage in types]):
+            if "no" + signature['USAGE'] in types:
+                return None
+        elif signature['USAGE'] not in types:
+            return None
+    return signature['TYPE']
+
+
 def get_fs_type(device):
     return get_signature(device, "filesystem")
 
 
+# Layout of the ext2/3/4 superblock which starts 1024 bytes into the device
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_SUPERBLOCK_MAGIC = 0xEF53
+EXT_SUPERBLOCK = struct.Struct("<7L28xH38xL4x16s16s")
+EXT_SUPERBLOCK_HI = struct.Struct("<3L")
+EXT_SUPERBLOCK_HI_OFFSET = 0x150
+EXT_FEATURE_INCOMPAT_64BIT = 0x80
+
+# Layout of the beginning of the XFS superblock at the start of the device
+XFS_SUPERBLOCK_MAGIC = b"XFSB"
+XFS_SUPERBLOCK = struct.Struct(">4sLQ16x16s40xL4xL8x12s24xQ")
+
+
+def _read_superblock(device, offset, size):
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        return os.pread(fd, size, offset)
+    finally:
+        os.close(fd)
+
+
+def _superblock_string(data):
+    return __str__(data.split(b"\0", 1)[0])
+
+
+def read_ext_superblock(device):
+    """
+    Read the superblock of the ext2/3/4 file system on the device. Return
+    dictionary with 'block_size' in bytes, 'block_count', 'free_blocks',
+    'reserved_blocks', 'uuid' and 'label' of the file system, or None if
+    there is no ext file system on the device.
+    """
+    try:
+        data = _read_superblock(device, EXT_SUPERBLOCK_OFFSET,
+                                EXT_SUPERBLOCK_HI_OFFSET +
+                                EXT_SUPERBLOCK_HI.size)
+        (inodes, blocks, reserved, free, free_inodes, first_data_block,
+         log_block_size, magic, incompat, fs_uuid, label) = \
+            EXT_SUPERBLOCK.unpack_from(data)
+    except (IOError, OSError, struct.error):
+        return None
+    if magic != EXT_SUPERBLOCK_MAGIC:
+        return None
+    if incompat & EXT_FEATURE_INCOMPAT_64BIT:
+        blocks_hi, reserved_hi, free_hi = EXT_SUPERBLOCK_HI.unpack_from(
+            data, EXT_SUPERBLOCK_HI_OFFSET)
+        blocks |= blocks_hi << 32
+        reserved |= reserved_hi << 32
+        free |= free_hi << 32
+    return {'block_size': 1024 << log_block_size,
+            'block_count': blocks,
+            'free_blocks': free,
+            'reserved_blocks': reserved,
+            'uuid': str(uuid.UUID(bytes=fs_uuid)),
+            'label': _superblock_string(label)}
+
+
+def read_xfs_superblock(device):
+    """
+    Read the primary superblock of the XFS file system on the device. Return
+    dictionary as read_ext_superblock() does with the 'log_blocks' and the
+    'ag_count' of the file system in addition, or None if there is no XFS
+    file system on the device.
+    """
+    try:
+        data = _read_superblock(device, 0, XFS_SUPERBLOCK.size)
+        (magic, block_size, blocks, fs_uuid, ag_count, log_blocks, label,
+         free) = XFS_SUPERBLOCK.unpack_from(data)
+    except (IOError, OSError, struct.error):
+        return None
+    if magic != XFS_SUPERBLOCK_MAGIC:
+        return None
+    return {'block_size': block_size,
+            'block_count': blocks,
+            'free_blocks': free,
+            'reserved_blocks': 0,
+            'log_blocks': log_blocks,
+            'ag_count': ag_count,
+            'uuid': str(uuid.UUID(bytes=fs_uuid)),
+            'label': _superblock_string(label)}
+
+
 def get_real_device(device):
     if os.path.islink(device):
         return os.path.abspath(os.path.join(os.path.dirname(device),
@@ -327,86 +757,351 @@ def get_real_device(device):
     return device
 
 
+class SystemSnapshot(object):
+    """
+    Kernel view of the system storage gathered once per ssm invocation.
+
+    Block devices listed by lsblk, their signatures probed by blkid,
+    /proc/self/mountinfo (or /proc/mounts), /proc/swaps and /proc/devices
+    are each read only once, on first use,
+    and indexed so that all the backends can query them as many times as
+    they need to. Everything is thrown away by invalidate(), which is
+    registered with invalidate_caches() and hence called after each change
+    ssm makes to the storage.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.invalidate()
+
+    def invalidate(self):
+        with self.lock:
+            self._partitions = None
+            self._signatures = None
+            self._mounts = None
+            self._swaps = None
+            self._devices = None
+
+    def partitions(self):
+        """ Rows of [major, minor, size in kB, kname, name, parent kname] """
+        with self.lock:
+            if self._partitions is None:
+                self._partitions = self._read_partitions()
+            return [list(row) for row in self._partitions]
+
+    def signatures(self):
+        """
+        Dictionary of signatures found on the block devices, indexed by both
+        kernel and device mapper name of the device. Each signature is a
+        dictionary with TYPE, USAGE, UUID and LABEL, where TYPE is empty if
+        there is no signature on the device.
+        """
+        with self.lock:
+            if self._signatures is None:
+                self._signatures = self._read_signatures()
+            return self._signatures
+
+    def mounts(self):
+        """ List of (line, device, row) tuples, one for each mount """
+        with self.lock:
+            if self._mounts is None:
+                if os.path.exists("/proc/self/mountinfo"):
+                    self._mounts = self._read_mountinfo()
+                else:
+                    self._mounts = self._read_mounts()
+            return self._mounts
+
+    def swaps(self):
+        with self.lock:
+            if self._swaps is None:
+                self._swaps = []
+                with open('/proc/swaps', 'r') as f:
+                    for line in f.readlines()[1:]:
+                        self._swaps.append(line.split())
+            return [list(swap) for swap in self._swaps]
+
+    def devices(self):
+        """ Dictionary of block device driver names and their major numbers """
+        with self.lock:
+            if self._devices is None:
+                self._devices = {}
+                block = False
+                with open('/proc/devices', 'r') as f:
+                    for line in f:
+                        if line.startswith("Block devices:"):
+                            block = True
+                            continue
+                        array = line.split()
+                        if len(array) != 2:
+                            continue
+                        # Block device numbers take precedence
+                        if block or array[1] not in self._devices:
+                            self._devices[array[1]] = array[0]
+            return self._devices
+
+    def _read_partitions(self):
+        if SSM_SYSFS and os.path.isdir(SYSFS_BLOCK):
+            try:
+                return self._read_sysfs_partitions()
+            except (IOError, OSError, ValueError):
+                pass
+        return self._read_lsblk_partitions()
+
+    @staticmethod
+    def _read_sysfs_attr(path, *names):
+        with open(os.path.join(path, *names), 'r') as f:
+            return f.read().strip()
+
+    def _read_sysfs_partitions(self):
+        """
+        Produce the same rows as _read_lsblk_partitions() does, without
+        running lsblk. A device is listed once for each of its parents,
+        which is either the whole disk of the partition, or the devices
+        listed in slaves/.
+        """
+        partitions = []
+        for name in sorted(os.listdir(SYSFS_BLOCK)):
+            path = os.path.join(SYSFS_BLOCK, name)
+            major, minor = self._read_sysfs_attr(path, "dev").split(":")
+            # lsblk skips ram disks and loop devices with nothing attached
+            if major == "1":
+                continue
+            if name.startswith("loop") and \
+               not os.path.exists(os.path.join(path, "loop", "backing_file")):
+                continue
+            # Size is always in 512 byte sectors. Empty devices, such as
+            # unused nbd devices, inactive md arrays or card readers
+            # without a card, are skipped by lsblk as well.
+            sectors = int(self._read_sysfs_attr(path, "size"))
+            if sectors == 0:
+                continue
+            size = sectors // 2
+            kname = "/dev/" + name.replace("!", "/")
+            try:
+                devname = "/dev/mapper/" + self._read_sysfs_attr(path, "dm",
+                                                                 "name")
+            except (IOError, OSError):
+                devname = kname
+
+            if os.path.exists(os.path.join(path, "partition")):
+                parents = [os.path.basename(
+                           os.path.dirname(os.path.realpath(path)))]
+            else:
+                try:
+                    parents = sorted(os.listdir(os.path.join(path, "slaves")))
+                except OSError:
+                    parents = []
+
+            row = [major, minor, size, kname, devname]
+            if not parents:
+                partitions.append(row)
+            for parent in parents:
+                partitions.append(row + ["/dev/" + parent.replace("!", "/")])
+        return partitions
+
+    def _read_lsblk_partitions(self):
+        partitions = []
+        new_line = []
+        output = run(["lsblk", "-l", "-b", "-n", "-p", "-o",
+                      "MAJ:MIN,SIZE,KNAME,NAME,PKNAME"], stdout=False)
+
+        for line in output[1].splitlines():
+            new_line = re.split(r'\s+|:', line.strip())
+            # Not every line has the parent device name, but in either case,
+            # if we got data, convert the size to kB
+            if len(new_line) in [5, 6]:
+                new_line[2] = int(new_line[2])//1024
+                partitions.append(new_line)
+            else:
+                pass
+        return partitions
+
+    def _read_signatures(self):
+        """
+        lsblk lists the block devices together with the signatures known
+        to udev. Those may be out of date, or missing entirely without
+        udev, so the signatures are probed by a single 'blkid -p' over all
+        the devices. What lsblk says is used only for devices blkid can
+        not read.
+        """
+        devices = {}
+        output = run(["lsblk", "-P", "-p", "-o",
+                      "KNAME,NAME,FSTYPE,UUID,LABEL"], stdout=False)
+        for line in output[1].splitlines():
+            row = dict([(key, _unescape_lsblk(value)) for key, value
+                        in re.findall(r'(\w+)="([^"]*)"', line)])
+            if 'KNAME' not in row or 'FSTYPE' not in row:
+                continue
+            devices[row['KNAME']] = (row.get('NAME'), {
+                'TYPE': row['FSTYPE'],
+                'USAGE': row['FSTYPE'] and _signature_usage(row['FSTYPE']),
+                'UUID': row.get('UUID', ""),
+                'LABEL': row.get('LABEL', "")})
+
+        probed = _probe_signatures(sorted(devices))
+        signatures = {}
+        for kname, (name, signature) in devices.items():
+            if probed is not None and \
+               (kname in probed or os.access(kname, os.R_OK)):
+                signature = probed.get(kname, {'TYPE': "", 'USAGE': "",
+                                               'UUID': "", 'LABEL': ""})
+            signatures[kname] = signature
+            if name:
+                signatures[name] = signature
+        return signatures
+
+    def _read_mountinfo(self):
+        mounts = []
+        names = ['id', 'parent', 'major_minor', 'root', 'mp', 'options']
+        with open('/proc/self/mountinfo', 'r') as f:
+            for line in f:
+                array = line.split(None, 6)
+                row = dict([(names[index], array[index])
+                            for index in min(
+                                list(range(len(array) - 1)),
+                                list(range(len(names)))
+                            )])
+                array = line.rsplit(None, 3)
+                row['fs'] = array[1]
+                row['dev'] = array[2]
+                row['sb_options'] = array[3]
+                dev = get_real_device(row['dev'])
+                if row['root'] != '/':
+                    dev = "{0}:{1}".format(dev, row['root'])
+                mounts.append((line, dev, row))
+        return mounts
+
+    def _read_mounts(self):
+        mounts = []
+        with open('/proc/mounts', 'r') as f:
+            for line in f:
+                l = line.split()[:2]
+                dev = get_real_device(l[0])
+                mounts.append((line, dev, {'dev': l[0], 'mp': l[1]}))
+        return mounts
+
+# Storage information shared by all the backends
+SNAPSHOT = SystemSnapshot()
+register_cache(SNAPSHOT.invalidate)
+
+
+def _lvm_backup_disabled(lvm_dir):
+    """ Return True if lvm is configured not to keep metadata backups """
+    for name in ["lvm.conf", "lvmlocal.conf"]:
+        try:
+            with open(os.path.join(lvm_dir, name), 'r') as f:
+                if re.search(r'^\s*backup\s*=\s*0\b', f.read(), re.M):
+                    return True
+        except (IOError, OSError):
+            pass
+    return False
+
+
+def get_topology_stamp():
+    """
+    Return a string which changes whenever the storage topology might have
+    changed, or None if it can not be determined. It covers every uevent
+    the kernel sent, mounts, swaps and lvm metadata sequence numbers from
+    the lvm metadata backups. Usage of the file systems, thin pools and
+    snapshots is not covered, it changes without any of those.
+    """
+    try:
+        with open("/sys/kernel/uevent_seqnum", 'r') as f:
+            digest = hashlib.sha1(f.read().strip().encode())
+        for path in ["/proc/self/mountinfo", "/proc/swaps"]:
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    except (IOError, OSError):
+        return None
+
+    lvm_dir = os.environ.get('LVM_SYSTEM_DIR', "/etc/lvm")
+    # lvm metadata changes can not be noticed without the backups
+    if _lvm_backup_disabled(lvm_dir):
+        return None
+    backup = os.path.join(lvm_dir, "backup")
+    try:
+        names = sorted(os.listdir(backup))
+    except OSError as err:
+        # No lvm at all is fine, backups we can not read are not
+        if err.errno != errno.ENOENT:
+            return None
+        names = []
+    for name in names:
+        try:
+            with open(os.path.join(backup, name), 'r') as f:
+                match = re.search(r'^\s*seqno\s*=\s*(\d+)', f.read(), re.M)
+        except (IOError, OSError):
+            return None
+        digest.update("{0}={1}\n".format(
+                      name, match.group(1) if match else "").encode())
+    return digest.hexdigest()
+
+
 def get_swaps():
-    swap = []
-    with open('/proc/swaps', 'r') as f:
-        for line in f.readlines()[1:]:
-            swap.append(line.split())
-    return swap
+    return SNAPSHOT.swaps()
 
 
 def get_partitions():
-    partitions = []
-    new_line = []
-    output = run(["lsblk", "-l", "-b", "-n", "-p", "-o", "MAJ:MIN,SIZE,KNAME,NAME,PKNAME"],
-                 stdout=False)
-
-    for line in output[1].splitlines():
-        new_line = re.split(r'\s+|:', line.strip())
-        # Not every line has the parent device name, but in either case,
-        # if we got data, convert the size to kB
-        if len(new_line) in [5, 6]:
-            new_line[2] = int(new_line[2])//1024
-            partitions.append(new_line)
-        else:
-            pass
-    return partitions
+    return SNAPSHOT.partitions()
 
 
-def get_mountinfo(regex=".*"):
+def _filter_mounts(regex):
     mounts = {}
     reg = re.compile(regex)
-    names = ['id', 'parent', 'major_minor', 'root', 'mp', 'options']
-    with open('/proc/self/mountinfo', 'r') as f:
-        for line in f:
-            m = reg.search(line)
-            if not m:
-                continue
-            array = line.split(None, 6)
-            row = dict([(names[index], array[index])
-                        for index in min(
-                            list(range(len(array) - 1)),
-                            list(range(len(names)))
-                        )])
-            array = line.rsplit(None, 3)
-            row['fs'] = array[1]
-            row['dev'] = array[2]
-            row['sb_options'] = array[3]
-            dev = get_real_device(row['dev'])
-            if row['root'] != '/':
-                dev = "{0}:{1}".format(dev, row['root'])
-            mounts[dev] = row
+    for line, dev, row in SNAPSHOT.mounts():
+        if reg.search(line):
+            mounts[dev] = dict(row)
     return mounts
 
+
+def get_mountinfo(regex=".*"):
+    return _filter_mounts(regex)
+
+
 def get_mounts_old(regex=".*"):
-    mounts = {}
-    reg = re.compile(regex)
-    with open('/proc/mounts', 'r') as f:
-        for line in f:
-            m = reg.search(line)
-            if m:
-                l = line.split()[:2]
-                dev = get_real_device(l[0])
-                mounts[dev] = {'dev': l[0], 'mp': l[1]}
-    return mounts
+    return _filter_mounts(regex)
 
 
 def get_mounts(regex=".*"):
-    if os.path.exists("/proc/self/mountinfo"):
-        return get_mountinfo(regex)
-    return get_mounts_old(regex)
+    return _filter_mounts(regex)
+
+
+class MountIndex(object):
+    """
+    Mount points of all the mounted devices indexed by the real device, as
+    listed by get_mounts(). It is built on the first use and shared by all
+    the users until the storage configuration changes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        with self.lock:
+            self._index = None
+
+    def get(self, device):
+        """ Return the mount of the real device, or None. """
+        with self.lock:
+            if self._index is None:
+                self._index = get_mounts()
+            return self._index.get(device)
+
+MOUNT_INDEX = MountIndex()
+register_cache(MOUNT_INDEX.invalidate)
+
+
+def get_mount_point(device):
+    """ Return the mount point of the device, or None if it is not mounted """
+    mount = MOUNT_INDEX.get(get_real_device(device))
+    if mount:
+        return mount.get('mp')
+    return None
 
 
 def get_dmnumber(name):
-    reg = re.compile(" {0}$".format(name))
-    dmnumber = None
-    with open('/proc/devices', 'r') as f:
-        for line in f:
-            m = reg.search(line)
-            if m:
-                dmnumber = line.split()[0]
-                break
-    return dmnumber
+    return SNAPSHOT.devices().get(name)
 
 def udev_checkpoint(devices):
     if not isinstance(devices, list):
@@ -424,6 +1119,7 @@ def wipefs(devices, signatures):
     # Avoid race with udev
     udev_settle()
     run(command)
+    invalidate_caches()
 
 
 def humanize_size(arg):
@@ -476,6 +1172,133 @@ def humanize_size(arg):
     return ("{0:.2f} {1}").format(size, unit)
 
 
+def _process_cpu_time(pid=None):
+    """
+    Return user and system time in seconds consumed by the process with the
+    given pid, or by all our waited for children if pid is None.
+    """
+    if pid is None:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+    try:
+        with open("/proc/{0}/stat".format(pid), 'r') as f:
+            # The command name may contain spaces, skip past it
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / \
+            float(os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, IndexError, ValueError):
+        return 0.0
+
+
+def _profile_caller():
+    """
+    Return (module, function) of the code the command has been run for,
+    skipping the profiling itself and the run() and run_*() wrappers.
+    """
+    frame = sys._getframe(2)
+    while frame is not None:
+        name = frame.f_code.co_name
+        if name != "run" and not name.startswith("run_"):
+            module = os.path.basename(frame.f_code.co_filename)
+            return (os.path.splitext(module)[0], name)
+        frame = frame.f_back
+    return ("", "")
+
+
+def profile_start(pid=None):
+    """
+    Take the starting point for profile_command(), or return None when the
+    profiling is disabled. When pid is given, cpu time of that process is
+    measured, otherwise of the children we are going to wait for.
+    """
+    if not SSM_PROFILE:
+        return None
+    return (time.time(), _process_cpu_time(pid))
+
+
+def profile_command(cmd, start, exitcode, output_size, pid=None):
+    """
+    Record the command run for the profiling summary.
+
+    Parameters
+    ----------
+    cmd : list of str
+        The command
+    start : tuple
+        Value returned by profile_start() before the command has been run
+    exitcode : int
+        Exit code of the command
+    output_size : int
+        Size of the output the command produced in bytes
+    pid : int, optional
+        Process the command has been run by, the same as given to
+        profile_start()
+
+    Note that the cpu time of the children is accounted for the whole
+    process, so it is only approximate for commands run in parallel.
+    """
+    if not SSM_PROFILE or start is None:
+        return
+    wall = time.time() - start[0]
+    cpu = _process_cpu_time(pid) - start[1]
+    module, caller = _profile_caller()
+    with PROFILE_LOCK:
+        PROFILE_RECORDS.append({'command': list(cmd),
+                                'module': module,
+                                'caller': caller,
+                                'wall': wall,
+                                'cpu': cpu,
+                                'exitcode': exitcode,
+                                'output_size': output_size})
+
+
+def print_profile(json_file=None):
+    """
+    Print summary of the commands recorded by profile_command(), sorted by
+    the cumulative time spent running them. Optionally dump the raw records
+    into json_file as well.
+    """
+    with PROFILE_LOCK:
+        records = list(PROFILE_RECORDS)
+
+    summary = {}
+    for record in records:
+        key = (" ".join(record['command']), record['module'],
+               record['caller'])
+        entry = summary.setdefault(key, {'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                                         'output_size': 0, 'exitcodes': set()})
+        entry['calls'] += 1
+        entry['wall'] += record['wall']
+        entry['cpu'] += record['cpu']
+        entry['output_size'] += record['output_size']
+        entry['exitcodes'].add(record['exitcode'])
+
+    data = []
+    for (command, module, caller), entry in sorted(summary.items(),
+            key=lambda item: item[1]['wall'], reverse=True):
+        data.append(("{0}.{1}".format(module, caller),
+                     str(entry['calls']),
+                     "{0:.3f}".format(entry['wall']),
+                     "{0:.3f}".format(entry['cpu']),
+                     str(entry['output_size']),
+                     ",".join(map(str, sorted(entry['exitcodes']))),
+                     command))
+    ptable(data, [('Caller', str), ('Calls', int), ('Time', float),
+                  ('CPU', float), ('Output', int), ('Exit', str),
+                  ('Command', str)])
+    print("{0} commands, {1:.3f}s total time, {2:.3f}s cpu time".format(
+          len(records), sum([record['wall'] for record in records]),
+          sum([record['cpu'] for record in records])))
+
+    if json_file:
+        try:
+            with open(json_file, 'w') as f:
+                json.dump(records, f, indent=2)
+        except (IOError, OSError) as err:
+            sys.stderr.write("SSM Warning: Unable to write profile " +
+                             "into '{0}': {1}\n".format(json_file, err))
+
+
 def run(cmd, show_cmd=False, stdout=False, stderr=True, can_fail=False,
         stdin_data=None, return_stdout=True):
 
@@ -501,10 +1324,13 @@ def run(cmd, show_cmd=False, stdout=False, stderr=True, can_fail=False,
     if VERBOSE_VV_FLAG:
         print('executing command: {}'.format(' '.join(cmd)))
 
+    start = profile_start()
     proc = subprocess.Popen(cmd, stdout=stdout,
                             stderr=stderr, stdin=stdin, close_fds=True)
 
     output, error = proc.communicate(input=stdin_data)
+    profile_command(cmd, start, proc.returncode,
+                    len(output or b"") + len(error or b""))
 
     err_msg = "ERROR exit code {0} for running command: \"{1}\"".format(
               proc.returncode, " ".join(cmd))
@@ -538,6 +1364,43 @@ def run(cmd, show_cmd=False, stdout=False, stderr=True, can_fail=False,
     return (proc.returncode, __str__(output), __str__(error))
 
 
+def run_parallel(functions, parallel=True):
+    """
+    Call all the functions at once, each in its own thread, and wait for
+    them to finish. Returns list of (result, exception) tuples in the same
+    order as the functions were given, where exception is None if the
+    function did not raise any. Exceptions which are not derived from
+    Exception, such as KeyboardInterrupt or SystemExit, are raised again
+    once all the threads finished. If parallel is False, the functions are
+    called one after another in the calling thread instead.
+    """
+    results = [(None, None)] * len(functions)
+
+    def worker(index, function):
+        try:
+            results[index] = (function(), None)
+        except BaseException as err:
+            results[index] = (None, err)
+
+    if parallel:
+        threads = [threading.Thread(target=worker, args=(index, function))
+                   for index, function in enumerate(functions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        for index, function in enumerate(functions):
+            worker(index, function)
+            err = results[index][1]
+            if err is not None and not isinstance(err, Exception):
+                raise err
+    for result, err in results:
+        if err is not None and not isinstance(err, Exception):
+            raise err
+    return results
+
+
 def chain(*iterables):
     """
     Make an iterator that returns elements from the first iterable until
@@ -816,6 +1679,8 @@ def ptable(data, table_header=None):
 class Node(object):
     """ A simple graph node class """
 
+    __slots__ = ('_neighbours', '_parents', '_children')
+
     def __init__(self):
         self._neighbours = []
         self._parents = []
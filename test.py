@@ -251,7 +251,10 @@ def unit_tests(names):
         tests_ssm = test_loader.loadTestsFromModule(test_ssm)
         tests_misc = test_loader.loadTestsFromModule(test_misc)
         tests_multipath = test_loader.loadTestsFromModule(test_multipath)
-        tests = unittest.TestSuite([tests_lvm, tests_btrfs, tests_ssm, tests_misc, tests_multipath])
+        tests_md = test_loader.loadTestsFromModule(test_md)
+        tests_dm = test_loader.loadTestsFromModule(test_dm)
+        tests = unittest.TestSuite([tests_lvm, tests_btrfs, tests_ssm, tests_misc, tests_multipath,
+                                    tests_md, tests_dm])
 
     test_runner = unittest.TextTestRunner(verbosity=2)
     return not test_runner.run(tests).wasSuccessful()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of the memory used by the items and of the name matching.
+#
+# Run from the top of the source tree:
+#
+#   python -m tests.bench_items [count] [repeat]
+
+from __future__ import print_function
+
+import gc
+import sys
+import timeit
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+from ssmlib import main
+
+
+class VolumeBackend(object):
+    """ Minimal backend holding LVM-like volume data. """
+
+    type = 'volumes'
+
+    def __init__(self, count):
+        self.options = main.Options()
+        self.data = {}
+        for i in range(count):
+            name = "/dev/pool{0}/lvol{1:05d}".format(i % 10, i)
+            self.data[name] = {
+                'dev_name': name,
+                'real_dev': "/dev/dm-{0}".format(i),
+                'dm_name': "/dev/mapper/pool{0}-lvol{1:05d}".format(i % 10, i),
+                'pool_name': "pool{0}".format(i % 10),
+                'lv_name': "lvol{0:05d}".format(i),
+                'vol_size': 1024 * i,
+                'mount': '',
+            }
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+
+def create_items(backend):
+    return [main.VolumeItem(obj=backend, name=name, source=None)
+            for name in backend.data]
+
+
+def match_names(items):
+    for item in items:
+        item.matches_name('/dev/mapper/missing')
+
+
+def main_bench(count=20000, repeat=7):
+    backend = VolumeBackend(count)
+
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+    items = create_items(backend)
+    if tracemalloc:
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("memory for {0} items: {1:.1f} MB".format(
+            count, memory / 1024.0 / 1024))
+
+    timer = timeit.Timer(lambda: create_items(backend))
+    print("item creation:        {0:.3f}s".format(
+        min(timer.repeat(repeat, 1))))
+    timer = timeit.Timer(lambda: match_names(items))
+    print("matches_name over all: {0:.3f}s".format(
+        min(timer.repeat(repeat, 1))))
+
+
+if __name__ == '__main__':
+    main_bench(*[int(arg) for arg in sys.argv[1:3]])
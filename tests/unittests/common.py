@@ -22,6 +22,7 @@ import unittest
 import argparse
 from ssmlib import main
 from ssmlib import misc
+from ssmlib.backends import lvm
 
 
 class MyStdout(object):
@@ -43,8 +44,17 @@ class BaseStorageHandleInit(unittest.TestCase):
         self.run_data = []
         self.run_orig = misc.run
         misc.run = self.mock_run
+        self.lvm_shell_orig = lvm.SSM_LVM_SHELL
+        lvm.SSM_LVM_SHELL = False
+        self.cache_dir_orig = misc.SSM_CACHE_DIR
+        misc.SSM_CACHE_DIR = ""
+        self.check_binary_orig = misc.check_binary
+        misc.check_binary = self.mock_check_binary
         main.SSM_NONINTERACTIVE = True
 
+    def mock_check_binary(self, name):
+        return True
+
     def mock_run(self, cmd, *args, **kwargs):
         # Convert all parts of cmd into string
         for i, item in enumerate(cmd):
@@ -61,6 +71,9 @@ class BaseStorageHandleInit(unittest.TestCase):
         self.storage = None
         self.run_data = []
         misc.run = self.run_orig
+        lvm.SSM_LVM_SHELL = self.lvm_shell_orig
+        misc.SSM_CACHE_DIR = self.cache_dir_orig
+        misc.check_binary = self.check_binary_orig
         main.SSM_NONINTERACTIVE = False
 
 
@@ -70,6 +83,10 @@ class MockSystemDataSource(unittest.TestCase):
         self.run_data = []
         self.run_orig = misc.run
         misc.run = self.mock_run
+        self.lvm_shell_orig = lvm.SSM_LVM_SHELL
+        lvm.SSM_LVM_SHELL = False
+        self.cache_dir_orig = misc.SSM_CACHE_DIR
+        misc.SSM_CACHE_DIR = ""
         self.get_partitions_orig = misc.get_partitions
         misc.get_partitions = self.mock_get_partitions
         self.get_real_device_orig = misc.get_real_device
@@ -103,6 +120,7 @@ class MockSystemDataSource(unittest.TestCase):
         self.links = {}
         self._mpoint = False
         main.SSM_NONINTERACTIVE = True
+        misc.invalidate_caches()
 
     def tearDown(self):
         self.directories = []
@@ -112,6 +130,8 @@ class MockSystemDataSource(unittest.TestCase):
         self.vol_data = {}
         self.mount_data = {}
         misc.run = self.run_orig
+        lvm.SSM_LVM_SHELL = self.lvm_shell_orig
+        misc.SSM_CACHE_DIR = self.cache_dir_orig
         misc.get_partitions = self.get_partitions_orig
         misc.get_real_device = self.get_real_device_orig
         misc.get_device_size = self.get_device_size_orig
@@ -259,6 +279,7 @@ class MockSystemDataSource(unittest.TestCase):
 
     def _removeMount(self, device):
         del self.mount_data[device]
+        misc.invalidate_caches()
 
     def _addDir(self, dirname):
         self.directories.append(dirname)
@@ -315,6 +336,7 @@ class MockSystemDataSource(unittest.TestCase):
                                         'root': "/"}
         self.mount_data[vol_path] = {'dev': vol_path, 'mp': mount,
                                         'root': "/"}
+        misc.invalidate_caches()
 
     def _addVol(self, vol_name, vol_size, stripes, pool_name, devices,
                 mount=None, active=True, fstype=None):
@@ -18,8 +18,13 @@
 # Unittests for the system storage manager btrfs backend
 
 
+import os
+import shutil
+import struct
+import tempfile
 import unittest
 from ssmlib import main
+from ssmlib import misc
 from ssmlib import problem
 from ssmlib.backends import btrfs
 from tests.unittests.common import *
@@ -474,3 +479,171 @@ class BtrfsFunctionCheck(MockSystemDataSource):
         self._checkCmd("ssm -f migrate /dev/sdc1 /dev/sdd2", [],
             "btrfs replace start -f -B /dev/sdc1 /dev/sdd2 /tmp/mount")
         self.assertTrue("btrfs device delete /dev/sdd2 /tmp/mount" in self.run_data)
+
+    def test_btrfs_model(self):
+        # Generate some storage data
+        self._addPool('default_pool', ['/dev/sda', '/dev/sdb'])
+        self._addPool('my_pool', ['/dev/sdc2', '/dev/sdc3', '/dev/sdc1'])
+        self._addVol('vol001', 117283225, 1, 'default_pool', ['/dev/sda'],
+                    '/mnt/mount')
+        self._addVol('vol002', 1024, 1, 'my_pool', ['/dev/sdc2'],
+                    '/mnt/test')
+
+        # All the backends share a single 'filesystem show' and a single
+        # subvolume list for each file system
+        self.run_data = []
+        main.main("ssm list")
+        self.assertEqual(self.run_data.count("btrfs filesystem show"), 1)
+        self.assertEqual(self.run_data.count(
+            "btrfs subvolume list -a /mnt/mount"), 1)
+        self.assertEqual(self.run_data.count(
+            "btrfs subvolume list -a /mnt/test"), 1)
+
+        # Backends get their own copies of the shared data
+        pool = btrfs.BtrfsPool(options=main.Options())
+        pool.data['default_pool']['mount'] = '/tmp/mount'
+        pool = btrfs.BtrfsPool(options=main.Options())
+        self.assertEqual(pool.data['default_pool']['mount'], '/mnt/mount')
+        self.assertEqual(btrfs.BTRFS_MODEL.pool['default_pool']['mount'],
+                         '/mnt/mount')
+
+    def test_btrfs_sysfs(self):
+        sysfs_orig = btrfs.BTRFS_SYSFS
+        sysfs = tempfile.mkdtemp()
+        uuid = "ce2d0e8c-4a6c-4f4a-9f43-5a1b2c3d4e5f"
+        lsblk = ""
+        for dev in sorted(self.dev_data):
+            if dev == '/dev/sdc2':
+                lsblk += 'KNAME="{0}" NAME="{0}" FSTYPE="btrfs" ' \
+                         'UUID="{1}" LABEL="my_pool"\n'.format(dev, uuid)
+            else:
+                lsblk += 'KNAME="{0}" NAME="{0}" FSTYPE="" UUID="" ' \
+                         'LABEL=""\n'.format(dev)
+
+        def mock_run(cmd, *args, **kwargs):
+            if cmd[0] == 'lsblk':
+                return (0, lsblk, None)
+            return self.mock_run(cmd, *args, **kwargs)
+
+        def write(path, value):
+            path = os.path.join(sysfs, uuid, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(value)
+
+        class Stat(object):
+            f_frsize = 4096
+            f_blocks = 2560
+
+        def mock_statvfs(mount):
+            if mount != '/mnt/test':
+                raise OSError("not mounted")
+            return Stat()
+
+        try:
+            btrfs.BTRFS_SYSFS = sysfs
+            btrfs.os.statvfs = mock_statvfs
+            misc.run = mock_run
+            self._addPool('my_pool', ['/dev/sdc2'])
+            self.mount_data['/dev/sdc2'] = {'dev': '/dev/sdc2',
+                                            'mp': '/mnt/test', 'root': '/'}
+            write("label", "my_pool\n")
+            write("devices/sdc2/dev", "8:2\n")
+            write("allocation/data/bytes_used", "1048576\n")
+            write("allocation/data/disk_total", "8388608\n")
+            write("allocation/metadata/bytes_used", "131072\n")
+            write("allocation/metadata/disk_total", "2097152\n")
+
+            # Mounted file system is described by sysfs
+            misc.invalidate_caches()
+            self.run_data = []
+            pool = btrfs.BtrfsPool(options=main.Options())
+            self.assertFalse("btrfs filesystem show" in self.run_data)
+            self.assertEqual(pool.data['my_pool']['mount'], '/mnt/test')
+            self.assertEqual(pool.data['my_pool']['pool_used'], "1152.0")
+            self.assertEqual(pool.data['my_pool']['pool_size'], 29826161)
+            dev = btrfs.BtrfsDev(options=main.Options())
+            self.assertEqual(dev.data['/dev/sdc2']['dev_used'], "10240.0")
+            self.assertEqual(dev.data['/dev/sdc2']['pool_name'], 'my_pool')
+            vol = btrfs.BtrfsVolume(options=main.Options())
+            self.assertEqual(vol.data['my_pool']['real_dev'], '/dev/sdc2')
+            # The file system is smaller than the device
+            self.assertEqual(vol.data['my_pool']['fs_size'], "10240.0")
+
+            # Without statvfs() of the mount point the btrfs tool is used
+            self.mount_data['/dev/sdc2']['mp'] = '/mnt/other'
+            misc.invalidate_caches()
+            self.run_data = []
+            pool = btrfs.BtrfsPool(options=main.Options())
+            self.assertTrue("btrfs filesystem show" in self.run_data)
+            self.mount_data['/dev/sdc2']['mp'] = '/mnt/test'
+
+            # Unmounted file system needs the btrfs tool
+            shutil.rmtree(os.path.join(sysfs, uuid))
+            misc.invalidate_caches()
+            self.run_data = []
+            pool = btrfs.BtrfsPool(options=main.Options())
+            self.assertTrue("btrfs filesystem show" in self.run_data)
+        finally:
+            btrfs.BTRFS_SYSFS = sysfs_orig
+            btrfs.os.statvfs = self.mock_os_statvfs
+            misc.run = self.mock_run
+            shutil.rmtree(sysfs)
+
+    def test_btrfs_subvolume_ioctl(self):
+        ioctl_orig = btrfs.fcntl.ioctl
+        mount = tempfile.mkdtemp()
+
+        def root_item(generation):
+            data = bytearray(239)
+            struct.pack_into("<Q", data, 160, generation)
+            return bytes(data)
+
+        def root_ref(dirid, name):
+            return struct.pack("<QQH", dirid, 0, len(name)) + name
+
+        tree = sorted([
+            (256, btrfs.BTRFS_ROOT_ITEM_KEY, 0, root_item(7)),
+            (256, btrfs.BTRFS_ROOT_BACKREF_KEY, 5, root_ref(256, b"vol")),
+            (257, btrfs.BTRFS_ROOT_ITEM_KEY, 12, root_item(13)),
+            (257, btrfs.BTRFS_ROOT_BACKREF_KEY, 256, root_ref(260, b"snap")),
+            # Subvolume being deleted
+            (258, btrfs.BTRFS_ROOT_ITEM_KEY, 0, root_item(14))])
+        directories = {(256, 260): b"dir/"}
+
+        def mock_ioctl(fd, request, args, mutate):
+            if request == btrfs.BTRFS_IOC_INO_LOOKUP:
+                tree_id, objectid = struct.unpack_from("=2Q", args)
+                name = directories.get((tree_id, objectid), b"")
+                args[16:16 + len(name) + 1] = name + b"\0"
+                return 0
+            self.assertEqual(request, btrfs.BTRFS_IOC_TREE_SEARCH_V2)
+            key = btrfs.SEARCH_ARGS.unpack_from(args)
+            self.assertEqual(key[0], btrfs.BTRFS_ROOT_TREE_OBJECTID)
+            # Return at most two items at once
+            found = [item for item in tree
+                     if item[:3] >= (key[1], key[7], key[3]) and
+                        item[:3] <= (key[2], key[8], key[4])][:2]
+            values = list(key)
+            values[9] = len(found)
+            btrfs.SEARCH_ARGS.pack_into(args, 0, *values)
+            pos = btrfs.SEARCH_ARGS.size
+            for objectid, item_type, offset, data in found:
+                btrfs.SEARCH_HEADER.pack_into(args, pos, 0, objectid, offset,
+                                              item_type, len(data))
+                pos += btrfs.SEARCH_HEADER.size
+                args[pos:pos + len(data)] = data
+                pos += len(data)
+            return 0
+
+        try:
+            btrfs.fcntl.ioctl = mock_ioctl
+            self.assertEqual(btrfs.get_subvolumes(mount), [
+                {'ID': 256, 'parent_ID': 5, 'generation': 7,
+                 'path': 'vol', 'snapshot': False},
+                {'ID': 257, 'parent_ID': 256, 'generation': 13,
+                 'path': 'vol/dir/snap', 'snapshot': True}])
+        finally:
+            btrfs.fcntl.ioctl = ioctl_orig
+            shutil.rmtree(mount)
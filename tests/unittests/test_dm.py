@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+#
+# (C)2012 Red Hat, Inc., Lukas Czerner <lczerner@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Unittests for the system storage manager device mapper queries
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from ssmlib import main
+from ssmlib import misc
+from ssmlib.backends import dm
+from ssmlib.backends import crypt
+from ssmlib.backends import multipath
+from tests.unittests.common import *
+
+DM_TABLE = {
+    'luks1': [(0, 2093056, 'crypt',
+               'aes-xts-plain64 ' + '1f' * 64 + ' 0 8:1 4096')],
+    'default_pool-lvol001': [(0, 409600, 'linear', '8:2 2048')],
+    'mpatha': [(0, 2097152, 'multipath',
+                '1 queue_if_no_path 0 2 1 service-time 0 1 1 8:16 1 '
+                'round-robin 0 1 1 8:32 1')]}
+
+
+class DmFunctionCheck(MockSystemDataSource):
+
+    def setUp(self):
+        super(DmFunctionCheck, self).setUp()
+        self._addDevice('/dev/sda1', 1048576, 1)
+        self._addDevice('/dev/sda2', 1048576, 2)
+        self._addDevice('/dev/sdb', 1048576, 16)
+        self._addDevice('/dev/sdc', 1048576, 32)
+        self.sysfs = tempfile.mkdtemp()
+        self.dev_dir = tempfile.mkdtemp()
+        for (minor, name, uuid) in [
+                (0, 'luks1', 'CRYPT-LUKS2-1234-luks1'),
+                (1, 'default_pool-lvol001', 'LVM-abcd'),
+                (2, 'mpatha', 'mpath-3600000')]:
+            dev_name = '/dev/dm-{0}'.format(minor)
+            self._addDevice(dev_name, 1046528, minor)
+            self.dev_data[dev_name]['major'] = '253'
+            self._addLink(dev_name, '/dev/mapper/' + name)
+            self._write("dm-{0}/dm/name".format(minor), name)
+            self._write("dm-{0}/dm/uuid".format(minor), uuid)
+        os.mkdir(os.path.join(self.dev_dir, "mapper"))
+        with open(os.path.join(self.dev_dir, "mapper", "luks1"), 'w'):
+            pass
+
+        self.dm_sysfs_orig = dm.DM_SYSFS
+        dm.DM_SYSFS = self.sysfs
+        self.dm_control_orig = dm.DM_CONTROL
+        dm.DM_CONTROL = os.path.join(self.dev_dir, "control")
+        self.dm_dev_dir_orig = crypt.DM_DEV_DIR
+        crypt.DM_DEV_DIR = self.dev_dir
+        self.ioctl_orig = dm.fcntl.ioctl
+        self.get_dmnumber_orig = misc.get_dmnumber
+        misc.get_dmnumber = self.mock_get_dmnumber
+        misc.invalidate_caches()
+
+    def tearDown(self):
+        super(DmFunctionCheck, self).tearDown()
+        dm.DM_SYSFS = self.dm_sysfs_orig
+        dm.DM_CONTROL = self.dm_control_orig
+        crypt.DM_DEV_DIR = self.dm_dev_dir_orig
+        dm.fcntl.ioctl = self.ioctl_orig
+        misc.get_dmnumber = self.get_dmnumber_orig
+        shutil.rmtree(self.sysfs)
+        shutil.rmtree(self.dev_dir)
+        misc.invalidate_caches()
+
+    def mock_get_dmnumber(self, name):
+        if name == "device-mapper":
+            return '253'
+        return None
+
+    def mock_run(self, cmd, *args, **kwargs):
+        self.run_data.append(" ".join(cmd))
+        output = ""
+        if cmd == ['dmsetup', 'table']:
+            for name in sorted(DM_TABLE):
+                for target in DM_TABLE[name]:
+                    output += "{0}: {1} {2} {3} {4}\n".format(name, *target)
+        return (0, output)
+
+    def mock_ioctl(self, fd, request, buf, mutate):
+        header = list(dm.DM_IOCTL.unpack_from(buf))
+        pos = header[4]
+        if request == dm.DM_LIST_DEVICES:
+            names = sorted(DM_TABLE)
+            for minor, name in enumerate(names):
+                size = dm.DM_NAME_LIST.size + len(name) + 1
+                size += -size % 8
+                offset = size if minor + 1 < len(names) else 0
+                dm.DM_NAME_LIST.pack_into(buf, pos, os.makedev(253, minor),
+                                          offset)
+                name = name.encode() + b"\0"
+                start = pos + dm.DM_NAME_LIST.size
+                buf[start:start + len(name)] = name
+                pos += size
+        elif request == dm.DM_TABLE_STATUS:
+            self.assertTrue(header[7] & dm.DM_STATUS_TABLE_FLAG)
+            name = misc.__str__(header[11].split(b"\0", 1)[0])
+            header[5] = len(DM_TABLE[name])
+            for target in DM_TABLE[name]:
+                params = target[3].encode() + b"\0"
+                size = dm.DM_TARGET_SPEC.size + len(params)
+                size += -size % 8
+                dm.DM_TARGET_SPEC.pack_into(buf, pos, target[0], target[1], 0,
+                                            pos - header[4] + size,
+                                            target[2].encode())
+                start = pos + dm.DM_TARGET_SPEC.size
+                buf[start:start + len(params)] = params
+                pos += size
+        dm.DM_IOCTL.pack_into(buf, 0, *header)
+        return 0
+
+    def _write(self, path, value):
+        path = os.path.join(self.sysfs, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(value + "\n")
+
+    def test_dm_devices(self):
+        devices = dm.get_devices()
+        self.assertEqual(sorted(devices.keys()),
+                         ['default_pool-lvol001', 'luks1', 'mpatha'])
+        self.assertEqual(devices['luks1']['subsystem'], 'CRYPT')
+        self.assertEqual(devices['mpatha']['subsystem'], 'mpath')
+        self.assertEqual(devices['mpatha']['devnum'], '253:2')
+        self.assertEqual(devices['mpatha']['size'], 1046528)
+        self.assertTrue(dm.devices_complete())
+        self.assertEqual(dm.get_device('/dev/dm-1')['dm_name'],
+                         '/dev/mapper/default_pool-lvol001')
+        self.assertEqual(dm.get_device('/dev/mapper/luks1')['real_dev'],
+                         '/dev/dm-0')
+        self.assertEqual(dm.get_device('/dev/sda1'), None)
+        self.assertEqual(dm.get_device('253:2')['name'], 'mpatha')
+        # Nothing is run to find the devices
+        self.assertEqual(self.run_data, [])
+
+        # Devices are looked up without going through all of them again
+        get_partitions = misc.get_partitions
+        calls = []
+        misc.get_partitions = lambda: calls.append(1) or get_partitions()
+        try:
+            self.assertEqual(dm.find_device_name('8:16'), '/dev/sdb')
+            self.assertEqual(dm.find_device_name('8:32'), '/dev/sdc')
+            self.assertEqual(dm.find_device_name('8:99'), None)
+            self.assertEqual(len(calls), 1)
+            misc.invalidate_caches()
+            for i in range(3):
+                dm.get_device('/dev/mapper/luks1')
+            self.assertEqual(len(calls), 2)
+        finally:
+            misc.get_partitions = get_partitions
+
+        # Without the device mapper driver there are no devices
+        misc.get_dmnumber = lambda name: None
+        misc.invalidate_caches()
+        self.assertEqual(dm.get_devices(), {})
+        self.assertFalse(dm.devices_complete())
+
+    def test_dm_dmsetup(self):
+        vol = crypt.DmCryptVolume(options=main.Options())
+        # All the tables are read at once, cryptsetup is not needed
+        self.assertEqual(self.run_data, ['dmsetup table'])
+        data = vol.data[os.path.join(self.dev_dir, "mapper", "luks1")]
+        self.assertEqual(data['cipher'], 'aes-xts-plain64')
+        self.assertEqual(data['keysize'], '512')
+        self.assertEqual(data['crypt_device'], '/dev/sda1')
+        self.assertEqual(data['vol_size'], '1046528.0')
+        self.assertEqual(len(vol.data), 1)
+
+        multipath.MultipathDevice(options=main.Options())
+        self.assertEqual(self.run_data, ['dmsetup table'])
+
+    def test_dm_ioctl(self):
+        with open(dm.DM_CONTROL, 'w'):
+            pass
+        dm.fcntl.ioctl = self.mock_ioctl
+        tables = dm.DM_MODEL.tables()
+        self.assertEqual(sorted(tables.keys()), sorted(DM_TABLE.keys()))
+        self.assertEqual(tables['default_pool-lvol001'],
+                         [{'start': 0, 'length': 409600, 'type': 'linear',
+                           'params': '8:2 2048'}])
+        # The key is never stored
+        self.assertEqual(tables['luks1'][0]['params'],
+                         'aes-xts-plain64 ' + '0' * 128 + ' 0 8:1 4096')
+
+        vol = crypt.DmCryptVolume(options=main.Options())
+        mp = multipath.MultipathDevice(options=main.Options())
+        self.assertEqual(self.run_data, [])
+        data = vol.data[os.path.join(self.dev_dir, "mapper", "luks1")]
+        self.assertEqual(data['keysize'], '512')
+        self.assertEqual(mp.data['mpatha']['wwid'], '3600000')
+        self.assertEqual(mp.data['mpatha']['nodes'], ['/dev/sdb', '/dev/sdc'])
+        self.assertEqual(mp.data['mpatha']['path_groups'], 2)
+        self.assertEqual(mp.data['/dev/sdc']['pool_name'], '/dev/dm-2')
+
+    def test_dm_parse(self):
+        self.assertEqual(dm.parse_table_line("No devices found"), None)
+        self.assertEqual(dm.parse_table_line("luks1: 0 8 crypt a :64:logon:"
+                                             "cryptsetup:1234 0 8:1 0"),
+                         ('luks1', {'start': 0, 'length': 8, 'type': 'crypt',
+                                    'params': 'a :64:logon:cryptsetup:1234 '
+                                              '0 8:1 0'}))
+        self.assertEqual(dm.crypt_params("a :64:logon:cryptsetup:1234 0 "
+                                         "8:1 0")['keysize'], '512')
+        groups = multipath.parse_table(DM_TABLE['mpatha'][0][3])
+        self.assertEqual([group['attrs'] for group in groups],
+                         ["policy='service-time'", "policy='round-robin'"])
+        self.assertEqual(groups[1]['paths'][0]['dev'], 'sdc')
+        self.assertEqual(multipath.parse_table("1 2"), None)
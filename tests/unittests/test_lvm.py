@@ -17,11 +17,21 @@
 
 # Unittests for the system storage manager lvm backend
 
+import os
+import sys
+import json
+import subprocess
 import unittest
+from collections import OrderedDict
 from ssmlib import main
+from ssmlib import misc
 from ssmlib import problem
 from ssmlib.backends import lvm
 from tests.unittests.common import *
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 
 class LvmFunctionCheck(MockSystemDataSource):
@@ -62,10 +72,136 @@ class LvmFunctionCheck(MockSystemDataSource):
                         data['vol_size'], data['stripes'], data['stripesize'],
                         data['type'], data['dev_name'].split("/")[-1],
                         data['origin'], data['attr'])
+        elif cmd[1] == 'fullreport':
+            output = self._fullreport()
         if 'return_stdout' in kwargs and not kwargs['return_stdout']:
             output = None
         return (0, output, None)
 
+    def _fullreport(self):
+        report = []
+        for (pool, data) in self.pool_data.items():
+            vg = [OrderedDict([('vg_name', pool),
+                               ('pv_count', str(data['dev_count'])),
+                               ('vg_size', str(data['pool_size'])),
+                               ('vg_free', str(data['pool_free'])),
+                               ('lv_count', str(data['vol_count']))])]
+            pv = [OrderedDict([('pv_name', dev),
+                               ('vg_name', pool),
+                               ('pv_free', str(dev_data['dev_free'])),
+                               ('pv_used', str(dev_data['dev_used'])),
+                               ('pv_size', str(dev_data['dev_size']))])
+                  for (dev, dev_data) in self.dev_data.items()
+                  if dev_data.get('pool_name') == pool]
+            vols = [(vol, vol_data) for (vol, vol_data)
+                    in sorted(self.vol_data.items())
+                    if vol_data['pool_name'] == pool]
+            # Segment columns are reported in the segment report only
+            lv = [OrderedDict([('vg_name', pool),
+                               ('lv_size', str(vol_data['vol_size'])),
+                               ('lv_name', vol.split("/")[-1]),
+                               ('origin', vol_data['origin']),
+                               ('lv_attr', vol_data['attr']),
+                               ('pool_lv', ""),
+                               ('snap_percent', ""),
+                               ('pv_count', str(data['dev_count'])),
+                               ('thin_count', ""),
+                               ('data_percent', ""),
+                               ('metadata_percent', ""),
+                               ('lv_uuid', "uuid-" + vol)])
+                  for (vol, vol_data) in vols]
+            seg = [OrderedDict([('lv_uuid', "uuid-" + vol),
+                                ('stripes', str(vol_data['stripes'])),
+                                ('stripe_size', str(vol_data['stripesize'])),
+                                ('segtype', vol_data['type'])])
+                   for (vol, vol_data) in vols]
+            pvseg = [OrderedDict([('pvseg_start', "0")])
+                     for dev in pv]
+            report.append(OrderedDict([('vg', vg), ('pv', pv), ('lv', lv),
+                                       ('pvseg', pvseg), ('seg', seg)]))
+        return json.dumps({'report': report})
+
+    def test_lvm_fullreport(self):
+        self._addPool('default_pool', ['/dev/sda', '/dev/sdb'])
+        self._addPool('my_pool', ['/dev/sdc2', '/dev/sdc3'])
+        self._addVol('vol001', 117283225, 1, 'default_pool', ['/dev/sda'])
+        self._addVol('vol002', 237284225, 1, 'my_pool', ['/dev/sdc3'])
+
+        version = lvm.LVM_VERSION
+        lvm.LVM_VERSION = [2, 2, 158]
+        try:
+            storage = main.StorageHandle()
+            self.assertEqual(storage.pool['my_pool']['dev_count'], '2')
+            self.assertEqual(storage.dev['/dev/sdc3']['pool_name'], 'my_pool')
+            self.assertEqual(storage.vol['/dev/my_pool/vol002']['pool_name'],
+                             'my_pool')
+            self.assertEqual(len(list(storage.vol)), 2)
+        finally:
+            lvm.LVM_VERSION = version
+
+        # Everything lvm related should be gathered with a single command
+        lvm_cmds = [cmd for cmd in self.run_data if cmd.startswith("lvm ")]
+        self.assertEqual(len(lvm_cmds), 1)
+        self.assertTrue(lvm_cmds[0].startswith("lvm fullreport"))
+        self.assertTrue("--configreport seg -o lv_uuid,stripes,stripesize,"
+                        "segtype" in lvm_cmds[0])
+        vol = storage.vol['/dev/my_pool/vol002']
+        self.assertEqual(vol['type'], 'linear')
+        self.assertEqual(vol['stripes'], '1')
+
+    def test_lvm_shell(self):
+        shell = lvm.LvmShell()
+        # Commands changing the storage are never run in the shell
+        self.assertEqual(shell.run(['lvm', 'lvremove', 'default_pool/vol001']),
+                         None)
+        self.assertEqual(shell.proc, None)
+        self.assertTrue(shell.usable)
+
+        # The stuck shell is killed and the report is run the usual way
+        timeout = lvm.LVM_SHELL_COMMAND_TIMEOUT
+        lvm.LVM_SHELL_COMMAND_TIMEOUT = 0.1
+        report_r, report_w = os.pipe()
+        try:
+            shell.proc = subprocess.Popen(['sleep', '30'],
+                                          stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.PIPE)
+            shell.report_fd = report_r
+            self.assertEqual(shell.run(['lvm', 'lvs']), None)
+        finally:
+            lvm.LVM_SHELL_COMMAND_TIMEOUT = timeout
+            os.close(report_w)
+        self.assertEqual(shell.proc, None)
+        self.assertFalse(shell.usable)
+
+    def test_lvm_lookup(self):
+        self._addPool('default_pool', ['/dev/sda', '/dev/sdb'])
+        self._addPool('my_pool', ['/dev/sdc2', '/dev/sdc3'])
+        self._addVol('vol001', 117283225, 1, 'default_pool', ['/dev/sda'])
+        self._addVol('vol002', 237284225, 1, 'my_pool', ['/dev/sdc3'])
+
+        storage = main.StorageHandle()
+        vol = storage.vol['/dev/my_pool/vol002']
+        self.assertEqual(vol['lv_name'], 'vol002')
+        for name in ['my_pool/vol002', vol['real_dev'], vol['dm_name']]:
+            self.assertEqual(storage.vol[name].data, vol.data)
+            self.assertEqual(storage.vol[name].name, name)
+        self.assertEqual(storage.vol['my_pool/vol003'], None)
+        self.assertEqual(storage.vol['/dev/my_pool/vol003'], None)
+        self.assertEqual(storage.vol[None], None)
+
+        # Names missing from the index are resolved relative to DM_DEV_DIR
+        link = lvm.DM_DEV_DIR + '/disk/by-id/dm-name-my_pool-vol002'
+        self._addLink(vol['real_dev'], link)
+        exists = os.path.exists
+        os.path.exists = lambda path: path in self.links or exists(path)
+        try:
+            for name in ['disk/by-id/dm-name-my_pool-vol002', link]:
+                self.assertEqual(storage.vol[name].data, vol.data)
+            self.assertEqual(storage.vol['disk/by-id/missing'], None)
+        finally:
+            os.path.exists = exists
+
     def test_lvm_create(self):
         default_pool = lvm.SSM_LVM_DEFAULT_POOL
 
@@ -463,3 +599,59 @@ class LvmFunctionCheck(MockSystemDataSource):
         self._cmdEq("mount -o discard /dev/default_pool/vol001 /mnt/test")
         main.main("ssm mount --options rw,discard,neco=44 /dev/my_pool/vol002 /mnt/test1")
         self._cmdEq("mount -o rw,discard,neco=44 /dev/my_pool/vol002 /mnt/test1")
+
+    def test_lvm_list_plan(self):
+        self._addPool('default_pool', ['/dev/sda', '/dev/sdb'])
+        self._addVol('vol001', 117283225, 1, 'default_pool', ['/dev/sda'],
+                     fstype="ext4")
+        stdout_orig = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            # Pools do not need file systems, nor the snapshot usage
+            main.main("ssm list pool")
+            lvs = [cmd for cmd in self.run_data if cmd.startswith("lvm lvs")]
+            self.assertEqual(len(lvs), 1)
+            self.assertFalse("snap_percent" in lvs[0])
+            self.assertTrue("data_percent" in lvs[0])
+            self.assertFalse([cmd for cmd in self.run_data
+                              if cmd.split()[0] in ["blkid", "tune2fs"]])
+
+            # Snapshots need their usage, but not the thin pool one
+            misc.invalidate_caches()
+            self.run_data = []
+            main.main("ssm list snap")
+            lvs = [cmd for cmd in self.run_data if cmd.startswith("lvm lvs")]
+            self.assertTrue("snap_percent" in lvs[0])
+            self.assertFalse("data_percent" in lvs[0])
+        finally:
+            sys.stdout = stdout_orig
+
+        # Without the plan everything is gathered again
+        storage = main.StorageHandle()
+        self.assertEqual(storage.options.plan, None)
+        self.assertTrue(storage.options.needs('fs_info'))
+        list(storage.pool)
+        lvs = [cmd for cmd in self.run_data if cmd.startswith("lvm lvs")]
+        self.assertTrue("snap_percent" in lvs[-1])
+        self.assertTrue("data_percent" in lvs[-1])
+
+    def test_list_plan(self):
+        plan = main.ListPlan(main.Pool.ATTRS)
+        self.assertTrue(plan.needs('thin_usage'))
+        self.assertFalse(plan.needs('snap_usage'))
+        self.assertFalse(plan.needs('fs_info'))
+        plan = main.ListPlan(main.Volumes.ATTRS)
+        self.assertTrue(plan.needs('fs_info'))
+        self.assertFalse(plan.needs('thin_usage'))
+
+        # Items do not probe for file systems nobody is going to print
+        self._addPool('default_pool', ['/dev/sda', '/dev/sdb'])
+        self._addVol('vol001', 117283225, 1, 'default_pool', ['/dev/sda'],
+                     fstype="vfat")
+        storage = main.StorageHandle()
+        storage.options.plan = main.ListPlan(main.Pool.ATTRS)
+        vol = storage.vol['/dev/default_pool/vol001']
+        self.assertEqual(vol['fs_type'], "")
+        self.assertEqual(vol.fs_probe, main.FS_PROBE_UNKNOWN)
+        storage.options.plan = None
+        self.assertEqual(vol['fs_type'], "vfat")
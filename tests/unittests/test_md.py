@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#
+# (C)2012 Red Hat, Inc., Lukas Czerner <lczerner@redhat.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Unittests for the system storage manager md backend
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from ssmlib import main
+from ssmlib import misc
+from ssmlib.backends import md
+from tests.unittests.common import *
+
+
+class MdFunctionCheck(MockSystemDataSource):
+
+    def setUp(self):
+        super(MdFunctionCheck, self).setUp()
+        self._addDevice('/dev/sdb1', 2097152, 1)
+        self._addDevice('/dev/sdc1', 4194304, 1)
+        self._addDevice('/dev/md127', 2096128)
+        self.dev_data['/dev/md127']['major'] = '9'
+
+        self.md_sysfs_orig = md.MD_SYSFS
+        md.MD_SYSFS = self.sysfs = tempfile.mkdtemp()
+        self.get_dmnumber_orig = misc.get_dmnumber
+        misc.get_dmnumber = self.mock_get_dmnumber
+        self.get_slaves_orig = misc.get_slaves
+        misc.get_slaves = self.mock_get_slaves
+        misc.invalidate_caches()
+
+    def tearDown(self):
+        super(MdFunctionCheck, self).tearDown()
+        md.MD_SYSFS = self.md_sysfs_orig
+        misc.get_dmnumber = self.get_dmnumber_orig
+        misc.get_slaves = self.get_slaves_orig
+        shutil.rmtree(self.sysfs)
+
+    def mock_get_dmnumber(self, name):
+        if name == "md":
+            return '9'
+        return None
+
+    def mock_get_slaves(self, devname):
+        return ['/dev/sdb1', '/dev/sdc1']
+
+    def _write(self, path, value):
+        path = os.path.join(self.sysfs, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(value + "\n")
+
+    def test_md_sysfs(self):
+        self._write("md127/md/level", "raid1")
+        self._write("md127/md/metadata_version", "1.2")
+        self._write("md127/md/dev-sdb1/state", "in_sync")
+        self._write("md127/md/dev-sdc1/state", "in_sync")
+        self._write("md127/md/sync_action", "resync")
+        self._write("md127/md/sync_completed", "1024 / 4096")
+
+        vol = md.MdRaidVolume(options=main.Options())
+        dev = md.MdRaidDevice(options=main.Options())
+        # Everything is known without running mdadm
+        self.assertEqual(self.run_data, [])
+
+        data = vol.data['/dev/md127']
+        self.assertEqual(data['type'], 'raid1')
+        self.assertEqual(data['vol_size'], '2096128')
+        self.assertEqual(data['total_devices'], '2')
+        self.assertEqual(data['pool_name'], md.SSM_DM_DEFAULT_POOL)
+        self.assertEqual(data['sync_action'], 'resync')
+        self.assertEqual(data['sync_progress'], '25.00')
+        item = main.VolumeItem(obj=vol, name='/dev/md127', source=None)
+        self.assertEqual(main.Item.sync_info(item),
+                         [('synchronization', ''), ('  action', 'resync'),
+                          ('  progress', '25.00 %')])
+
+        self.assertEqual(sorted(dev.data.keys()), ['/dev/sdb1', '/dev/sdc1'])
+        self.assertEqual(dev.data['/dev/sdc1']['dev_size'], 4194304)
+        self.assertEqual(dev.data['/dev/sdc1']['pool_name'],
+                         md.SSM_DM_DEFAULT_POOL)
+
+        # Backends do not share the rows
+        vol.data['/dev/md127']['mount'] = '/mnt/test'
+        vol = md.MdRaidVolume(options=main.Options())
+        self.assertFalse('mount' in vol.data['/dev/md127'])
+
+    def test_md_mdadm(self):
+        # The array is not described in sysfs
+        vol = md.MdRaidVolume(options=main.Options())
+        self.assertEqual(self.run_data, ['mdadm --detail /dev/md127',
+                                         'mdadm --examine /dev/sdb1',
+                                         'mdadm --examine /dev/sdc1'])
+        self.assertEqual(vol.data['/dev/md127']['dev_name'], '/dev/md127')
+
+        # And it is not examined again
+        md.MdRaidDevice(options=main.Options())
+        self.assertEqual(len(self.run_data), 3)
+
+    def test_md_no_driver(self):
+        misc.get_dmnumber = lambda name: None
+        vol = md.MdRaidVolume(options=main.Options())
+        self.assertEqual(vol.data, {})
+        self.assertEqual(self.run_data, [])
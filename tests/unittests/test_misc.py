@@ -22,8 +22,11 @@ import re
 import sys
 import stat
 import time
+import shutil
 import doctest
+import tempfile
 import unittest
+import threading
 import argparse
 from ssmlib import main
 from ssmlib import misc
@@ -109,6 +112,276 @@ class MiscCheck(unittest.TestCase):
             "a4    b4    cde4   \n" + \
             "-------------------\n")
 
+    def test_find_binary(self):
+        path_orig = os.environ['PATH']
+        paths_orig = dict(misc.BINARY_PATHS)
+        cache_dir_orig = misc.SSM_CACHE_DIR
+        tmp = tempfile.mkdtemp()
+        try:
+            for name, mode in [('tool', 0o755), ('data', 0o644)]:
+                with open(os.path.join(tmp, name), 'w') as f:
+                    f.write("#!/bin/sh\n")
+                os.chmod(os.path.join(tmp, name), mode)
+            os.environ['PATH'] = tmp
+            misc.BINARY_PATHS.clear()
+            misc.SSM_CACHE_DIR = ""
+
+            self.assertEqual(misc.find_binary('tool'),
+                             (os.path.join(tmp, 'tool'), True))
+            self.assertEqual(misc.find_binary('missing'), (None, False))
+            if os.getuid() != 0 or not os.access(os.path.join(tmp, 'data'),
+                                                 os.X_OK):
+                self.assertEqual(misc.find_binary('data'),
+                                 (os.path.join(tmp, 'data'), False))
+            self.assertTrue(misc.check_binary('tool'))
+            self.assertFalse(misc.check_binary('missing'))
+
+            # New results are written into the on-disk cache only once
+            misc.SSM_CACHE_DIR = os.path.join(tmp, "cache")
+            misc.BINARY_PATHS.clear()
+            misc.find_binary('tool')
+            misc.find_binary('missing')
+            self.assertFalse(os.path.exists(misc.SSM_CACHE_DIR))
+            misc.store_binary_paths()
+            self.assertEqual(sorted(misc.load_cache("binaries")['binaries']),
+                             ['missing', 'tool'])
+            self.assertFalse(misc.BINARY_PATHS_CHANGED)
+        finally:
+            os.environ['PATH'] = path_orig
+            misc.BINARY_PATHS.clear()
+            misc.BINARY_PATHS.update(paths_orig)
+            misc.SSM_CACHE_DIR = cache_dir_orig
+            shutil.rmtree(tmp)
+
+    def test_topology_stamp(self):
+        if misc.get_topology_stamp() is None:
+            self.skipTest("uevent sequence number is not available")
+        lvm_dir_orig = os.environ.get('LVM_SYSTEM_DIR')
+        tmp = tempfile.mkdtemp()
+        try:
+            os.environ['LVM_SYSTEM_DIR'] = tmp
+            os.mkdir(os.path.join(tmp, "backup"))
+            with open(os.path.join(tmp, "backup", "vg"), 'w') as f:
+                f.write("vg {\n\tseqno = 1\n}\n")
+            stamp = misc.get_topology_stamp()
+            self.assertNotEqual(stamp, None)
+            with open(os.path.join(tmp, "backup", "vg"), 'w') as f:
+                f.write("vg {\n\tseqno = 2\n}\n")
+            self.assertNotEqual(misc.get_topology_stamp(), stamp)
+
+            # lvm changes can not be noticed without the backups
+            with open(os.path.join(tmp, "lvm.conf"), 'w') as f:
+                f.write("backup {\n\t# backup = 1\n\tbackup = 0\n}\n")
+            self.assertEqual(misc.get_topology_stamp(), None)
+        finally:
+            if lvm_dir_orig is None:
+                del os.environ['LVM_SYSTEM_DIR']
+            else:
+                os.environ['LVM_SYSTEM_DIR'] = lvm_dir_orig
+            shutil.rmtree(tmp)
+
+    def test_profile(self):
+        profile_orig = misc.SSM_PROFILE
+        records_orig = list(misc.PROFILE_RECORDS)
+        try:
+            misc.SSM_PROFILE = True
+            del misc.PROFILE_RECORDS[:]
+            misc.run(['echo', 'hello'])
+            misc.run(['false'], can_fail=True)
+            self.assertEqual(len(misc.PROFILE_RECORDS), 2)
+            record = misc.PROFILE_RECORDS[0]
+            self.assertEqual(record['command'], ['echo', 'hello'])
+            self.assertEqual(record['module'], 'test_misc')
+            self.assertEqual(record['caller'], 'test_profile')
+            self.assertEqual(record['exitcode'], 0)
+            self.assertEqual(record['output_size'], len("hello\n"))
+            self.assertTrue(record['wall'] >= 0)
+            self.assertEqual(misc.PROFILE_RECORDS[1]['exitcode'], 1)
+
+            misc.SSM_PROFILE = False
+            misc.run(['true'])
+            self.assertEqual(len(misc.PROFILE_RECORDS), 2)
+        finally:
+            misc.SSM_PROFILE = profile_orig
+            del misc.PROFILE_RECORDS[:]
+            misc.PROFILE_RECORDS.extend(records_orig)
+
+
+class SnapshotCheck(unittest.TestCase):
+    """
+    Checks that the system information is gathered only once.
+    """
+    def setUp(self):
+        self.run_data = []
+        self.run_orig = misc.run
+        misc.run = self.mock_run
+        self.sysfs_orig = misc.SSM_SYSFS
+        misc.SSM_SYSFS = False
+        misc.invalidate_caches()
+
+    def tearDown(self):
+        misc.run = self.run_orig
+        misc.SSM_SYSFS = self.sysfs_orig
+        misc.invalidate_caches()
+
+    def mock_run(self, cmd, *args, **kwargs):
+        self.run_data.append(" ".join(cmd))
+        if cmd[:4] == ["blkid", "-p", "-o", "export"]:
+            # /dev/dm-0 can not be read, /dev/sdc was just formatted
+            return (0, "DEVNAME=/dev/sda1\nTYPE=crypto_LUKS\n" +
+                       "USAGE=crypto\nUUID=1234\n\n" +
+                       "DEVNAME=/dev/sdc\nUUID=9abc\nLABEL=new\\ data\n" +
+                       "TYPE=xfs\nUSAGE=filesystem\n", None)
+        if cmd[0] == "blkid":
+            return (0, "xfs\n", None)
+        if "-P" in cmd:
+            return (0, 'KNAME="/dev/sda" NAME="/dev/sda" FSTYPE="" ' +
+                       'UUID="" LABEL=""\n' +
+                       'KNAME="/dev/sda1" NAME="/dev/sda1" ' +
+                       'FSTYPE="crypto_LUKS" UUID="1234" LABEL=""\n' +
+                       'KNAME="/dev/sdc" NAME="/dev/sdc" FSTYPE="" ' +
+                       'UUID="" LABEL=""\n' +
+                       'KNAME="/dev/sdd" NAME="/dev/sdd" ' +
+                       'FSTYPE="newfs" UUID="" LABEL=""\n' +
+                       'KNAME="/dev/dm-0" NAME="/dev/mapper/secret" ' +
+                       'FSTYPE="ext4" UUID="5678" ' +
+                       'LABEL="my\\x20d\\xc3\\xa1ta"\n',
+                    None)
+        return (0, "8:0 10240 /dev/sda /dev/sda\n" +
+                   "8:1 2048 /dev/sda1 /dev/sda1 /dev/sda\n", None)
+
+    def test_partitions(self):
+        partitions = [['8', '0', 10, '/dev/sda', '/dev/sda'],
+                      ['8', '1', 2, '/dev/sda1', '/dev/sda1', '/dev/sda']]
+        self.assertEqual(misc.get_partitions(), partitions)
+        # Changing the result must not change the snapshot
+        misc.get_partitions()[0][2] = 0
+        self.assertEqual(misc.get_partitions(), partitions)
+        self.assertEqual(len(self.run_data), 1)
+
+        misc.invalidate_caches()
+        self.assertEqual(misc.get_partitions(), partitions)
+        self.assertEqual(len(self.run_data), 2)
+
+    def test_sysfs_partitions(self):
+        sysfs_block_orig = misc.SYSFS_BLOCK
+        tmp = tempfile.mkdtemp()
+        devices = {'sda': ("8:0", 20480, None),
+                   'sda/sda1': ("8:1", 4096, None),
+                   'dm-0': ("253:0", 2048, "secret"),
+                   'ram0': ("1:0", 8192, None),
+                   'loop0': ("7:0", 0, None),
+                   # Empty devices are not listed by lsblk
+                   'nbd0': ("43:0", 0, None),
+                   'md127': ("9:127", 0, None)}
+        try:
+            misc.SYSFS_BLOCK = os.path.join(tmp, "class", "block")
+            os.makedirs(misc.SYSFS_BLOCK)
+            for name, (dev, size, dm_name) in devices.items():
+                path = os.path.join(tmp, "devices", name)
+                os.makedirs(os.path.join(path, "slaves"))
+                for attr, value in [("dev", dev), ("size", size)]:
+                    with open(os.path.join(path, attr), 'w') as f:
+                        f.write("{0}\n".format(value))
+                if dm_name:
+                    os.mkdir(os.path.join(path, "dm"))
+                    with open(os.path.join(path, "dm", "name"), 'w') as f:
+                        f.write(dm_name + "\n")
+                os.symlink(path, os.path.join(misc.SYSFS_BLOCK,
+                                              os.path.basename(name)))
+            open(os.path.join(tmp, "devices", "sda", "sda1",
+                              "partition"), 'w').close()
+            os.symlink(os.path.join(tmp, "devices", "sda", "sda1"),
+                       os.path.join(tmp, "devices", "dm-0", "slaves",
+                                    "sda1"))
+
+            misc.SSM_SYSFS = True
+            self.assertEqual(misc.get_partitions(), [
+                ['253', '0', 1024, '/dev/dm-0', '/dev/mapper/secret',
+                 '/dev/sda1'],
+                ['8', '0', 10240, '/dev/sda', '/dev/sda'],
+                ['8', '1', 2048, '/dev/sda1', '/dev/sda1', '/dev/sda']])
+            self.assertEqual(len(self.run_data), 0)
+        finally:
+            misc.SYSFS_BLOCK = sysfs_block_orig
+            shutil.rmtree(tmp)
+
+    def test_signatures(self):
+        check_binary_orig = misc.check_binary
+        misc.check_binary = lambda name: True
+        try:
+            self._check_signatures()
+        finally:
+            misc.check_binary = check_binary_orig
+
+    def _check_signatures(self):
+        self.assertEqual(misc.get_signature("/dev/sda"), None)
+        self.assertEqual(misc.get_signature("/dev/sda1"), "crypto_LUKS")
+        self.assertEqual(misc.get_fs_type("/dev/sda1"), None)
+        self.assertEqual(misc.get_fs_type("/dev/dm-0"), "ext4")
+        self.assertEqual(misc.get_fs_type("/dev/mapper/secret"), "ext4")
+        self.assertEqual(misc.get_signature("/dev/sda1", "nocrypto"), None)
+        self.assertEqual(misc.get_signature("/dev/dm-0", "nocrypto"), "ext4")
+        self.assertEqual(misc.SNAPSHOT.signatures()["/dev/dm-0"]["LABEL"],
+                         u"my d\xe1ta")
+        # blkid knows better than lsblk, which may be out of date
+        self.assertEqual(misc.get_fs_type("/dev/sdc"), "xfs")
+        self.assertEqual(misc.SNAPSHOT.signatures()["/dev/sdc"]["LABEL"],
+                         "new data")
+        self.assertEqual(self.run_data, [
+            "lsblk -P -p -o KNAME,NAME,FSTYPE,UUID,LABEL",
+            "blkid -p -o export /dev/dm-0 /dev/sda /dev/sda1 /dev/sdc "
+            "/dev/sdd"])
+
+        # Usage of the types blkid did not describe is probed separately
+        self.assertEqual(misc.get_signature("/dev/sdd"), "newfs")
+        self.assertEqual(len(self.run_data), 2)
+        self.assertEqual(misc.get_fs_type("/dev/sdd"), "xfs")
+        self.assertEqual(self.run_data[-1],
+                         "blkid -o value -p -s TYPE -u filesystem /dev/sdd")
+        self.assertEqual(misc._signature_usage("zfs_member"), None)
+        self.assertEqual(misc._signature_usage("isw_raid_member"), "raid")
+        self.assertEqual(misc._signature_usage("bcache"), "other")
+        self.assertEqual(misc._signature_usage("newfs"), None)
+
+        # Devices lsblk does not know about are probed separately
+        self.assertEqual(misc.get_fs_type("/dev/sdb"), "xfs")
+        self.assertEqual(self.run_data[-1],
+                         "blkid -o value -p -s TYPE -u filesystem /dev/sdb")
+
+    def test_mounts(self):
+        mounts = misc.get_mounts()
+        self.assertEqual(misc.get_mounts(), mounts)
+        self.assertTrue(set(misc.get_mounts("/dev/")) <= set(mounts))
+        self.assertTrue(misc.SNAPSHOT.mounts() is misc.SNAPSHOT.mounts())
+
+    def test_run_parallel(self):
+        def fail():
+            raise RuntimeError("failed")
+
+        def interrupt():
+            raise KeyboardInterrupt()
+
+        results = misc.run_parallel([lambda: 1, fail])
+        self.assertEqual(results[0], (1, None))
+        self.assertTrue(isinstance(results[1][1], RuntimeError))
+
+        # Interrupts are not mistaken for a function returning None
+        self.assertRaises(KeyboardInterrupt, misc.run_parallel,
+                          [lambda: 1, interrupt])
+        self.assertRaises(SystemExit, misc.run_parallel,
+                          [lambda: sys.exit(1)])
+
+        # Functions can be called one after another in the calling thread
+        called = []
+        results = misc.run_parallel(
+            [lambda: called.append(threading.current_thread()), fail], False)
+        self.assertEqual(called, [threading.current_thread()])
+        self.assertTrue(isinstance(results[1][1], RuntimeError))
+        self.assertRaises(KeyboardInterrupt, misc.run_parallel,
+                          [interrupt, lambda: called.append(None)], False)
+        self.assertEqual(len(called), 1)
+
 
 class NodeCheck(unittest.TestCase):
     def setUp(self):
@@ -68,6 +68,8 @@ class MultipathFunctionCheck(MockSystemDataSource):
         # two mp volumes
         self.createMP("dm-90", "mpatha", 11489037516, ["sda", "sdb"])
         self.createMP("dm-91", "mpathb", 11489037, ["sdd", "sde", "sdf"])
+        # Output of 'multipath -ll' to use instead of the generated one
+        self.mp_output = None
 
 
     def _mp_size(self, rawsize):
@@ -83,7 +85,9 @@ class MultipathFunctionCheck(MockSystemDataSource):
 
         self.run_data.append(" ".join(cmd))
         output = ""
-        if cmd[:2] == ['multipath', '-ll']:
+        if cmd[:2] == ['multipath', '-ll'] and self.mp_output is not None:
+            output = self.mp_output
+        elif cmd[:2] == ['multipath', '-ll']:
             mp_vol = None
             if len(cmd) > 2:
                 mp_vol = cmd[2]
@@ -154,6 +158,60 @@ class MultipathFunctionCheck(MockSystemDataSource):
         self.assertEqual(vdata['dev_name'], '/dev/dm-90')
         self.assertEqual(vdata['nodes'], ['/dev/sda','/dev/sdb'])
 
+    def test_mp_parse_topology(self):
+        output = "\n".join([
+            "mpatha (3600a0b800011a1ee0000a47c4e8b8bd1) dm-0 IBM,1814",
+            "size=10G features='1 queue_if_no_path' hwhandler='1 rdac' wp=rw",
+            "|-+- policy='service-time 0' prio=6 status=active",
+            "| |- 1:0:0:1 sdb 8:16 active ready running",
+            "| `- 2:0:0:1 sdd 8:48 active ready running",
+            "`-+- policy='service-time 0' prio=1 status=enabled",
+            "  |- 1:0:1:1 sdc 8:32 active ready running",
+            "  `- 2:0:1:1 sde 8:64 failed faulty offline",
+            "360000000000000000e00000000020001 dm-1 QEMU,QEMU HARDDISK",
+            "size=1.0G features='0' hwhandler='0' wp=rw",
+            "`-+- policy='service-time 0' prio=1 status=active",
+            "  `- 3:0:0:2 sdf 8:80 active ready running",
+            ""])
+        maps = multipath.parse_topology(output)
+        self.assertEqual([mp_map['name'] for mp_map in maps],
+                         ["mpatha", "360000000000000000e00000000020001"])
+        self.assertEqual(maps[0]['wwid'], "3600a0b800011a1ee0000a47c4e8b8bd1")
+        self.assertEqual(maps[0]['dm'], "dm-0")
+        self.assertEqual([[path['dev'] for path in group['paths']]
+                          for group in maps[0]['groups']],
+                         [['sdb', 'sdd'], ['sdc', 'sde']])
+        self.assertEqual(maps[0]['groups'][1]['paths'][1]['state'],
+                         "failed faulty offline")
+        self.assertEqual(maps[1]['wwid'], maps[1]['name'])
+        self.assertEqual(maps[1]['groups'][0]['paths'][0]['hctl'], "3:0:0:2")
+
+    def test_mp_single_call(self):
+        self.run_data = []
+        mp = MultipathDevice(options=self._options)
+        self.assertEqual(self.run_data, ["multipath -ll"])
+        self.assertEqual(mp.data['mpathb']['nodes'],
+                         ['/dev/sdd', '/dev/sde', '/dev/sdf'])
+        self.assertEqual(mp.data['/dev/sde']['pool_name'], '/dev/dm-91')
+
+    def test_mp_wwid_names(self):
+        # Without user friendly names the maps are named by their wwid
+        self._addDevice('/dev/dm-92', 1073741824)
+        self._addDevice('/dev/sdg', 1073741824)
+        self.mp_output = "\n".join([
+            "360014051f0e4a1c2b3d dm-92 LIO-ORG,disk",
+            "size=1.0G features='0' hwhandler='1 alua' wp=rw",
+            "`-+- policy='service-time 0' prio=50 status=active",
+            "  `- 3:0:0:0 sdg 8:96 active ready running",
+            ""])
+        mp = MultipathDevice(options=self._options)
+        data = mp.data['360014051f0e4a1c2b3d']
+        self.assertEqual(data['dev_name'], '/dev/dm-92')
+        self.assertEqual(data['wwid'], '360014051f0e4a1c2b3d')
+        self.assertEqual(data['dev_size'],
+                         misc.get_device_size('/dev/dm-92'))
+        self.assertEqual(mp.data['/dev/sdg']['pool_name'], '/dev/dm-92')
+
     def test_mp_forbidden_ops(self):
         self.assertRaises(problem.SsmError, main.main, "ssm remove /dev/mapper/mpatha")
         self.assertRaises(problem.SsmError, main.main, "ssm remove /dev/dm-90")
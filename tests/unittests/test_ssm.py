@@ -21,13 +21,20 @@ import os
 import re
 import sys
 import stat
+import struct
 import time
+import shutil
 import doctest
+import tempfile
 import unittest
 import argparse
 from ssmlib import main
 from ssmlib import misc
 from ssmlib import problem
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 from tests.unittests.common import *
 
@@ -651,6 +658,272 @@ class SsmFunctionCheck(MockSystemDataSource):
         with self.assertRaises(NotImplementedError) as context:
             main.main("ssm list volumes")
 
+    def test_list_extN(self):
+        # Generate some storage data
+        self._addPool('default_pool', ['/dev/sda', '/dev/sdb'])
+        self._addVol('vol001', 117283225, 1, 'default_pool', ['/dev/sda'],
+                     fstype="ext4")
+
+        # For unmounted fs, it should be tune2fs, otherwise os.statvfs.
+        with self.assertRaises(KeyError) as context:
+            main.main("ssm list volumes")
+        self._cmdEq('tune2fs -l /dev/default_pool/vol001')
+
+        self._mountVol('vol001', 'default_pool', ['/dev/sda'], '/mnt/test1')
+        self.run_data = []
+        with self.assertRaises(NotImplementedError) as context:
+            main.main("ssm list volumes")
+        self.assertFalse([cmd for cmd in self.run_data
+                          if cmd.startswith("tune2fs")])
+
+    def test_list_extN_mounted_size(self):
+        tmp = tempfile.mkdtemp()
+        dev = os.path.join(tmp, "ext4")
+        try:
+            # ext4 with 4KiB blocks, 0x1000 blocks, 0x800 free, 0x10 reserved
+            sb = bytearray(4096)
+            struct.pack_into("<3L", sb, 1024 + 0x04, 0x1000, 0x10, 0x800)
+            struct.pack_into("<L", sb, 1024 + 0x18, 2)
+            struct.pack_into("<H", sb, 1024 + 0x38, 0xEF53)
+            with open(dev, 'wb') as f:
+                f.write(sb)
+            self.dev_data[dev] = {'fstype': 'ext4'}
+            self.mount_data[dev] = {'dev': dev, 'mp': '/mnt/test'}
+            misc.invalidate_caches()
+            # The kernel does not count the metadata in the size
+            main.os.statvfs = lambda mount_point: os.statvfs_result(
+                (4096, 4096, 0x1000 - 0x40, 0x800, 0x7f0, 0, 0, 0, 0, 255))
+
+            # Mounted file system has the same size as the unmounted one
+            fs = main.FsInfo(dev, main.Options())
+            self.assertEqual(fs.data['fs_size'], 0x1000 * 4)
+            self.assertEqual(fs.data['fs_free'], (0x800 - 0x10) * 4)
+            self.assertEqual(fs.data['fs_used'], (0x1000 - 0x800) * 4)
+            self.assertEqual(self.run_data, [])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_mount_index(self):
+        calls = []
+
+        def get_mounts(regex=".*"):
+            calls.append(regex)
+            return self.mount_data
+        misc.get_mounts = get_mounts
+        self.mount_data['/dev/sda'] = {'dev': '/dev/sda', 'mp': '/mnt/test'}
+        misc.invalidate_caches()
+
+        self.assertEqual(misc.get_mount_point('/dev/sda'), '/mnt/test')
+        self.assertEqual(misc.get_mount_point('/dev/sdb'), None)
+        # All the mounts are listed only once
+        self.assertEqual(calls, [".*"])
+
+        misc.invalidate_caches()
+        self.assertEqual(misc.get_mount_point('/dev/sdb'), None)
+        self.assertEqual(len(calls), 2)
+
+    def test_device_partitions(self):
+        misc.get_partitions = lambda: [
+            ['8', '0', 1024, '/dev/sda', '/dev/sda'],
+            ['8', '1', 512, '/dev/sda1', '/dev/sda1', '/dev/sda'],
+            ['8', '2', 512, '/dev/sda2', '/dev/sda2', '/dev/sda'],
+            ['8', '16', 1024, '/dev/sdb', '/dev/sdb'],
+            ['253', '1', 512, '/dev/dm-1', '/dev/mapper/a', '/dev/sdb'],
+            ['253', '10', 512, '/dev/dm-10', '/dev/mapper/b', '/dev/sdb']]
+        data = main.DeviceInfo(options=main.Options()).data
+        self.assertEqual(data['/dev/sda']['partitioned'], 2)
+        self.assertEqual(data['/dev/sda']['mount'], "PARTITIONED")
+        self.assertEqual(data['/dev/sda']['type'], "disk")
+        for name in ['/dev/sda1', '/dev/sda2']:
+            self.assertTrue(data[name]['partition'])
+            self.assertEqual(data[name]['type'], "part")
+        # Devices stacked on top of a device are not its partitions
+        self.assertEqual(data['/dev/sdb']['partitioned'], 0)
+        self.assertEqual(data['/dev/dm-1']['partitioned'], 0)
+        self.assertFalse('partition' in data['/dev/dm-10'])
+
+    def test_create_graph(self):
+        self._addPool('default_pool', ['/dev/sda', '/dev/sdb'])
+        self._addPool('my_pool', ['/dev/sdc2', '/dev/sdc3'])
+        self._addVol('vol001', 117283225, 1, 'default_pool', ['/dev/sda'])
+        self._addVol('vol002', 1024, 1, 'my_pool', ['/dev/sdc2'])
+
+        storage = main.StorageHandle()
+        sources = [storage.pool, storage.dev, storage.vol, storage.snap]
+        main.create_graph(*sources)
+
+        vol = storage.vol['/dev/my_pool/vol002']
+        self.assertEqual([parent.name for parent in vol.parents],
+                         ['my_pool'])
+        vol = storage.vol['/dev/default_pool/vol001']
+        self.assertEqual([parent.name for parent in vol.parents],
+                         ['default_pool'])
+        self.assertEqual(storage.pool['my_pool'].parents, [])
+
+    def test_item_names(self):
+        self._addPool('my_pool', ['/dev/sdc2', '/dev/sdc3'])
+        self._addVol('vol001', 1024, 1, 'my_pool', ['/dev/sdc2'])
+
+        storage = main.StorageHandle()
+        vol = storage.vol['/dev/my_pool/vol001']
+        names = vol.names
+        self.assertTrue('/dev/my_pool/vol001' in names)
+        self.assertTrue(vol.names is names)
+        self.assertFalse(vol.matches_name('/dev/my_pool/renamed'))
+
+        # Names have to follow the changes of the item data
+        vol.update_data({'dev_name': '/dev/my_pool/renamed'})
+        self.assertTrue(vol.matches_name('/dev/my_pool/renamed'))
+        self.assertFalse(vol.names is names)
+
+        # Backend methods are proxied and the proxy is reused
+        self.assertTrue(vol.remove is vol.remove)
+        self.assertRaises(AttributeError, getattr, vol, 'no_such_method')
+
+    def test_fs_probe(self):
+        self._addPool('my_pool', ['/dev/sdc2', '/dev/sdc3'])
+        self._addVol('vol001', 1024, 1, 'my_pool', ['/dev/sdc2'])
+        self._addVol('vol002', 1024, 1, 'my_pool', ['/dev/sdc2'])
+        self.vol_data['/dev/my_pool/vol002']['fstype'] = 'vfat'
+
+        storage = main.StorageHandle()
+        vol = storage.vol['/dev/my_pool/vol001']
+        self.assertEqual(vol.fs_probe, main.FS_PROBE_UNKNOWN)
+        count = main.FS_PROBE_COUNT
+        # No file system, but the device is probed only once
+        self.assertEqual(vol['fs_type'], "")
+        self.assertEqual(vol['fs_size'], "")
+        self.assertEqual(vol['fs_free'], "")
+        self.assertEqual(vol.fs_probe, main.FS_PROBE_NONE)
+        self.assertEqual(main.FS_PROBE_COUNT, count + 1)
+        # Other names of the same volume share the result of the probe
+        self._addLink(vol['dev_name'], '/dev/mapper/my_pool-vol001')
+        alias = storage.vol['/dev/mapper/my_pool-vol001']
+        self.assertFalse(alias is vol)
+        self.assertEqual(alias.fs_probe, main.FS_PROBE_NONE)
+        self.assertEqual(alias['fs_type'], "")
+        self.assertEqual(main.FS_PROBE_COUNT, count + 1)
+
+        vol = storage.vol['/dev/my_pool/vol002']
+        self.assertEqual(vol['fs_type'], "vfat")
+        self.assertEqual(vol['fs_unknown'], "")
+        self.assertEqual(vol.fs_probe, main.FS_PROBE_FS)
+        self.assertEqual(main.FS_PROBE_COUNT, count + 2)
+
+    def test_fs_superblock(self):
+        tmp = tempfile.mkdtemp()
+        ext = os.path.join(tmp, "ext4")
+        xfs = os.path.join(tmp, "xfs")
+        uuid = b"\x12\x34\x56\x78" * 4
+        try:
+            # 64bit ext4 with 4KiB blocks
+            sb = bytearray(4096)
+            struct.pack_into("<4L", sb, 1024 + 0x04, 0x10, 0x1, 0x8, 0)
+            struct.pack_into("<L", sb, 1024 + 0x18, 2)
+            struct.pack_into("<H", sb, 1024 + 0x38, 0xEF53)
+            struct.pack_into("<L", sb, 1024 + 0x60, 0x80 | 0x40)
+            sb[1024 + 0x68:1024 + 0x78] = uuid
+            sb[1024 + 0x78:1024 + 0x81] = b"ext_label"
+            struct.pack_into("<3L", sb, 1024 + 0x150, 1, 0, 1)
+            with open(ext, 'wb') as f:
+                f.write(sb)
+
+            sb = bytearray(512)
+            sb[0:4] = b"XFSB"
+            struct.pack_into(">LQ", sb, 4, 4096, 262144)
+            sb[32:48] = uuid
+            struct.pack_into(">L", sb, 88, 4)
+            struct.pack_into(">L", sb, 96, 1024)
+            sb[108:117] = b"xfs_label"
+            struct.pack_into(">Q", sb, 144, 131072)
+            with open(xfs, 'wb') as f:
+                f.write(sb)
+
+            info = misc.read_ext_superblock(ext)
+            self.assertEqual(info['block_size'], 4096)
+            self.assertEqual(info['block_count'], (1 << 32) + 0x10)
+            self.assertEqual(info['free_blocks'], (1 << 32) + 0x8)
+            self.assertEqual(info['reserved_blocks'], 0x1)
+            self.assertEqual(info['uuid'],
+                             "12345678-1234-5678-1234-567812345678")
+            self.assertEqual(info['label'], "ext_label")
+            self.assertEqual(misc.read_xfs_superblock(ext), None)
+
+            info = misc.read_xfs_superblock(xfs)
+            self.assertEqual(info['block_count'], 262144)
+            self.assertEqual(info['free_blocks'], 131072)
+            self.assertEqual(info['ag_count'], 4)
+            self.assertEqual(info['log_blocks'], 1024)
+            self.assertEqual(info['label'], "xfs_label")
+            self.assertEqual(misc.read_ext_superblock(xfs), None)
+            self.assertEqual(misc.read_ext_superblock(
+                             os.path.join(tmp, "missing")), None)
+
+            # File system information does not need any tools
+            self.dev_data[ext] = {'fstype': 'ext4'}
+            self.dev_data[xfs] = {'fstype': 'xfs'}
+            fs = main.FsInfo(ext, main.Options())
+            self.assertEqual(fs.data['fs_size'], ((1 << 32) + 0x10) * 4)
+            self.assertEqual(fs.data['fs_free'], ((1 << 32) + 0x7) * 4)
+            self.assertEqual(fs.data['fs_used'], 0x8 * 4)
+            self.assertEqual(fs.data['fs_uuid'],
+                             "12345678-1234-5678-1234-567812345678")
+            self.assertEqual(fs.data['fs_label'], "ext_label")
+            fs = main.FsInfo(xfs, main.Options())
+            self.assertEqual(fs.data['fs_size'], (262144 - 1024) * 4)
+            self.assertEqual(fs.data['fs_free'], (131072 - 12) * 4)
+            self.assertEqual(fs.data['fs_uuid'],
+                             "12345678-1234-5678-1234-567812345678")
+            self.assertEqual(fs.data['fs_label'], "xfs_label")
+            self.assertEqual(self.run_data, [])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_list_cache(self):
+        list_cache_orig = main.SSM_LIST_CACHE
+        get_topology_stamp_orig = misc.get_topology_stamp
+        stdout_orig = sys.stdout
+        tmp = tempfile.mkdtemp()
+        stamp = ["1"]
+
+        def list_pools():
+            self.run_data = []
+            sys.stdout = output = StringIO()
+            try:
+                main.main("ssm list pool")
+            finally:
+                sys.stdout = stdout_orig
+            return output.getvalue()
+
+        try:
+            main.SSM_LIST_CACHE = True
+            misc.SSM_CACHE_DIR = tmp
+            misc.get_topology_stamp = lambda: stamp[0]
+            self._addPool('default_pool', ['/dev/sda', '/dev/sdb'])
+
+            output = list_pools()
+            self.assertTrue("default_pool" in output)
+            self.assertTrue(self.run_data)
+
+            # Nothing is gathered as long as the stamp is the same
+            self._addPool('my_pool', ['/dev/sdc2', '/dev/sdc3'])
+            self.assertEqual(list_pools(), output)
+            self.assertEqual(self.run_data, [])
+
+            stamp[0] = "2"
+            output = list_pools()
+            self.assertTrue("my_pool" in output)
+
+            # Changing the storage drops the cache
+            self._checkCmd("ssm add", ['-p my_pool', '/dev/sdd'],
+                           "pool extend my_pool /dev/sdd")
+            self.assertFalse(os.path.exists(os.path.join(tmp, "list.json")))
+        finally:
+            main.SSM_LIST_CACHE = list_cache_orig
+            misc.get_topology_stamp = get_topology_stamp_orig
+            sys.stdout = stdout_orig
+            shutil.rmtree(tmp)
+
     def test_remove(self):
         # Generate some storage data
         self._addPool('default_pool', ['/dev/sda', '/dev/sdb'])
@@ -963,6 +1236,8 @@ class DevInfo(MyInfo):
 
 
 class Pool(main.Storage):
+    ATTRS = ['pool_name', 'dev_count', 'pool_free', 'pool_used', 'pool_size']
+
     def __init__(self, *args, **kwargs):
         super(Pool, self).__init__(*args, **kwargs)
         _default_backend = PoolInfo(options=self.options)
@@ -973,11 +1248,14 @@ class Pool(main.Storage):
             obj=_default_backend, name=main.DEFAULT_DEVICE_POOL,
             source=self)
         self.header = ['Pool', 'Devices', 'Free', 'Used', 'Total']
-        self.attrs = ['pool_name', 'dev_count', 'pool_free', 'pool_used', 'pool_size']
+        self.attrs = list(self.ATTRS)
         self.types = [str, str, float, float, float]
 
 
 class Volumes(main.Storage):
+    ATTRS = ['dev_name', 'dev_size', 'fs_type',
+             'fs_free', 'fs_used', 'fs_size', 'type', 'mount']
+
     def __init__(self, *args, **kwargs):
         super(Volumes, self).__init__(*args, **kwargs)
         self.name_fields = set(['dev_name', 'dm_name', 'real_dev','lv_name'])
@@ -985,12 +1263,14 @@ class Volumes(main.Storage):
         self._data = {'test': VolumeInfo(options=self.options)}
         self.header = ['Volume', 'Volume size', 'FS', 'Free',
                        'Used', 'FS size', 'Type', 'Mount point']
-        self.attrs = ['dev_name', 'dev_size', 'fs_type',
-                      'fs_free', 'fs_used', 'fs_size', 'type', 'mount']
+        self.attrs = list(self.ATTRS)
         self.types = [str, float, str, float, float, float, str, str]
 
 
 class Devices(main.Storage):
+    ATTRS = ['dev_name', 'dev_free', 'dev_used', 'dev_size',
+             'pool_name', 'mount']
+
     def __init__(self, *args, **kwargs):
         super(Devices, self).__init__(*args, **kwargs)
         self.name_fields = set(['dev_name', 'mount'])
@@ -999,6 +1279,5 @@ class Devices(main.Storage):
                                 data=DevInfo(options=self.options).data)}
         self.header = ['Device', 'Free', 'Used',
                        'Total', 'Pool', 'Mount point']
-        self.attrs = ['dev_name', 'dev_free', 'dev_used', 'dev_size',
-                      'pool_name', 'mount']
+        self.attrs = list(self.ATTRS)
         self.types = [str, float, float, float, str, str]